@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Micro-benchmark: check_file_exit with keyed index vs. the old nested linear scan
+# 合成 1M 条目标文件和未完成 Upload 列表，对比线性遍历与索引查找的耗时
+# Run: python3 benchmark/bench_index.py [entries]
+
+import os
+import sys
+import time
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import s3_upload  # noqa: E402
+
+Entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+LinearSample = 20  # 线性遍历太慢，只抽样部分源文件再按比例估算
+
+
+def linear_check_file_exit(srcfile, desFilelist, UploadIdList):
+    # 旧实现：对每个源文件遍历整个目标列表和 Upload 列表
+    for f in desFilelist:
+        if f["Key"] == srcfile["Key"] and srcfile["Size"] == f["Size"]:
+            return 'NEXT'
+    keyIDList = [u for u in UploadIdList if u["Key"] == srcfile["Key"]]
+    if not keyIDList:
+        return 'UPLOAD'
+    UploadID_latest = keyIDList[0]
+    for u in keyIDList:
+        if u["Initiated"] > UploadID_latest["Initiated"]:
+            UploadID_latest = u
+    return UploadID_latest["UploadId"]
+
+
+def main():
+    s3_upload.JobType = 'S3_TO_S3'
+    base_time = datetime.datetime(2020, 1, 1)
+    des_file_list = [{"Key": f'prefix/{i:08d}', "Size": i + 1, "ETag": f'"{i:032x}"'}
+                     for i in range(Entries)]
+    upload_id_list = [{"Key": f'prefix/{i:08d}', "UploadId": f'upload-{i}',
+                       "Initiated": base_time + datetime.timedelta(seconds=i)}
+                      for i in range(0, Entries, 10)]
+    # 源文件：一半已存在（同Size），一半是新文件或大小不同
+    src_file_list = [{"Key": f'prefix/{i:08d}', "Size": i + 1 + (i % 2)} for i in range(Entries)]
+    print(f'Entries: {Entries} destination, {len(upload_id_list)} unfinished uploads, {Entries} source')
+
+    start = time.perf_counter()
+    dest = s3_upload.Destination('bench-des', None, 'STANDARD')
+    dest.des_file_index = s3_upload.build_des_file_index(des_file_list)
+    dest.upload_id_index = s3_upload.build_upload_id_index(upload_id_list)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for src_file in src_file_list:
+        s3_upload.check_file_exit(src_file, dest)
+    index_time = time.perf_counter() - start
+
+    # 抽样的源文件取列表尾部，线性遍历的最坏情况
+    sample = src_file_list[-LinearSample:]
+    start = time.perf_counter()
+    for src_file in sample:
+        linear_result = linear_check_file_exit(src_file, des_file_list, upload_id_list)
+        assert linear_result == s3_upload.check_file_exit(src_file, dest)
+    linear_time = (time.perf_counter() - start) / LinearSample * Entries
+
+    print(f'Index build:          {build_time:.3f}s')
+    print(f'Indexed check (all):  {index_time:.3f}s  ({index_time / Entries * 1e6:.3f} us/file)')
+    print(f'Linear check (est.):  {linear_time:.1f}s  ({linear_time / Entries * 1e6:.1f} us/file, '
+          f'sampled {LinearSample} files)')
+    print(f'Speedup: {linear_time / (build_time + index_time):.0f}x')
+
+
+if __name__ == '__main__':
+    main()
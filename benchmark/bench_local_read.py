@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Benchmark: LOCAL_TO_S3 part reading, old read() into bytes vs. mmap memoryview vs. buffer pool
+# 每种模式在单独的子进程中运行，对比耗时、CPU 时间、峰值 RSS。mmap 的页是文件页(可回收的 page cache)，
+# 所以另外在 Linux 上采样 /proc/self/status 的 RssAnon，即真正分配的匿名内存峰值
+# Run: python3 benchmark/bench_local_read.py [file_MB] [chunk_MB] [threads]
+
+import os
+import sys
+import json
+import time
+import hashlib
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent import futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+Megabytes = 1024*1024
+SendBlockSize = 64 * 1024  # 模拟 http 发送时每次从 Body 读取的块大小
+
+
+def rss_anon_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def run_mode(mode, path, chunk_size, threads):
+    import s3_upload
+    file_size = os.path.getsize(path)
+    peak_anon = [rss_anon_kb()]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.is_set():
+            peak_anon[0] = max(peak_anon[0], rss_anon_kb())
+            time.sleep(0.005)
+
+    if mode == 'read':
+        # 旧实现：每个分片 open/seek/read 一个新的 bytes，bytes 作为 Body 整块发送
+        def part(start):
+            with open(path, 'rb') as data:
+                data.seek(start)
+                chunkdata = data.read(chunk_size)
+            hashlib.md5(chunkdata)
+            memoryview(chunkdata)  # http 发送 bytes 不再复制
+    else:
+        s3_upload.LocalMmapRead = (mode == 'mmap')
+        reader = s3_upload.LocalFileReader(path)
+
+        def part(start):
+            with reader.part(start, chunk_size) as chunkdata:
+                hashlib.md5(chunkdata)
+                body = s3_upload.PartReader(chunkdata)
+                while body.read(SendBlockSize):
+                    pass
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(part, range(0, file_size, chunk_size)))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    stop.set()
+    sampler.join()
+    if mode != 'read':
+        reader.close()
+    print(json.dumps({
+        "mode": mode,
+        "wall_s": round(wall, 3),
+        "cpu_s": round(cpu, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_rss_anon_mb": round(peak_anon[0] / 1024, 1)
+    }))
+
+
+def main():
+    file_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    chunk_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.bin')
+        with open(path, 'wb') as f:
+            for i in range(file_mb):
+                f.write(os.urandom(Megabytes))
+        print(f'File {file_mb}MB, chunk {chunk_mb}MB, threads {threads}')
+        for mode in ('read', 'mmap', 'buffer'):
+            # 子进程的当前目录设为临时目录，s3_upload 的日志目录不落在仓库里
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode, path,
+                            str(chunk_mb * Megabytes), str(threads)], cwd=tmp, check=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--mode':
+        run_mode(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+    else:
+        main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Benchmark: local tree listing, old os.walk + getsize vs. parallel scandir walker (iter_local_file_list)
+# 生成一个多层目录树，对比旧的单线程 os.walk 与不同 MaxWalkThread 的并发遍历耗时，并核对文件列表一致
+# MaxWalkThread = 1 是列表线程里的顺序遍历(默认)，省的是每个文件单独 getsize 的 syscall；本地盘有 page cache 时
+# 多线程受 GIL 和队列开销限制反而更慢，只有 NFS/EFS 这类每次 stat 是网络往返的文件系统才适合加大
+# Run: python3 benchmark/bench_local_walk.py [depth] [fanout] [files_per_dir] [existing_dir]
+
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def make_tree(root, depth, fanout, files_per_dir):
+    count = 0
+    dirs = [root]
+    for level in range(depth + 1):
+        next_dirs = []
+        for d in dirs:
+            for i in range(files_per_dir):
+                with open(os.path.join(d, f'f{i}.dat'), 'wb') as f:
+                    f.write(b'x' * (i + 1))
+                count += 1
+            if level < depth:
+                for i in range(fanout):
+                    sub = os.path.join(d, f'd{i}')
+                    os.mkdir(sub)
+                    next_dirs.append(sub)
+        dirs = next_dirs
+    return count
+
+
+def old_walk(root):
+    # 旧实现：os.walk + 每个文件单独 getsize + Path
+    file_list = []
+    for parent, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            file_absPath = os.path.join(parent, filename)
+            file_list.append({"Key": Path(file_absPath[len(root)+1:]), "Size": os.path.getsize(file_absPath)})
+    return file_list
+
+
+def main():
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    fanout = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    files_per_dir = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    existing_dir = sys.argv[4] if len(sys.argv) > 4 else ''
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # s3_upload 的日志目录不落在仓库里
+        import s3_upload
+        if existing_dir:
+            root = existing_dir.rstrip('/')
+            print(f'Tree: {root}')
+        else:
+            root = os.path.join(tmp, 'tree')
+            os.mkdir(root)
+            count = make_tree(root, depth, fanout, files_per_dir)
+            print(f'Tree: depth {depth}, fanout {fanout}, {files_per_dir} files/dir, {count} files')
+        s3_upload.SrcDir = root
+        s3_upload.SrcFileIndex = "*"
+        s3_upload.IgnoreSmallFile = False
+
+        start = time.perf_counter()
+        expected = old_walk(root)
+        old_time = time.perf_counter() - start
+        expected = sorted((str(f["Key"]), f["Size"]) for f in expected)
+        print(f'os.walk + getsize:        {old_time:.3f}s')
+
+        for threads in (1, 4, 16, 64):
+            s3_upload.MaxWalkThread = threads
+            start = time.perf_counter()
+            result = list(s3_upload.iter_local_file_list())
+            new_time = time.perf_counter() - start
+            assert sorted((str(f["Key"]), f["Size"]) for f in result) == expected
+            label = 'serial' if threads == 1 else f'{threads:2d} threads'
+            print(f'scandir, {label:10s}:      {new_time:.3f}s  ({old_time / new_time:.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
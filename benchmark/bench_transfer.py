@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Benchmark: end-to-end LOCAL_TO_S3 / S3_TO_S3 throughput against an in-process S3 stand-in (fake_s3.py)
+# 对 ChunkSize x MaxThread x MaxParallelFile 做网格扫描，每个组合在单独的子进程里完整运行一次 s3_upload.py
+# 可注入请求延迟、全局带宽上限、随机错误率(SlowDown 503)，数据集是少量大文件或大量小文件
+# 结果(耗时、吞吐量、请求数、重试数、各阶段耗时、CPU、峰值 RSS、目标核对)写到 JSON，用于比较版本间的性能回归
+# Run: python3 benchmark/bench_transfer.py --jobs LOCAL_TO_S3,S3_TO_S3 --datasets huge:4x256MB,tiny:20000x4KB \
+#          --chunk-mb 8,32 --threads 5,20 --parallel-files 1,5 --latency-ms 20 --bandwidth-mbps 1000 \
+#          --error-rate 0.01 --output bench_transfer.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import contextlib
+import subprocess
+
+BenchDir = os.path.dirname(os.path.abspath(__file__))
+RepoDir = os.path.join(BenchDir, '..')
+sys.path.insert(0, BenchDir)
+sys.path.insert(0, RepoDir)
+
+Megabytes = 1024*1024
+Units = {'B': 1, 'KB': 1024, 'MB': Megabytes, 'GB': 1024*Megabytes}
+FilesPerDir = 1000
+SrcBucket = 'bench-src'
+DesBucket = 'bench-des'
+S3Prefix = 'bench'
+
+
+# "huge:4x256MB" -> ('huge', 4, 268435456)
+def parse_dataset(spec):
+    name, shape = spec.split(':')
+    count, size = shape.upper().split('X')
+    unit = next(u for u in sorted(Units, key=len, reverse=True) if size.endswith(u))
+    return name, int(count), int(float(size[:-len(unit)]) * Units[unit])
+
+
+def dataset_keys(name, count):
+    return [f'{name}/d{i // FilesPerDir}/f{i}.dat' for i in range(count)]
+
+
+def make_local_dataset(root, name, count, size):
+    from fake_s3 import FakeS3Server
+    for key in dataset_keys(name, count):
+        path = os.path.join(root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for start in range(0, size, 64 * Megabytes):
+                f.write(FakeS3Server.source_bytes(key, start, min(start + 64 * Megabytes, size)))
+
+
+# 子进程：启动 fake S3，替换 boto3 Session，按参数覆盖配置后用 Transferer 运行一次任务
+def run_case(case_path):
+    with open(case_path) as f:
+        case = json.load(f)
+    import boto3.session
+    from fake_s3 import FakeS3Server, make_session_class
+    server = FakeS3Server(latency=case["LatencyMs"] / 1000, bandwidth=case["BandwidthMbps"] * Megabytes / 8,
+                          error_rate=case["ErrorRate"])
+    name, count, size = case["Dataset"]
+    keys = dataset_keys(name, count)
+    if case["JobType"] == 'S3_TO_S3':
+        for key in keys:
+            server.add_source(SrcBucket, f'{S3Prefix}/{key}', size)
+    boto3.session.Session = make_session_class(server)
+
+    import s3_upload
+    overrides = {
+        "JobType": case["JobType"],
+        "SrcFileIndex": "*",
+        "SrcDir": case["SrcDir"],
+        "SrcBucket": SrcBucket,
+        "DesBucket": DesBucket,
+        "S3Prefix": S3Prefix,
+        "ChunkSize": case["ChunkSize"],
+        "SmallFileThreshold": case["ChunkSize"],
+        "MaxThread": case["MaxThread"],
+        "MaxParallelFile": case["MaxParallelFile"],
+        "DontAskMeToClean": True,
+        "SyncManifestFile": "",
+        "ResumeJournalFile": "",
+        "LoggingLevel": "WARNING"
+    }
+    overrides.update(case["Config"])
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            s3_upload.Transferer() as transferer:
+        job_result = transferer.run(s3_upload.TransferJob(**overrides))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    # 核对目标：每个源文件都在目标且大小一致；打包上传的小文件不是单独的对象，压缩上传的对象大小与源文件不同，
+    # 这两种只看任务自己的校验结果
+    packed = case["JobType"] == 'LOCAL_TO_S3' and overrides.get("PackSmallFiles") and size < overrides["SmallFileThreshold"]
+    trust_job = packed or overrides.get("Compression")
+    missing = [k for k in keys if not trust_job and
+               server.objects.get((DesBucket, f'{S3Prefix}/{k}'), {}).get("Size") != size]
+    snapshot = s3_upload.metrics.snapshot()
+    total = count * size
+    result = dict(case["Result"])
+    result.update({
+        "WallSeconds": round(wall, 3),
+        "CpuSeconds": round(cpu, 3),
+        "MBPerSecond": round(total / Megabytes / wall, 2),
+        "FilesPerSecond": round(count / wall, 2),
+        "PeakRssMB": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "Requests": dict(sorted(server.calls.items())),
+        "InjectedErrors": server.errors,
+        "Retries": snapshot["Counters"].get("retries", {}),
+        "Stages": {stage: {"Count": s["Count"], "AvgSeconds": s["AvgSeconds"]}
+                   for stage, s in snapshot["Stages"].items()},
+        "Verified": not missing and not job_result["Delta"],
+        "Missing": len(missing)
+    })
+    with open(case_path, 'w') as f:
+        json.dump(result, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='s3_upload throughput benchmark against an in-process S3 stand-in')
+    parser.add_argument('--jobs', default='LOCAL_TO_S3,S3_TO_S3')
+    parser.add_argument('--datasets', default='huge:4x256MB,tiny:20000x4KB',
+                        help='name:COUNTxSIZE, comma separated')
+    parser.add_argument('--chunk-mb', default='8,32')
+    parser.add_argument('--threads', default='5,20', help='MaxThread values')
+    parser.add_argument('--parallel-files', default='1,5', help='MaxParallelFile values')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--bandwidth-mbps', type=float, default=1000, help='0 = unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--config', default='{}', help='extra s3_upload_config overrides, JSON')
+    parser.add_argument('--output', default='bench_transfer.json')
+    args = parser.parse_args()
+
+    jobs = args.jobs.split(',')
+    datasets = [parse_dataset(d) for d in args.datasets.split(',')]
+    grid = list(itertools.product([int(c) for c in args.chunk_mb.split(',')],
+                                  [int(t) for t in args.threads.split(',')],
+                                  [int(p) for p in args.parallel_files.split(',')]))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        src_dir = os.path.join(tmp, 'src')
+        if 'LOCAL_TO_S3' in jobs:
+            for name, count, size in datasets:
+                print(f'Generating local dataset {name}: {count} x {size} bytes')
+                make_local_dataset(os.path.join(src_dir, name), name, count, size)
+        for job, (name, count, size), (chunk_mb, threads, parallel_files), run in itertools.product(
+                jobs, datasets, grid, range(args.repeat)):
+            result = {
+                "JobType": job,
+                "Dataset": name,
+                "Files": count,
+                "FileSize": size,
+                "ChunkSize": chunk_mb * Megabytes,
+                "MaxThread": threads,
+                "MaxParallelFile": parallel_files,
+                "LatencyMs": args.latency_ms,
+                "BandwidthMbps": args.bandwidth_mbps,
+                "ErrorRate": args.error_rate,
+                "Run": run
+            }
+            # 每个组合一个新的子进程和工作目录：模块状态、log 目录互不影响，也不落在仓库里
+            case_dir = tempfile.mkdtemp(dir=tmp)
+            case_path = os.path.join(case_dir, 'case.json')
+            with open(case_path, 'w') as f:
+                json.dump({
+                    "JobType": job,
+                    "Dataset": [name, count, size],
+                    "SrcDir": os.path.join(src_dir, name),
+                    "ChunkSize": chunk_mb * Megabytes,
+                    "MaxThread": threads,
+                    "MaxParallelFile": parallel_files,
+                    "LatencyMs": args.latency_ms,
+                    "BandwidthMbps": args.bandwidth_mbps,
+                    "ErrorRate": args.error_rate,
+                    "Config": json.loads(args.config),
+                    "Result": result
+                }, f)
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', case_path],
+                                  cwd=case_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            if proc.returncode != 0:
+                result["Error"] = proc.stderr.strip().splitlines()[-1:] or ['exit code %d' % proc.returncode]
+            else:
+                with open(case_path) as f:
+                    result = json.load(f)
+            results.append(result)
+            print(f'{job:12s} {name:6s} chunk {chunk_mb:4d}MB threads {threads:3d} files {parallel_files:3d}: ' +
+                  (f'{result["WallSeconds"]:8.2f}s {result["MBPerSecond"]:9.2f}MB/s '
+                   f'{result["FilesPerSecond"]:9.2f} files/s retries {sum(result["Retries"].values())} '
+                   f'verified {result["Verified"]}' if "Error" not in result else f'ERROR {result["Error"]}'))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            "Environment": {
+                "Python": platform.python_version(),
+                "Platform": platform.platform(),
+                "CPUs": os.cpu_count(),
+                "Time": time.strftime('%Y-%m-%dT%H:%M:%S')
+            },
+            "Arguments": vars(args),
+            "Results": results
+        }, f, indent=2)
+    print('Results written to', os.path.abspath(args.output))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--case':
+        run_case(sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# In-process S3 stand-in for benchmarks: the subset of the boto3 S3 client used by s3_upload.py
+# 可注入每个请求的延迟、全局带宽上限(所有线程共享)、随机错误率(返回 SlowDown 503)
+# 只保存目标对象的大小和 MD5，源对象按 Key 生成确定的内容，大数据集也不占内存
+
+import time
+import base64
+import random
+import hashlib
+import datetime
+import itertools
+import threading
+from botocore.exceptions import ClientError
+
+Megabytes = 1024*1024
+
+
+class FakeS3Server:
+    def __init__(self, latency=0.0, bandwidth=0, error_rate=0.0, seed=1):
+        self.latency = latency  # 每个请求的延迟，秒
+        self.bandwidth = bandwidth  # 全局带宽上限 bytes/s，0 则不限
+        self.error_rate = error_rate  # upload/get/put 请求随机失败的比例
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_free = 0.0  # 带宽令牌桶：下一段数据可以开始发送的时间
+        self.sources = {}  # (bucket, key) -> size，内容按 Key 生成
+        self.objects = {}  # (bucket, key) -> {"Size", "ETag"}
+        self.uploads = {}  # uploadId -> {"Bucket", "Key", "Initiated", "Parts": {n: {"Size", "ETag"}}}
+        self.upload_ids = itertools.count(1)
+        self.calls = {}
+        self.errors = 0
+
+    def add_source(self, bucket, key, size):
+        self.sources[(bucket, key)] = size
+        self.objects[(bucket, key)] = {"Size": size, "ETag": None}
+
+    # 源对象内容：以 Key 的哈希生成 1MB 的块，重复到文件大小
+    @staticmethod
+    def source_bytes(key, start, end):
+        block = (hashlib.sha256(key.encode('utf-8')).digest() * (Megabytes // 32 + 1))[:Megabytes]
+        offset = start % Megabytes
+        n = end - start
+        repeat = (offset + n) // Megabytes + 1
+        return (block * repeat)[offset:offset+n]
+
+    def request(self, op, nbytes=0, can_fail=False):
+        with self.lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+            fail = can_fail and self.error_rate > 0 and self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            wait_until = time.time() + self.latency
+            if self.bandwidth and nbytes:
+                start = max(self.next_free, time.time())
+                self.next_free = start + nbytes / self.bandwidth
+                wait_until = max(wait_until, self.next_free)
+        delay = wait_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            raise ClientError({"Error": {"Code": "SlowDown", "Message": "Please reduce your request rate."},
+                               "ResponseMetadata": {"HTTPStatusCode": 503}}, op)
+
+
+class StreamingBody:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = len(self.data) - self.pos
+        chunk = self.data[self.pos:self.pos+n]
+        self.pos += len(chunk)
+        return chunk
+
+    def iter_chunks(self, chunk_size=Megabytes):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def read_body(Body):
+    if hasattr(Body, 'read'):
+        Body = Body.read()
+    if isinstance(Body, str):
+        Body = Body.encode('utf-8')
+    return bytes(Body)
+
+
+def not_found(code, op):
+    return ClientError({"Error": {"Code": code, "Message": code},
+                        "ResponseMetadata": {"HTTPStatusCode": 404}}, op)
+
+
+class FakeS3Client:
+    def __init__(self, server):
+        self.server = server
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, Delimiter=None, **kwargs):
+        self.server.request('list_objects_v2')
+        with self.server.lock:
+            keys = sorted(k for (b, k) in self.server.objects if b == Bucket and k.startswith(Prefix))
+        if ContinuationToken:
+            keys = [k for k in keys if k > ContinuationToken]
+        entries = []
+        seen = set()
+        for k in keys:
+            if Delimiter and Delimiter in k[len(Prefix):]:
+                common_prefix = Prefix + k[len(Prefix):].split(Delimiter)[0] + Delimiter
+                if common_prefix not in seen:
+                    seen.add(common_prefix)
+                    entries.append((common_prefix, None))
+                continue
+            entries.append((k, self.server.objects[(Bucket, k)]))
+            if len(entries) > MaxKeys:
+                break
+        page = entries[:MaxKeys]
+        response = {"IsTruncated": len(entries) > MaxKeys, "KeyCount": len(page),
+                    "Contents": [{"Key": k, "Size": o["Size"], "ETag": o["ETag"] or '""'} for k, o in page if o],
+                    "CommonPrefixes": [{"Prefix": k} for k, o in page if o is None]}
+        if response["IsTruncated"]:
+            # 最后一个是 CommonPrefix 时要跳过它下面的所有 Key
+            last = page[-1][0]
+            response["NextContinuationToken"] = last + '￿' if page[-1][1] is None else last
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.server.request('head_object')
+        o = self.server.objects.get((Bucket, Key))
+        if o is None:
+            raise not_found('NoSuchKey', 'HeadObject')
+        return {"ContentLength": o["Size"], "ETag": o["ETag"]}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        size = self.server.sources.get((Bucket, Key))
+        if size is None:
+            raise not_found('NoSuchKey', 'GetObject')
+        start, end = 0, size
+        if Range:
+            a, b = Range[len('bytes='):].split('-')
+            start, end = int(a), min(int(b) + 1, size)
+        self.server.request('get_object', end - start, can_fail=True)
+        return {"Body": StreamingBody(FakeS3Server.source_bytes(Key, start, end)), "ContentLength": end - start}
+
+    def put_object(self, Bucket, Key, Body=b'', ContentMD5=None, **kwargs):
+        data = read_body(Body)
+        self.server.request('put_object', len(data), can_fail=True)
+        md5 = hashlib.md5(data)
+        if ContentMD5 is not None and ContentMD5 != base64.b64encode(md5.digest()).decode('utf-8'):
+            raise ClientError({"Error": {"Code": "BadDigest"}, "ResponseMetadata": {"HTTPStatusCode": 400}}, 'PutObject')
+        etag = f'"{md5.hexdigest()}"'
+        with self.server.lock:
+            self.server.objects[(Bucket, Key)] = {"Size": len(data), "ETag": etag}
+        return {"ETag": etag}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        size = self.server.sources[(CopySource["Bucket"], CopySource["Key"])]
+        self.server.request('copy_object', can_fail=True)
+        with self.server.lock:
+            self.server.objects[(Bucket, Key)] = {"Size": size, "ETag": '"copy"'}
+        return {"CopyObjectResult": {"ETag": '"copy"'}}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.server.request('delete_object')
+        with self.server.lock:
+            self.server.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_multipart_uploads(self, Bucket, Prefix='', KeyMarker='', **kwargs):
+        self.server.request('list_multipart_uploads')
+        with self.server.lock:
+            uploads = [{"Key": u["Key"], "UploadId": i, "Initiated": u["Initiated"]}
+                       for i, u in self.server.uploads.items()
+                       if u["Bucket"] == Bucket and u["Key"].startswith(Prefix)]
+        return {"IsTruncated": False, "NextKeyMarker": uploads[-1]["Key"] if uploads else '', "Uploads": uploads}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.server.request('create_multipart_upload')
+        uploadId = f'upload-{next(self.server.upload_ids)}'
+        with self.server.lock:
+            self.server.uploads[uploadId] = {"Bucket": Bucket, "Key": Key, "Parts": {},
+                                             "Initiated": datetime.datetime.now(datetime.timezone.utc)}
+        return {"UploadId": uploadId}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body, ContentMD5=None, **kwargs):
+        data = read_body(Body)
+        self.server.request('upload_part', len(data), can_fail=True)
+        md5 = hashlib.md5(data)
+        if ContentMD5 is not None and ContentMD5 != base64.b64encode(md5.digest()).decode('utf-8'):
+            raise ClientError({"Error": {"Code": "BadDigest"}, "ResponseMetadata": {"HTTPStatusCode": 400}}, 'UploadPart')
+        etag = f'"{md5.hexdigest()}"'
+        with self.server.lock:
+            if UploadId not in self.server.uploads:
+                raise not_found('NoSuchUpload', 'UploadPart')
+            self.server.uploads[UploadId]["Parts"][PartNumber] = {"Size": len(data), "ETag": etag, "MD5": md5.digest()}
+        return {"ETag": etag}
+
+    def upload_part_copy(self, Bucket, Key, PartNumber, UploadId, CopySource, CopySourceRange, **kwargs):
+        a, b = CopySourceRange[len('bytes='):].split('-')
+        data = FakeS3Server.source_bytes(CopySource["Key"], int(a), int(b) + 1)
+        self.server.request('upload_part_copy', can_fail=True)
+        md5 = hashlib.md5(data)
+        etag = f'"{md5.hexdigest()}"'
+        with self.server.lock:
+            self.server.uploads[UploadId]["Parts"][PartNumber] = {"Size": len(data), "ETag": etag, "MD5": md5.digest()}
+        return {"CopyPartResult": {"ETag": etag}}
+
+    def list_parts(self, Bucket, Key, UploadId, MaxParts=1000, PartNumberMarker=0, **kwargs):
+        self.server.request('list_parts')
+        with self.server.lock:
+            parts = sorted(self.server.uploads[UploadId]["Parts"].items())
+        parts = [(n, p) for n, p in parts if n > PartNumberMarker]
+        page = parts[:MaxParts]
+        return {"IsTruncated": len(parts) > MaxParts,
+                "NextPartNumberMarker": page[-1][0] if page else 0,
+                "Parts": [{"PartNumber": n, "ETag": p["ETag"], "Size": p["Size"]} for n, p in page]}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.server.request('complete_multipart_upload')
+        with self.server.lock:
+            upload = self.server.uploads.pop(UploadId)
+            parts = [upload["Parts"][p["PartNumber"]] for p in MultipartUpload["Parts"]]
+            etag = '"%s-%d"' % (hashlib.md5(b''.join(p["MD5"] for p in parts)).hexdigest(), len(parts))
+            self.server.objects[(Bucket, Key)] = {"Size": sum(p["Size"] for p in parts), "ETag": etag}
+        return {"ETag": etag, "Location": f'{Bucket}/{Key}'}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.server.request('abort_multipart_upload')
+        with self.server.lock:
+            self.server.uploads.pop(UploadId, None)
+        return {}
+
+
+# 替换 boto3.session.Session，所有 profile 的 client 都指向同一个 FakeS3Server
+def make_session_class(server):
+    class FakeSession:
+        def __init__(self, profile_name=None, **kwargs):
+            pass
+
+        def client(self, service_name, config=None, **kwargs):
+            return FakeS3Client(server)
+    return FakeSession
@@ -16,107 +16,760 @@ from s3_upload_config import *
 import time
 import hashlib
 import logging
+import queue
+import threading
+import collections
+import io
+import mmap
+import contextlib
+import sqlite3
+import asyncio
+import functools
+import subprocess
+import random
+import http.server
+import cProfile
+import pstats
+import tracemalloc
+import shutil
+import tarfile
+import zlib
+import itertools
 from pathlib import PurePosixPath, Path
-if JobType == 'ALIOSS_TO_S3':
-    import oss2  # for Ali Cloud Oss storage download
+import s3_upload_config
+# 可选依赖按任务配置在 load_optional_modules 中导入，import 本模块没有副作用
+oss2 = None  # for Ali Cloud Oss storage download
+AioSession = AioConfig = None  # asyncio 引擎的异步 S3 client
+crc32c = None  # pip install crc32c
 
-# Configure logging
-logger = logging.getLogger()
-# File logging
-os.system("mkdir log")
+# 配置文件里的全部配置项，TransferJob 以它为默认值
+DefaultConfig = {k: v for k, v in vars(s3_upload_config).items() if not k.startswith('_')}
+
+
+def load_optional_modules():
+    global oss2, AioSession, AioConfig, crc32c
+    if JobType == 'ALIOSS_TO_S3' and oss2 is None:
+        import oss2
+    if Engine == 'asyncio' and AioSession is None:
+        try:
+            from aiobotocore.session import AioSession
+            from aiobotocore.config import AioConfig
+        except ImportError:
+            AioSession = None
+    if ChecksumAlgorithm == 'CRC32C' and crc32c is None:
+        try:
+            import crc32c
+        except ImportError:
+            crc32c = None
+
+
+# Configure logging：只用本模块的 logger，不改动 root logger，嵌入的调用方自己配置 logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())  # 调用方没配置 logging 时也不由 logging 的默认 handler 输出到屏幕
 this_file_name = os.path.splitext(os.path.basename(__file__))[0]
-t = time.gmtime()
-file_time = f'{t.tm_year}-{t.tm_mon}-{t.tm_mday}-{t.tm_hour}-{t.tm_min}-{t.tm_sec}'
-log_file_name = './log/'+this_file_name+'-'+file_time+'.log'
-print('Logging to file:', os.path.abspath(log_file_name), 'Logging level:', LoggingLevel)
-fileHandler = logging.FileHandler(filename=log_file_name)
-fileHandler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s - %(message)s'))
-logger.addHandler(fileHandler)
-# Screen stream logging
-streamHandler = logging.StreamHandler()
-streamHandler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s - %(message)s'))
-logger.addHandler(streamHandler)
-# Loggin Level
-logger.setLevel(logging.WARNING)
-if LoggingLevel == 'INFO':
-    logger.setLevel(logging.INFO)
-elif LoggingLevel == 'DEBUG':
-    logger.setLevel(logging.DEBUG)
+log_file_name = None  # setup_logging 之后是本次任务的日志文件
+log_handlers = []
 
 
-def get_local_file_list():
-    __src_file_list = []
+def job_time():
+    t = time.gmtime()
+    file_time = f'{t.tm_year}-{t.tm_mon}-{t.tm_mday}-{t.tm_hour}-{t.tm_min}-{t.tm_sec}'
+    if ShardCount > 1 and ShardIndex >= 0:
+        file_time += f'-shard{ShardIndex}'  # 同时启动的各 shard 进程写各自的日志文件
+    return file_time
+
+
+# log_to_file 则写 log 目录下本次任务的日志文件，console(命令行入口)则同时输出到屏幕
+def setup_logging(log_to_file, console):
+    global log_file_name, log_handlers
+    log_handlers = []
+    # File logging
+    if log_to_file:
+        os.makedirs('log', exist_ok=True)
+        log_file_name = './log/'+this_file_name+'-'+job_time()+'.log'
+        if console:
+            print('Logging to file:', os.path.abspath(log_file_name), 'Logging level:', LoggingLevel)
+        log_handlers.append(logging.FileHandler(filename=log_file_name))
+    # Screen stream logging
+    if console:
+        log_handlers.append(logging.StreamHandler())
+    for handler in log_handlers:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+    # Loggin Level
+    logger.setLevel(logging.WARNING)
+    if LoggingLevel == 'INFO':
+        logger.setLevel(logging.INFO)
+    elif LoggingLevel == 'DEBUG':
+        logger.setLevel(logging.DEBUG)
+
+
+def close_logging():
+    global log_file_name, log_handlers
+    for handler in log_handlers:
+        logger.removeHandler(handler)
+        handler.close()
+    log_file_name = None
+    log_handlers = []
+
+
+# 传输统计：各阶段(list/read/hash/download/upload_part/complete 等)的耗时直方图、字节数、重试次数、
+# 正在传输的文件的吞吐量、队列深度。MetricsFile 定期写出 JSON，MetricsPort 在本机提供 Prometheus 格式的 /metrics
+class TransferMetrics:
+    Buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # 直方图上限，秒
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.stages = {}  # {stage: {"Count", "Seconds", "Buckets": [...]}}
+        self.counters = collections.Counter()  # {(name, label, value): n}
+        self.gauges = {}  # {name: 取值函数}
+        self.files = {}  # 正在传输的分片文件 {Key: {"Size", "Bytes", "Start"}}
+        self.stop_event = threading.Event()
+        self.http_server = None
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            s = self.stages.get(stage)
+            if s is None:
+                s = self.stages[stage] = {"Count": 0, "Seconds": 0.0, "Buckets": [0] * (len(self.Buckets) + 1)}
+            s["Count"] += 1
+            s["Seconds"] += seconds
+            for i, le in enumerate(self.Buckets):
+                if seconds <= le:
+                    s["Buckets"][i] += 1
+                    break
+            else:
+                s["Buckets"][-1] += 1
+
+    # 统计一段代码的耗时，出错的也计入
+    @contextlib.contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name, label='', value='', n=1):
+        with self.lock:
+            self.counters[(name, label, value)] += n
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def file_start(self, key, size):
+        with self.lock:
+            self.files[str(key)] = {"Size": size, "Bytes": 0, "Start": time.time()}
+
+    def file_bytes(self, key, n):
+        with self.lock:
+            f = self.files.get(str(key))
+            if f is not None:
+                f["Bytes"] += n
+
+    def file_end(self, key):
+        with self.lock:
+            self.files.pop(str(key), None)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            elapsed = max(now - self.start_time, 0.001)
+            stages = {}
+            for stage, s in self.stages.items():
+                cumulative = 0
+                histogram = {}
+                for le, n in zip([str(b) for b in self.Buckets] + ['+Inf'], s["Buckets"]):
+                    cumulative += n
+                    histogram[le] = cumulative
+                stages[stage] = {
+                    "Count": s["Count"],
+                    "Seconds": round(s["Seconds"], 3),
+                    "AvgSeconds": round(s["Seconds"] / s["Count"], 4) if s["Count"] else 0,
+                    "Histogram": histogram
+                }
+            counters = {}
+            for (name, label, value), n in self.counters.items():
+                counters.setdefault(name, {})[value] = n
+            files = [{
+                "Key": key,
+                "Size": f["Size"],
+                "Bytes": f["Bytes"],
+                "BytesPerSecond": int(f["Bytes"] / max(now - f["Start"], 0.001))
+            } for key, f in self.files.items()]
+        gauges = {}
+        for name, func in list(self.gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception as err:
+                logger.debug(f'Metrics gauge {name} - {str(err)}')
+        return {
+            "Time": now,
+            "Elapsed": round(elapsed, 3),
+            "BytesPerSecond": {value: int(n / elapsed) for value, n in counters.get("bytes", {}).items()},
+            "ActiveFiles": files,
+            "Stages": stages,
+            "Counters": counters,
+            "Gauges": gauges
+        }
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        with self.lock:
+            counter_labels = {(name, value): label for (name, label, value) in self.counters}
+        lines = ['# TYPE s3_upload_stage_seconds histogram']
+        for stage, s in snapshot["Stages"].items():
+            for le, n in s["Histogram"].items():
+                lines.append(f's3_upload_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines.append(f's3_upload_stage_seconds_sum{{stage="{stage}"}} {s["Seconds"]}')
+            lines.append(f's3_upload_stage_seconds_count{{stage="{stage}"}} {s["Count"]}')
+        for name, values in snapshot["Counters"].items():
+            lines.append(f'# TYPE s3_upload_{name}_total counter')
+            for value, n in values.items():
+                label = counter_labels[(name, value)]
+                if label:
+                    lines.append(f's3_upload_{name}_total{{{label}="{value}"}} {n}')
+                else:
+                    lines.append(f's3_upload_{name}_total {n}')
+        lines.append('# TYPE s3_upload_file_bytes_per_second gauge')
+        for f in snapshot["ActiveFiles"]:
+            key = f["Key"].replace('\\', '\\\\').replace('"', '\\"')
+            lines.append(f's3_upload_file_bytes_per_second{{key="{key}"}} {f["BytesPerSecond"]}')
+        for name, value in snapshot["Gauges"].items():
+            lines.append(f'# TYPE s3_upload_{name} gauge')
+            lines.append(f's3_upload_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self):
+        tmp_file = MetricsFile + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp_file, MetricsFile)
+
+    def export_loop(self):
+        while not self.stop_event.wait(MetricsInterval):
+            try:
+                self.write_file()
+            except Exception as err:
+                logger.warning(f'Can not write metrics file {MetricsFile} - {str(err)}')
+
+    def start_export(self):
+        if MetricsFile:
+            threading.Thread(target=self.export_loop, daemon=True).start()
+        if MetricsPort:
+            self.http_server = http.server.ThreadingHTTPServer(('127.0.0.1', MetricsPort), MetricsHandler)
+            threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+            logger.info(f'Prometheus metrics on http://127.0.0.1:{MetricsPort}/metrics')
+
+    def stop_export(self):
+        self.stop_event.set()
+        if MetricsFile:
+            self.write_file()
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # 不把每次抓取写到日志
+
+
+metrics = TransferMetrics()
+
+
+# ProfileMode = 'cprofile'：Python 3.11 及以前 cProfile 只统计启用它的线程，所以每个线程一个 Profile，结束时合并输出热点；
+# 3.12 起 cProfile 基于 sys.monitoring，一个 Profile 就统计所有线程，同时启用第二个会 ValueError，所以只在主线程启用一个
+# ProfileMode = 'tracemalloc'：结束时输出分配内存最多的代码行和内存峰值
+class Profiler:
+    PerThread = sys.version_info < (3, 12)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = []  # 启用过的 Profile
+
+    # 启用本线程的 Profile，返回它
+    def enable(self):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+        profile.enable()
+        with self.lock:
+            if profile not in self.profiles:
+                self.profiles.append(profile)
+        return profile
+
+    # 在本线程的 Profile 下执行 func
+    def run(self, func, *args):
+        if ProfileMode != 'cprofile' or not self.PerThread:
+            return func(*args)
+        profile = self.enable()
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+
+    def start(self):
+        if ProfileMode == 'cprofile':
+            try:
+                self.enable()  # 主线程：目标列表等；3.12 起即所有线程
+            except ValueError as err:
+                logger.warning(f'Can not start cProfile, profile skipped - {str(err)}')
+        elif ProfileMode == 'tracemalloc':
+            tracemalloc.start()
+
+    def dump(self, path_prefix):
+        if ProfileMode == 'cprofile':
+            profile = getattr(self.local, 'profile', None)
+            if profile is not None:
+                profile.disable()
+            with self.lock:
+                if not self.profiles:
+                    return
+                stats = pstats.Stats(*self.profiles)
+            stats.dump_stats(path_prefix + '.prof')
+            with open(path_prefix + '-profile.txt', 'w') as f:
+                stats.stream = f
+                stats.sort_stats('cumulative').print_stats(60)
+                stats.sort_stats('tottime').print_stats(60)
+            logger.info(f'cProfile hot path dumped to {path_prefix}-profile.txt')
+        elif ProfileMode == 'tracemalloc':
+            current, peak = tracemalloc.get_traced_memory()
+            top_stats = tracemalloc.take_snapshot().statistics('lineno')
+            with open(path_prefix + '-tracemalloc.txt', 'w') as f:
+                f.write(f'Current: {current / Megabytes:.1f} MB, Peak: {peak / Megabytes:.1f} MB\n')
+                for stat in top_stats[:60]:
+                    f.write(f'{stat}\n')
+            tracemalloc.stop()
+            logger.info(f'tracemalloc top allocations dumped to {path_prefix}-tracemalloc.txt')
+
+
+profiler = Profiler()
+
+
+# 进度汇总：各线程只累加自己线程的计数器(不加锁，也不和其他线程争用)，输出线程定时汇总各线程的计数
+# 终端上每 ProgressInterval 秒刷新同一行状态；stdout 不是终端时每 ProgressLogInterval 秒输出一行不带颜色的进度
+class ProgressReporter:
+    Fields = ('ListedFiles', 'ListedBytes', 'DoneFiles', 'DoneBytes', 'SkippedFiles', 'Parts', 'TransferBytes')
+
+    def __init__(self):
+        self.lock = threading.Lock()  # 只在线程第一次计数时登记它的计数器
+        self.local = threading.local()
+        self.cells = []
+        self.listing = True
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.tty = sys.stdout.isatty()
+        self.last_time = time.time()
+        self.last_bytes = 0
+        self.rate = 0.0
+
+    def add(self, field, n=1):
+        cell = getattr(self.local, 'cell', None)
+        if cell is None:
+            cell = self.local.cell = dict.fromkeys(self.Fields, 0)
+            with self.lock:
+                self.cells.append(cell)
+        cell[field] += n
+
+    def listed(self, srcfile):
+        self.add('ListedFiles')
+        self.add('ListedBytes', srcfile["Size"])
+
+    def file_done(self, srcfile, skipped=False):
+        self.add('DoneFiles')
+        self.add('DoneBytes', srcfile["Size"])
+        if skipped:
+            self.add('SkippedFiles')
+
+    def part_done(self, size):
+        self.add('Parts')
+        self.add('TransferBytes', size)
+
+    def totals(self):
+        with self.lock:
+            cells = list(self.cells)
+        return {field: sum(cell[field] for cell in cells) for field in self.Fields}
+
+    def status_line(self):
+        t = self.totals()
+        now = time.time()
+        # 吞吐量取最近几次输出间隔的指数平均，ETA 不会因为单个分片的快慢跳动
+        interval = max(now - self.last_time, 0.001)
+        current_rate = (t['TransferBytes'] - self.last_bytes) / interval
+        self.rate = current_rate if self.rate == 0 else 0.7 * self.rate + 0.3 * current_rate
+        self.last_time, self.last_bytes = now, t['TransferBytes']
+        with metrics.lock:
+            active = [(key, f["Bytes"], f["Size"]) for key, f in metrics.files.items()]
+        done = min(t['DoneBytes'] + sum(n for key, n, size in active), t['ListedBytes'])
+        listed = t['ListedBytes']
+        more = '+' if self.listing else ''  # 还在列出源文件，总量还会增加
+        if self.rate > 0 and listed > done:
+            eta_m, eta_s = divmod(int((listed - done) / self.rate), 60)
+            eta_h, eta_m = divmod(eta_m, 60)
+            eta = f'{eta_h}:{eta_m:02d}:{eta_s:02d}'
+        else:
+            eta = '--:--:--'
+        line = (f'{done / max(listed, 1):7.2%} {size_str(done)}/{size_str(listed)}{more} '
+                f'{size_str(self.rate)}/s ETA {eta}{more} '
+                f'files {t["DoneFiles"]}/{t["ListedFiles"]}{more} skipped {t["SkippedFiles"]} parts {t["Parts"]}')
+        if active:
+            line += ' | ' + ' '.join(f'{os.path.basename(key)} {n / max(size, 1):.0%}'
+                                     for key, n, size in active[:3])
+            if len(active) > 3:
+                line += f' (+{len(active) - 3})'
+        return line
+
+    def render(self):
+        line = self.status_line()
+        if self.tty:
+            width = shutil.get_terminal_size().columns - 1
+            sys.stdout.write('\r\033[K' + line[:width])
+        else:
+            sys.stdout.write(time.strftime('%Y-%m-%d %H:%M:%S ') + line + '\n')
+        sys.stdout.flush()
+
+    def report_loop(self, interval):
+        while not self.stop_event.wait(interval):
+            self.render()
+
+    def start(self):
+        interval = ProgressInterval if self.tty else ProgressLogInterval
+        if interval > 0:
+            self.thread = threading.Thread(target=self.report_loop, args=(interval,), daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.render()  # 最终状态
+        if self.tty:
+            sys.stdout.write('\n')
+
+
+def size_str(n):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if n < 1024 or unit == 'TB':
+            return f'{n:.1f}{unit}' if unit != 'B' else f'{int(n)}B'
+        n /= 1024
+
+
+progress = ProgressReporter()
+
+
+# 列出一个目录，子目录交给 on_dir，文件逐个输出 (文件路径, stat)
+# 单个文件 stat 失败(如列出后被删除，正在写入的目录里常见)只跳过这个文件，目录里其他文件照常输出
+def scan_local_dir(path, on_dir):
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    on_dir(entry.path)
+                elif entry.is_file():
+                    yield entry.path, entry.stat()
+            except OSError as err:
+                logger.warning(f'Can not stat file, skip: {entry.path} - {str(err)}')
+
+
+# 在列表线程里顺序遍历本地目录树，边发现边输出 (文件路径, stat)，不进入目录的软链接，读不了的目录跳过
+# 本地盘有 page cache 时遍历受 syscall 和 GIL 限制，多线程反而更慢(benchmark/bench_local_walk.py)，所以这是默认方式
+def iter_local_tree_serial(root):
+    dirs = [root]
+    while dirs:
+        path = dirs.pop()
+        try:
+            yield from scan_local_dir(path, dirs.append)
+        except OSError as err:
+            logger.warning(f'Can not scan directory, skip: {path} - {str(err)}')
+
+
+# MaxWalkThread > 1 时并发遍历本地目录树，边发现边输出 (文件路径, stat)，适合每次 stat 都是网络往返的 NFS/EFS
+# 每个目录是线程池里的一个任务，子目录继续提交到线程池。os.scandir 的 DirEntry 缓存了文件类型，
+# Windows 上连 stat 都已缓存，不用再为每个文件单独调用 getsize。和 os.walk 一样不进入目录的软链接，读不了的目录跳过
+def iter_local_tree(root):
+    out_queue = queue.Queue(maxsize=MaxListQueue)
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending = [1]  # 还没遍历完的目录数
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def submit_dir(path):
+        if stop.is_set():
+            return
+        with lock:
+            pending[0] += 1
+        walk_pool.submit(scan, path)
+
+    def scan(path):
+        try:
+            batch = []
+            with metrics.stage('list'):
+                for item in scan_local_dir(path, submit_dir):
+                    if stop.is_set():
+                        return
+                    batch.append(item)
+                    if len(batch) >= 1000:
+                        put(batch)
+                        batch = []
+            if batch:
+                put(batch)
+        except OSError as err:
+            logger.warning(f'Can not scan directory, skip: {path} - {str(err)}')
+        finally:
+            with lock:
+                pending[0] -= 1
+                done = pending[0] == 0
+            if done:
+                put(None)
+
+    walk_pool = futures.ThreadPoolExecutor(max_workers=MaxWalkThread)
+    try:
+        walk_pool.submit(scan, root)
+        while True:
+            batch = out_queue.get()
+            if batch is None:
+                break
+            yield from batch
+    finally:
+        stop.set()
+        walk_pool.shutdown(wait=True)
+
+
+# 源文件列表生成器，边遍历边输出，不在内存中保存整个列表
+def iter_local_file_list():
     try:
         if SrcFileIndex == "*":
-            for parent, dirnames, filenames in os.walk(SrcDir):
-                for filename in filenames:  # 遍历输出文件信息
-                    file_absPath = os.path.join(parent, filename)
-                    file_relativePath = file_absPath[len(SrcDir)+1:]
-                    file_size = os.path.getsize(file_absPath)
-                    if file_size >= ChunkSize or not IgnoreSmallFile:
-                        if file_size != 0:
-                            __src_file_list.append({
-                                "Key": Path(file_relativePath),
-                                "Size": file_size
-                            })
-                        else:
-                            logger.warning(f'Zero size file, skip: {Path(file_relativePath)}')
+            walk = iter_local_tree if MaxWalkThread > 1 else iter_local_tree_serial
+            for file_absPath, file_stat in walk(SrcDir):  # 遍历输出文件信息
+                file_relativePath = file_absPath[len(SrcDir)+1:]
+                file_size = file_stat.st_size
+                if file_size >= ChunkSize or not IgnoreSmallFile:
+                    if file_size != 0:
+                        yield {
+                            "Key": Path(file_relativePath),
+                            "Size": file_size,
+                            "MTime": file_stat.st_mtime_ns,
+                            "Inode": file_stat.st_ino
+                        }
+                    else:
+                        logger.warning(f'Zero size file, skip: {Path(file_relativePath)}')
         else:
-            file_size = os.path.getsize(os.path.join(SrcDir, SrcFileIndex))
-            __src_file_list = [{
+            file_stat = os.stat(os.path.join(SrcDir, SrcFileIndex))
+            yield {
                 "Key": SrcFileIndex,
-                "Size": file_size
-            }]
+                "Size": file_stat.st_size,
+                "MTime": file_stat.st_mtime_ns,
+                "Inode": file_stat.st_ino
+            }
     except Exception as err:
         logger.error('Can not get source files. ERR: '+str(err))
         sys.exit(0)
+
+
+def get_local_file_list():
+    __src_file_list = list(iter_local_file_list())
     if not __src_file_list:
         logger.error('Source file empty.')
         sys.exit(0)
     return __src_file_list
 
 
-def get_s3_file_list(s3_client, bucket):
+# 按配置过滤 S3 列表中的文件，不需要处理的返回 None
+def s3_file_entry(bucket, n):
+    if n["Size"] >= ChunkSize or not IgnoreSmallFile:
+        if n["Size"] != 0:      # 子目录或 0 size 文件，不处理
+            return {
+                "Key": n["Key"],
+                "Size": n["Size"],
+                "ETag": n["ETag"]
+            }
+        logger.warning(f'Zero size file, skip: {bucket}/{n["Key"]}')
+    return None
+
+
+# list_objects_v2 分页
+def iter_s3_list_pages(s3_client, bucket, prefix, delimiter=''):
+    list_kwargs = {
+        "Bucket": bucket,
+        "Prefix": prefix,
+        "MaxKeys": 1000
+    }
+    if delimiter:
+        list_kwargs["Delimiter"] = delimiter
+    while True:
+        with metrics.stage('list'):
+            response_fileList = s3_client.list_objects_v2(**list_kwargs)
+        yield response_fileList
+        if not response_fileList["IsTruncated"]:
+            break
+        list_kwargs["ContinuationToken"] = response_fileList["NextContinuationToken"]
+
+
+# 逐页列出一个 Prefix 下的全部文件，每页返回一个文件列表
+def iter_s3_prefix_pages(s3_client, bucket, prefix):
+    for response_fileList in iter_s3_list_pages(s3_client, bucket, prefix):
+        __file_list = []
+        for n in response_fileList.get("Contents", []):
+            entry = s3_file_entry(bucket, n)
+            if entry is not None:
+                __file_list.append(entry)
+        yield __file_list
+
+
+# 列出一个 Prefix 下的全部文件
+def iter_s3_prefix(s3_client, bucket, prefix):
+    for __file_list in iter_s3_prefix_pages(s3_client, bucket, prefix):
+        yield from __file_list
+
+
+# 以 "/" 为 Delimiter 逐页列出一层，每页返回 (文件, 子目录 Prefix, 后面是否还有页)
+def iter_s3_level(s3_client, bucket, prefix):
+    for response_fileList in iter_s3_list_pages(s3_client, bucket, prefix, delimiter='/'):
+        __file_list = []
+        for n in response_fileList.get("Contents", []):
+            entry = s3_file_entry(bucket, n)
+            if entry is not None:
+                __file_list.append(entry)
+        __prefix_list = [p["Prefix"] for p in response_fileList.get("CommonPrefixes", [])]
+        yield __file_list, __prefix_list, response_fileList["IsTruncated"]
+
+
+def iter_s3_file_list(s3_client, bucket):
     logger.info('Get s3 file list '+bucket)
-    __des_file_list = []
+    __file_count = 0
     try:
-        response_fileList = s3_client.list_objects_v2(
-            Bucket=bucket,
-            Prefix=S3Prefix,
-            MaxKeys=1000
-        )
-        if response_fileList["KeyCount"] != 0:
-            for n in response_fileList["Contents"]:
-                if n["Size"] >= ChunkSize or not IgnoreSmallFile:
-                    if n["Size"] != 0:      # 子目录或 0 size 文件，不处理
-                        __des_file_list.append({
-                            "Key": n["Key"],
-                            "Size": n["Size"]
-                        })
-                    else:
-                        logger.warning(f'Zero size file, skip: {bucket}/{n["Key"]}')
-            while response_fileList["IsTruncated"]:
-                response_fileList = s3_client.list_objects_v2(
-                    Bucket=bucket,
-                    Prefix=S3Prefix,
-                    MaxKeys=1000,
-                    ContinuationToken=response_fileList["NextContinuationToken"]
-                )
-                for n in response_fileList["Contents"]:
-                    if n["Size"] >= ChunkSize or not IgnoreSmallFile:
-                        if n["Size"] != 0:      # 子目录或 0 size 文件，不处理
-                            __des_file_list.append({
-                                "Key": n["Key"],
-                                "Size": n["Size"]
-                            })
-                        else:
-                            logger.warning(f'Zero size file, skip: {bucket}/{n["Key"]}')
+        if MaxListThread > 1:
+            file_iter = iter_partitioned_file_list(
+                lambda prefix: iter_s3_level(s3_client, bucket, prefix),
+                lambda prefix: iter_s3_prefix_pages(s3_client, bucket, prefix)
+            )
         else:
+            file_iter = iter_s3_prefix(s3_client, bucket, S3Prefix)
+        for entry in file_iter:
+            __file_count += 1
+            yield entry
+        if __file_count == 0:
             logger.info('File list is empty in the s3 bucket')
     except Exception as err:
         logger.error(str(err))
         sys.exit(0)
-    return __des_file_list
+
+
+def get_s3_file_list(s3_client, bucket):
+    return list(iter_s3_file_list(s3_client, bucket))
+
+
+# 分区发现：从 S3Prefix 开始用 Delimiter 逐页列出一层，边列边按 Key 顺序输出 (Key, 文件) 或 (Prefix, None) 待列出的子目录分区
+# 只有一页且子目录少于 MaxListThread 的小层展开到下一层(最多到第3层)，得到足够的分区并发；
+# 多页的大层不展开，每页的文件立即输出，平铺的大量文件不用等整层列完，也不占用整层的内存
+# 每个子目录分区在 Key 空间里都是连续的一段，所以按输出顺序拼接即是全局 Key 顺序
+def iter_list_partitions(iter_level, prefix, depth=1):
+    level_pages = iter_level(prefix)
+    first_page = next(level_pages)
+    __file_list, __prefix_list, truncated = first_page
+    expand = not truncated and len(__prefix_list) < MaxListThread and depth < 3
+    for __file_list, __prefix_list, truncated in itertools.chain([first_page], level_pages):
+        labels = sorted([(f["Key"], f) for f in __file_list] + [(p, None) for p in __prefix_list],
+                        key=lambda x: x[0])
+        for label, f in labels:
+            if f is None and expand:
+                yield from iter_list_partitions(iter_level, label, depth + 1)
+            else:
+                yield label, f
+
+
+# 一个子目录分区：列表线程逐页放入有界队列，输出方按页取出。队列满则列表线程等待，每个分区最多预取 Pages 页，
+# 平铺了几百万个文件的分区也不用列完就开始输出，内存不随分区大小增长。stop 置位(输出方提前结束)则列表线程退出
+class ListPartition:
+    Pages = 2
+
+    def __init__(self, list_pool, list_pages, prefix, stop):
+        self.pages = queue.Queue(maxsize=self.Pages)
+        self.stop = stop
+        self.future = list_pool.submit(self.run, list_pages, prefix)
+
+    def run(self, list_pages, prefix):
+        try:
+            for __file_list in list_pages(prefix):
+                if not self.put(__file_list):
+                    return
+        finally:
+            self.put(None)  # 结束标记，出错也放入，由输出方的 future.result() 抛出
+
+    def put(self, __file_list):
+        while not self.stop.is_set():
+            try:
+                self.pages.put(__file_list, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # 输出已列出的文件，block 则等到分区列完；返回分区是否已列完
+    def drain(self, block):
+        while True:
+            try:
+                __file_list = self.pages.get(block=block)
+            except queue.Empty:
+                return False
+            if __file_list is None:
+                self.future.result()
+                return True
+            yield from __file_list
+
+
+# 按子目录分区并发列出，按分区顺序合并输出。最多预取 MaxListThread*2 个分区或文件，每个分区最多预取 ListPartition.Pages 页，
+# 内存不随 Bucket 或单个分区的大小增长
+def iter_partitioned_file_list(iter_level, list_pages):
+    stop = threading.Event()
+    with futures.ThreadPoolExecutor(max_workers=MaxListThread) as list_pool:
+        try:
+            window = collections.deque()
+            __partition_count = 0
+            for label, f in iter_list_partitions(iter_level, S3Prefix):
+                if f is None:
+                    window.append(ListPartition(list_pool, list_pages, label, stop))
+                    __partition_count += 1
+                else:
+                    window.append([f])
+                # 已列出的文件和分区已列出的页直接输出，预取满了才等待最前面的分区列完
+                while window:
+                    if isinstance(window[0], list):
+                        yield from window.popleft()
+                    elif (yield from window[0].drain(block=len(window) > MaxListThread * 2)):
+                        window.popleft()
+                    else:
+                        break
+            while window:
+                partition = window.popleft()
+                yield from (partition if isinstance(partition, list) else partition.drain(block=True))
+            logger.info(f'Listed {__partition_count} partitions with {MaxListThread} threads')
+        finally:
+            stop.set()
 
 
 def head_s3_single_file(s3_client, bucket):
@@ -150,58 +803,97 @@ def head_oss_single_file(__ali_bucket):
     return file
 
 
-def get_ali_oss_file_list(__ali_bucket):
+# 按配置过滤 OSS 列表中的文件，不需要处理的返回 None
+def oss_file_entry(n):
+    if n.size != 0:      # 子目录或 0 size 数据，不处理
+        return {
+            "Key": n.key,
+            "Size": n.size
+        }
+    logger.warning(f'Zero size file, skip: {ali_SrcBucket}/{n.key}')
+    return None
+
+
+# OSS list_objects 分页
+def iter_oss_list_pages(__ali_bucket, prefix, delimiter=''):
+    marker = ''
+    while True:
+        with metrics.stage('list'):
+            response_fileList = __ali_bucket.list_objects(
+                prefix=prefix,
+                delimiter=delimiter,
+                max_keys=1000,
+                marker=marker
+            )
+        yield response_fileList
+        if not response_fileList.is_truncated:
+            break
+        marker = response_fileList.next_marker
+
+
+def iter_oss_prefix_pages(__ali_bucket, prefix):
+    for response_fileList in iter_oss_list_pages(__ali_bucket, prefix):
+        __file_list = []
+        for n in response_fileList.object_list:
+            entry = oss_file_entry(n)
+            if entry is not None:
+                __file_list.append(entry)
+        yield __file_list
+
+
+def iter_oss_prefix(__ali_bucket, prefix):
+    for __file_list in iter_oss_prefix_pages(__ali_bucket, prefix):
+        yield from __file_list
+
+
+def iter_oss_level(__ali_bucket, prefix):
+    for response_fileList in iter_oss_list_pages(__ali_bucket, prefix, delimiter='/'):
+        __file_list = []
+        for n in response_fileList.object_list:
+            entry = oss_file_entry(n)
+            if entry is not None:
+                __file_list.append(entry)
+        yield __file_list, list(response_fileList.prefix_list), response_fileList.is_truncated
+
+
+def iter_ali_oss_file_list(__ali_bucket):
     logger.info('Get oss file list '+ali_SrcBucket)
-    __des_file_list = []
+    __file_count = 0
     try:
-        response_fileList = __ali_bucket.list_objects(
-            prefix=S3Prefix,
-            max_keys=1000
-        )
-
-        if len(response_fileList.object_list) != 0:
-            for n in response_fileList.object_list:
-                if n.size != 0:      # 子目录或 0 size 数据，不处理
-                    __des_file_list.append({
-                        "Key": n.key,
-                        "Size": n.size
-                    })
-                else:
-                    logger.warning(f'Zero size file, skip: {ali_SrcBucket}/{n["Key"]}')
-            while response_fileList.is_truncated:
-                response_fileList = __ali_bucket.list_objects(
-                    prefix=S3Prefix,
-                    max_keys=1000,
-                    marker=response_fileList.next_marker
-                )
-                for n in response_fileList.object_list:
-                    if n.size != 0:  # 子目录或 0 size 数据，不处理
-                        __des_file_list.append({
-                            "Key": n.key,
-                            "Size": n.size
-                        })
-                    else:
-                        logger.warning(f'Zero size file, skip: {ali_SrcBucket}/{n["Key"]}')
+        if MaxListThread > 1:
+            file_iter = iter_partitioned_file_list(
+                lambda prefix: iter_oss_level(__ali_bucket, prefix),
+                lambda prefix: iter_oss_prefix_pages(__ali_bucket, prefix)
+            )
         else:
+            file_iter = iter_oss_prefix(__ali_bucket, S3Prefix)
+        for entry in file_iter:
+            __file_count += 1
+            yield entry
+        if __file_count == 0:
             logger.info('File list is empty in the ali_oss bucket')
     except Exception as err:
         logger.error(str(err))
         sys.exit(0)
-    return __des_file_list
 
 
-def get_uploaded_list(s3_client):
-    logger.info('Get unfinished multipart upload')
+def get_ali_oss_file_list(__ali_bucket):
+    return list(iter_ali_oss_file_list(__ali_bucket))
+
+
+def get_uploaded_list(dest):
+    logger.info(f'Get unfinished multipart upload - {dest.bucket}')
     NextKeyMarker = ''
     IsTruncated = True
     __multipart_uploaded_list = []
     while IsTruncated:
-        list_multipart_uploads = s3_client.list_multipart_uploads(
-            Bucket=DesBucket,
-            Prefix=S3Prefix,
-            MaxUploads=1000,
-            KeyMarker=NextKeyMarker
-        )
+        with metrics.stage('list'):
+            list_multipart_uploads = dest.client.list_multipart_uploads(
+                Bucket=dest.bucket,
+                Prefix=S3Prefix,
+                MaxUploads=1000,
+                KeyMarker=NextKeyMarker
+            )
         IsTruncated = list_multipart_uploads["IsTruncated"]
         NextKeyMarker = list_multipart_uploads["NextKeyMarker"]
         if NextKeyMarker != '':
@@ -215,406 +907,2209 @@ def get_uploaded_list(s3_client):
     return __multipart_uploaded_list
 
 
+# 目标文件列表按 Key 建索引 {Key: {"Size", "ETag"}}，每个文件的查找由遍历列表变为 O(1)
+def build_des_file_index(desFilelist):
+    __des_file_index = {}
+    for f in desFilelist:
+        __des_file_index[f["Key"]] = {
+            "Size": f["Size"],
+            "ETag": f.get("ETag")
+        }
+    return __des_file_index
+
+
+# 未完成的 Multipart Upload 按 Key 分组，预先算出每个 Key 时间最晚的那个 Upload {Key: Upload}
+def build_upload_id_index(UploadIdList):
+    __upload_id_index = {}
+    for u in UploadIdList:
+        latest = __upload_id_index.get(u["Key"])
+        if latest is None or u["Initiated"] > latest["Initiated"]:
+            __upload_id_index[u["Key"]] = u
+    return __upload_id_index
+
+
+# 传输目标：DesBucket 和 ExtraDestinations 里的每个 Bucket，各自的 client、StorageClass，
+# 目标现存文件索引 {Key: {"Size", "ETag"}} 和未完成的 Upload 索引 {Key: Upload}，续传和校验都按目标分别进行
+class Destination:
+    def __init__(self, bucket, profile, storage_class):
+        self.bucket = bucket
+        self.profile = profile
+        self.storage_class = storage_class
+        self.client = None
+        self.des_file_index = {}
+        self.upload_id_index = {}
+        self.listed_upto = None  # 目标文件索引还在后台列出时是已列出的最大 Key，None 则索引已完整
+
+
+# 后台列出目标 Bucket 的现存文件建索引，文件线程不用等整个目标列完就开始传输，首个文件的开始时间与目标大小无关
+# S3 按 Key 顺序列出：不大于 listed_upto 的 Key 以索引为准，更大的由 check_file_exit 单独 head_object
+# 列出出错则 listed_upto 停在出错的位置，之后的 Key 一直按 head_object 检查；stop 置位(文件都已处理完)则不再列出
+def load_des_file_index(dest, stop):
+    try:
+        for f in iter_s3_file_list(dest.client, dest.bucket):
+            if stop.is_set():
+                return
+            dest.des_file_index[f["Key"]] = {
+                "Size": f["Size"],
+                "ETag": f.get("ETag")
+            }
+            dest.listed_upto = f["Key"]  # 先写索引再前移，检查方先取 listed_upto 再查索引
+        dest.listed_upto = None
+        logger.info(f'Destination file index loaded - {dest.bucket} - {len(dest.des_file_index)} files')
+    except (Exception, SystemExit):  # 列表函数 sys.exit 前已记录了错误
+        logger.warning(f'List destination did not finish, check other files by head_object - {dest.bucket}')
+
+
+# 目标文件索引还没列到这个 Key 时，单独 head_object 查目标文件，找不到返回 None
+def head_des_file(dest, prefix_and_key):
+    try:
+        with metrics.stage('head'):
+            response_head = dest.client.head_object(Bucket=dest.bucket, Key=prefix_and_key)
+    except Exception as err:
+        logger.debug(f'Head destination - {dest.bucket}/{prefix_and_key} - {str(err)}')
+        return None
+    return {
+        "Size": response_head["ContentLength"],
+        "ETag": response_head["ETag"]
+    }
+
+
+destinations = []  # 第一个是 DesBucket，在 run_transfer 中创建
+fanout_pool = None  # 多个目标时，分片上传到其他目标的线程池
+
+
 class NextFile(Exception):
     pass
 
 
-def upload_file(srcfile, desFilelist, UploadIdList):
-    logger.info(f'Start file: {srcfile["Key"]}')
+# 本地续传记录(SQLite, WAL)：按 Bucket/Key/UploadId 记录每个已上传分片的 PartNumber、MD5、ETag、Size
+# 每个分片上传成功后立即提交，程序中断重启时直接从本地读取，不用 list_parts，也不用为了 MD5 重新下载
+class ResumeJournal:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)  # 本机多个 shard 进程共用一个文件
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS parts ('
+                          'bucket TEXT, key TEXT, upload_id TEXT, part_number INTEGER, '
+                          'md5 TEXT, etag TEXT, size INTEGER, '
+                          'PRIMARY KEY (bucket, key, upload_id, part_number))')
+        self.conn.commit()
+
+    def record_part(self, bucket, key, uploadId, partnumber, md5, etag, size):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO parts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (bucket, key, uploadId, partnumber, md5, etag, size))
+            self.conn.commit()
+
+    def get_parts(self, bucket, key, uploadId):
+        with self.lock:
+            rows = self.conn.execute('SELECT part_number, md5, etag, size FROM parts '
+                                     'WHERE bucket = ? AND key = ? AND upload_id = ?',
+                                     (bucket, key, uploadId)).fetchall()
+        return {row[0]: {"MD5": row[1], "ETag": row[2], "Size": row[3]} for row in rows}
+
+    def forget_upload(self, bucket, key, uploadId):
+        with self.lock:
+            self.conn.execute('DELETE FROM parts WHERE bucket = ? AND key = ? AND upload_id = ?',
+                              (bucket, key, uploadId))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+resume_journal = None  # ResumeJournalFile 不为空时在 main 中打开
+
+
+# 进行中的 Upload 已上传分片的内存记录：按 Bucket/UploadId 记录每个分片的 ETag、Size、MD5 和校验和，
+# 来自 upload_part 的返回，续传时来自续传记录或 list_parts。合并时直接用它构建分片列表，不再 list_parts
+class PartLedger:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.uploads = {}
+
+    def add(self, bucket, uploadId, partnumber, part):
+        with self.lock:
+            self.uploads.setdefault((bucket, uploadId), {})[partnumber] = part
+
+    def parts(self, bucket, uploadId):
+        with self.lock:
+            return dict(self.uploads.get((bucket, uploadId), {}))
+
+    def forget(self, bucket, uploadId):
+        with self.lock:
+            self.uploads.pop((bucket, uploadId), None)
+
+
+part_ledger = PartLedger()
+
+
+def record_uploaded_part(dest, prefix_and_key, uploadId, partnumber, md5, etag, size, checksum=None):
+    part = {"ETag": etag, "Size": size, "MD5": md5}
+    if checksum is not None:
+        part[f'Checksum{ChecksumAlgorithm}'] = checksum
+    part_ledger.add(dest.bucket, uploadId, partnumber, part)
+    if resume_journal is not None:
+        resume_journal.record_part(dest.bucket, prefix_and_key, uploadId, partnumber, md5, etag, size)
+
+
+# Upload 已完成合并或已清除，续传记录不再需要
+def forget_upload(dest, prefix_and_key, uploadId):
+    part_ledger.forget(dest.bucket, uploadId)
+    if resume_journal is not None:
+        resume_journal.forget_upload(dest.bucket, prefix_and_key, uploadId)
+
+
+# LOCAL_TO_S3 本地同步清单(SQLite)：记录每个已同步文件的 Size、MTime、Inode、本地计算的 ETag 和同步时间
+# 再次运行时 stat 变了的文件即使大小相同也重传；TrustSyncManifest = True 时 stat 没变的直接跳过，不列出目标 Bucket
+class SyncManifest:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)  # 本机多个 shard 进程共用一个文件
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                          'bucket TEXT, key TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, '
+                          'etag TEXT, synced_time REAL, '
+                          'PRIMARY KEY (bucket, key))')
+        self.conn.commit()
+
+    # 返回上次同步时的 (Size, MTime, Inode)，没有记录返回 None
+    def get_stat(self, bucket, key):
+        with self.lock:
+            return self.conn.execute('SELECT size, mtime_ns, inode FROM files WHERE bucket = ? AND key = ?',
+                                     (bucket, key)).fetchone()
+
+    def record(self, bucket, key, srcfile, etag):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (bucket, key, srcfile["Size"], srcfile.get("MTime"), srcfile.get("Inode"),
+                               etag, time.time()))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+sync_manifest = None  # LOCAL_TO_S3 且 SyncManifestFile 不为空时在 main 中打开
+
+
+def record_synced_file(dest, srcfile, prefix_and_key, etag):
+    if sync_manifest is not None:
+        sync_manifest.record(dest.bucket, prefix_and_key, srcfile, etag)
+
+
+# 本次运行还没确认的文件 {目标Bucket: {目标Key: (源Key, Size)}}：列出时每个目标各记一条，上传完成或目标已有而跳过
+# 且大小一致的即删除，内存里只留下还在传输或失败的文件，不随源文件总数增长。
+# 传输结束后只对剩下的文件 head 目标，不再重新列出源和目标
+class TransferLedger:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.unconfirmed_files = {}
+        self.listed_count = 0
+        self.listing_complete = False  # 源文件正常列完才为 True，否则没列出的文件不在记录里，不能据此校验
+
+    def listed(self, prefix_and_key, srcfile):
+        entry = (srcfile["Key"], srcfile["Size"])
+        with self.lock:
+            for dest in destinations:
+                self.unconfirmed_files.setdefault(dest.bucket, {})[prefix_and_key] = entry
+            self.listed_count += 1
+
+    def completed(self, bucket, prefix_and_key, size, etag):
+        with self.lock:
+            files = self.unconfirmed_files.get(bucket, {})
+            if prefix_and_key in files and files[prefix_and_key][1] == size:
+                del files[prefix_and_key]
+
+    # 已确认的文件在目标上被删除重传，重新记为未确认
+    def forget(self, bucket, prefix_and_key, srcfile):
+        with self.lock:
+            self.unconfirmed_files.setdefault(bucket, {})[prefix_and_key] = (srcfile["Key"], srcfile["Size"])
+
+    def unconfirmed(self, bucket):
+        with self.lock:
+            return [(prefix_and_key, {"Key": key, "Size": size})
+                    for prefix_and_key, (key, size) in self.unconfirmed_files.get(bucket, {}).items()]
+
+
+transfer_ledger = TransferLedger()
+
+
+# 分片模式下按目标 Key 的 MD5 取模决定由哪个 shard 传输，与进程、主机和 Python 的 hash 随机化无关
+def in_shard(prefix_and_key):
+    if ShardCount <= 1:
+        return True
+    return int(hashlib.md5(prefix_and_key.encode('utf-8')).hexdigest(), 16) % ShardCount == ShardIndex
+
+
+def src_in_shard(srcfile):
     prefix_and_key = srcfile["Key"]
     if JobType == 'LOCAL_TO_S3':
         prefix_and_key = str(PurePosixPath(S3Prefix) / srcfile["Key"])
+    return in_shard(prefix_and_key)
+
+
+list_error = None  # 源文件列出失败的异常，列表线程设置
+
+
+# 源文件列表生产者：边列边放入有界队列，队列满则阻塞等待，内存占用与源文件总数无关
+# 小于 SmallFileThreshold 的文件放入小文件队列，由单独的高并发小文件线程池处理
+# 列出出错(列表函数 sys.exit)记入 list_error，由主线程中止任务，不把不完整的列表当作全部源文件
+def produce_file_queue(src_file_iter, file_queue, small_file_queue, stop_listing):
+    global list_error
+    __src_file_count = 0
     try:
-        # 循环重试3次（如果MD5计算的ETag不一致）
-        for md5_retry in range(3):
-            # 检查文件是否已存在，存在不继续、不存在且没UploadID要新建、不存在但有UploadID得到返回的UploadID
-            response_check_upload = check_file_exit(srcfile, desFilelist, UploadIdList)
-            if response_check_upload == 'UPLOAD':
-                logger.info(f'New upload: {srcfile["Key"]}')
-                response_new_upload = s3_dest_client.create_multipart_upload(
+        for srcfile in src_file_iter:
+            if stop_listing.is_set():
+                break  # 消费者都已结束，不再列出，listing_complete 保持 False
+            if not src_in_shard(srcfile):
+                continue  # 分片模式下每个 shard 都列出全部源文件，只传输属于自己的
+            if JobType == 'LOCAL_TO_S3':
+                transfer_ledger.listed(str(PurePosixPath(S3Prefix) / srcfile["Key"]), srcfile)
+            else:
+                transfer_ledger.listed(srcfile["Key"], srcfile)
+            progress.listed(srcfile)
+            if srcfile["Size"] < SmallFileThreshold:
+                small_file_queue.put(srcfile)
+            else:
+                file_queue.put(srcfile)
+            __src_file_count += 1
+        else:
+            transfer_ledger.listing_complete = True
+            logger.info(f'Source file list finished, total files: {__src_file_count}')
+    except (Exception, SystemExit) as err:
+        list_error = err
+        if not isinstance(err, SystemExit):  # 列表函数 sys.exit 前已记录了错误
+            logger.error(f'Source file list fail - {str(err)}')
+    finally:
+        progress.listing = False
+        if __src_file_count == 0:
+            logger.error('Source file empty.')
+        # 列表结束（或出错退出），给每个消费者一个结束标记
+        for i in range(MaxParallelFile):
+            file_queue.put(None)
+        for i in range(small_file_threads()):
+            small_file_queue.put(None)
+
+
+# 文件消费者：从队列中取文件交给 upload_func 上传，取到结束标记则退出
+def consume_file_queue(file_queue, upload_func):
+    while True:
+        srcfile = file_queue.get()
+        if srcfile is None:
+            break
+        try:
+            upload_func(srcfile)
+        except (Exception, SystemExit) as err:
+            # 重试用尽会 sys.exit，只放弃这个文件，消费者线程继续处理下一个文件
+            reason = 'quit for max retries' if isinstance(err, SystemExit) else str(err)
+            logger.error(f'Upload file fail: {srcfile["Key"]} - {reason}')
+
+
+# 读取或下载整个小文件到缓冲区 buf，返回数据的 memoryview
+def read_small_file(srcfile, buf):
+    if JobType == 'LOCAL_TO_S3':
+        view = memoryview(buf)
+        n = 0
+        with metrics.stage('read'), open(os.path.join(SrcDir, srcfile["Key"]), 'rb') as data:
+            while n < len(view):
+                size = data.readinto(view[n:])
+                if not size:
+                    break
+                n += size
+        return view[:n]
+    with metrics.stage('download'):
+        if JobType == 'S3_TO_S3':
+            response_get_object = s3_src_client.get_object(
+                Bucket=SrcBucket,
+                Key=srcfile["Key"]
+            )
+            getBody = read_part_body(
+                response_get_object["Body"].iter_chunks(chunk_size=Megabytes), buf, srcfile["Size"])[0]
+        elif JobType == 'ALIOSS_TO_S3':
+            getBody = read_part_body(ali_bucket.get_object(key=srcfile["Key"]), buf, srcfile["Size"])[0]
+    metrics.count('bytes', 'direction', 'download', len(getBody))
+    return getBody
+
+
+# 小文件单请求上传：读取整个文件，一次 put_object 带 Content-MD5 校验，不走 Multipart 的4次往返
+def upload_small_file(srcfile):
+    prefix_and_key = srcfile["Key"]
+    if JobType == 'LOCAL_TO_S3':
+        prefix_and_key = str(PurePosixPath(S3Prefix) / srcfile["Key"])
+    # 只上传到还没有这个文件的目标
+    pending = []
+    for dest in destinations:
+        response_check_upload = check_file_exit(srcfile, dest)
+        if response_check_upload == 'NEXT':
+            continue
+        if response_check_upload != 'UPLOAD':
+            # 以前按 Multipart 传了一半的，小文件直接重传，清理掉未完成的Upload
+            dest.client.abort_multipart_upload(
+                Bucket=dest.bucket,
+                Key=prefix_and_key,
+                UploadId=response_check_upload
+            )
+            forget_upload(dest, prefix_and_key, response_check_upload)
+        pending.append(dest)
+    if not pending:
+        logger.info(f'Duplicated. {srcfile["Key"]} same size, goto next file.')
+        metrics.count('files', 'result', 'skipped')
+        progress.file_done(srcfile, skipped=True)
+        return
+    upload_count = len(pending)
+    retryTime = 0
+    while retryTime <= MaxRetry:
+        try:
+            if JobType == 'S3_TO_S3' and ServerSideCopy:
+                # 服务端拷贝整个小文件，不经过本机
+                for dest in list(pending):
+                    with metrics.stage('copy_object'):
+                        response_copy_object = dest.client.copy_object(
+                            Bucket=dest.bucket,
+                            Key=prefix_and_key,
+                            CopySource={"Bucket": SrcBucket, "Key": srcfile["Key"]},
+                            StorageClass=dest.storage_class
+                        )
+                    transfer_ledger.completed(dest.bucket, prefix_and_key, srcfile["Size"],
+                                              response_copy_object["CopyObjectResult"]["ETag"])
+                    pending.remove(dest)
+                break
+            # 读取或下载到 buffer_pool 的缓冲区，小文件也计入 MaxMemoryBuffer 内存预算
+            with buffer_pool.buffer(srcfile["Size"]) as buf:
+                getBody = read_small_file(srcfile, buf)
+                extra_args = {}
+                if Compression:
+                    # 小文件直接压缩整个文件，压缩率不够的原样上传
+                    compressed = compress_data(getBody)
+                    metrics.count('compress', 'result', 'skipped' if compressed is None else 'compressed')
+                    if compressed is not None:
+                        getBody = compressed
+                        extra_args = compress_args(srcfile)
+                with metrics.stage('hash'):
+                    chunkdata_md5 = hashlib.md5(getBody)
+                    checksum = part_checksum(getBody) if JobType == 'LOCAL_TO_S3' else {}
+                # 读取或下载一次，上传到每个还没有完成的目标，重试时已完成的目标不再上传
+                for dest in list(pending):
+                    with metrics.stage('put_object'):
+                        response_put_object = dest.client.put_object(
+                            Body=PartReader(memoryview(getBody)),
+                            Bucket=dest.bucket,
+                            Key=prefix_and_key,
+                            StorageClass=dest.storage_class,
+                            ContentMD5=base64.b64encode(chunkdata_md5.digest()).decode('utf-8'),
+                            **checksum,
+                            **extra_args
+                        )
+                    # 单请求上传的 ETag 就是整个文件的 MD5
+                    if ifVerifyMD5 and response_put_object["ETag"] != f'"{chunkdata_md5.hexdigest()}"':
+                        raise Exception(f'MD5 ETag NOT MATCHED {dest.bucket} ( Destination / Origin ): '
+                                        f'{response_put_object["ETag"]} - "{chunkdata_md5.hexdigest()}"')
+                    transfer_ledger.completed(dest.bucket, prefix_and_key, srcfile["Size"],
+                                              response_put_object["ETag"])
+                    if JobType == 'LOCAL_TO_S3':
+                        record_synced_file(dest, srcfile, prefix_and_key, f'"{chunkdata_md5.hexdigest()}"')
+                    pending.remove(dest)
+            break
+        except Exception as err:
+            retryTime += 1
+            logger.warning(f'SmallFileFunc - {srcfile["Key"]} - Exception log: {str(err)}')
+            logger.warning(f'Small file upload fail, retry: {srcfile["Key"]} Attempts: {retryTime}')
+            if retryTime > MaxRetry or is_fatal_error(err):
+                logger.error(f'Quit for Max retries: {retryTime}')
+                sys.exit(0)
+            time.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
+    metrics.count('bytes', 'direction', 'upload', srcfile["Size"] * upload_count)
+    metrics.count('files', 'result', 'transferred')
+    progress.add('TransferBytes', srcfile["Size"] * upload_count)
+    progress.file_done(srcfile)
+    logger.info(f'FINISH small file: {srcfile["Key"]} TO {", ".join(f"{d.bucket}/{prefix_and_key}" for d in destinations)}')
+    return
+
+
+# 流式压缩(Compression)：{名称: {"ContentEncoding", "Compressor": 返回有 compress/flush 方法的压缩器}}
+# 压缩器接口与 zlib.compressobj、bz2.BZ2Compressor、lzma.LZMACompressor 相同，可以在这里加入其他算法
+CompressionCodecs = {
+    'gzip': {"ContentEncoding": 'gzip', "Compressor": lambda: zlib.compressobj(CompressLevel, zlib.DEFLATED, 31)},
+    'deflate': {"ContentEncoding": 'deflate', "Compressor": lambda: zlib.compressobj(CompressLevel, zlib.DEFLATED, 15)}
+}
+CompressSizeMeta = 'uncompressed-size'  # 压缩上传的对象在元数据里记录原文件大小
+
+
+def compress_args(srcfile):
+    return {
+        "ContentEncoding": CompressionCodecs[Compression]["ContentEncoding"],
+        "Metadata": {CompressSizeMeta: str(srcfile["Size"])}
+    }
+
+
+# 压缩整个数据，压缩率不够(大于 CompressSkipRatio)返回 None
+def compress_data(data):
+    with metrics.stage('compress'):
+        compressor = CompressionCodecs[Compression]["Compressor"]()
+        compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) > len(data) * CompressSkipRatio:
+        return None
+    return compressed
+
+
+# 读取源文件开头的一段，用于试探压缩率
+def read_source_sample(srcfile):
+    sample_size = min(CompressSampleSize, srcfile["Size"])
+    if JobType == 'LOCAL_TO_S3':
+        with metrics.stage('read'), open(os.path.join(SrcDir, srcfile["Key"]), 'rb') as f:
+            return f.read(sample_size)
+    with metrics.stage('download'):
+        if JobType == 'S3_TO_S3':
+            return s3_src_client.get_object(Bucket=SrcBucket, Key=srcfile["Key"],
+                                            Range=f'bytes=0-{sample_size - 1}')["Body"].read()
+        return ali_bucket.get_object(key=srcfile["Key"], byte_range=(0, sample_size - 1)).read()
+
+
+# 这个文件是否压缩上传：服务端拷贝不经过本机不能压缩；开头一段压缩率不够的(已压缩的格式)原样上传
+def compress_file(srcfile):
+    if not Compression or (JobType == 'S3_TO_S3' and ServerSideCopy):
+        return False
+    if compress_data(read_source_sample(srcfile)) is None:
+        logger.info(f'Not compressible, upload as is: {srcfile["Key"]}')
+        metrics.count('compress', 'result', 'skipped')
+        return False
+    metrics.count('compress', 'result', 'compressed')
+    return True
+
+
+# 压缩上传的对象在目标的 Size 是压缩后的大小，从元数据取原文件大小；不是压缩上传的返回 des_size
+def uncompressed_size(dest, prefix_and_key, des_size):
+    try:
+        with metrics.stage('head'):
+            metadata = dest.client.head_object(Bucket=dest.bucket, Key=prefix_and_key).get("Metadata", {})
+        return int(metadata.get(CompressSizeMeta, des_size))
+    except Exception as err:
+        logger.info(f'Head destination fail - {prefix_and_key} - {str(err)}')
+        return des_size
+
+
+# 按顺序读取整个源文件，S3/OSS 的下载流中断则从断点处用 Range 继续下载
+def iter_source_chunks(srcfile):
+    if JobType == 'LOCAL_TO_S3':
+        with open(os.path.join(SrcDir, srcfile["Key"]), 'rb') as f:
+            while True:
+                with metrics.stage('read'):
+                    chunk = f.read(Megabytes)
+                if not chunk:
+                    return
+                yield chunk
+    offset = 0
+    retryTime = 0
+    while offset < srcfile["Size"]:
+        try:
+            if JobType == 'S3_TO_S3':
+                body = s3_src_client.get_object(Bucket=SrcBucket, Key=srcfile["Key"],
+                                                Range=f'bytes={offset}-{srcfile["Size"] - 1}')["Body"]
+                chunks = body.iter_chunks(chunk_size=Megabytes)
+            else:
+                body = ali_bucket.get_object(key=srcfile["Key"], byte_range=(offset, srcfile["Size"] - 1))
+                chunks = iter(lambda: body.read(Megabytes), b'')
+            for chunk in chunks:
+                offset += len(chunk)
+                metrics.count('bytes', 'direction', 'download', len(chunk))
+                yield chunk
+        except Exception as err:
+            retryTime += 1
+            logger.warning(f'Download stream fail - {srcfile["Key"]} - offset {offset} - Attempt - {retryTime} - '
+                           f'{str(err)}')
+            if retryTime > MaxRetry or is_fatal_error(err):
+                logger.error(f'Quit for Max retries: {retryTime}')
+                sys.exit(0)
+            time.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
+
+
+# 压缩上传：源文件按顺序读入压缩器，压缩流每满 chunkSize 切成一个分片，提交到全局分片线程池上传。
+# 同样的输入、算法和级别压缩结果相同，续传时重新压缩整个文件，已上传的分片只计算 MD5 不再上传
+def uploadCompressedPart(uploads, srcfile, chunkSize):
+    prefix_and_key = srcfile["Key"]
+    if JobType == 'LOCAL_TO_S3':
+        prefix_and_key = str(PurePosixPath(S3Prefix) / srcfile["Key"])
+    stream = PartStream(prefix_and_key, chunkSize, uploads)
+    compressor = CompressionCodecs[Compression]["Compressor"]()
+    try:
+        for chunk in iter_source_chunks(srcfile):
+            metrics.file_bytes(srcfile["Key"], len(chunk))
+            with metrics.stage('compress'):
+                data = compressor.compress(chunk)
+            stream.write(data)
+        with metrics.stage('compress'):
+            data = compressor.flush()
+        stream.write(data)
+        stream.close()
+    finally:
+        stream.release()
+    logger.info(f'All parts uploaded - {srcfile["Key"]} - size: {srcfile["Size"]} - compressed: {stream.size}')
+    return stream.cal_etag(), len(stream.md5list)
+
+
+# 把连续写入的数据按 part_size 切成分片，满一个分片就提交到全局分片线程池上传，缓冲区来自 buffer_pool。
+# 用于打包的小文件和压缩流这类事先不知道总大小、不能按源文件位置切分的数据。
+# uploads 是各目标的 Upload [{"Dest", "UploadId", "Parts": 续传时已上传的分片}]，每个分片只上传到还没有它的目标，都有则只算 MD5；
+# 不指定则只传到 DesBucket，第一个分片提交时才 create_multipart_upload
+class PartStream:
+    def __init__(self, prefix_and_key, part_size, uploads=None):
+        self.key = prefix_and_key
+        self.part_size = part_size
+        self.uploads = uploads or [{"Dest": destinations[0], "UploadId": None, "Parts": []}]
+        self.create_args = {}
+        self.buf = buffer_pool.get(part_size)
+        self.buf_len = 0
+        self.size = 0  # 已写入的字节数
+        self.part_futures = []
+        self.md5list = []
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view):
+            n = min(len(view), self.part_size - self.buf_len)
+            self.buf[self.buf_len:self.buf_len+n] = view[:n]
+            self.buf_len += n
+            self.size += n
+            view = view[n:]
+            if self.buf_len == self.part_size:
+                self.flush_part()
+
+    # 提交当前缓冲区为一个分片，缓冲区在分片上传完后还给 buffer_pool
+    def flush_part(self, last=False):
+        for upload in self.uploads:
+            if upload["UploadId"] is None:
+                upload["UploadId"] = upload["Dest"].client.create_multipart_upload(
+                    Bucket=upload["Dest"].bucket,
+                    Key=self.key,
+                    StorageClass=upload["Dest"].storage_class,
+                    **self.create_args
+                )["UploadId"]
+        self.md5list.append(None)
+        partnumber = len(self.md5list)
+        targets = [(u["Dest"], u["UploadId"]) for u in self.uploads if partnumber not in u["Parts"]]
+        self.part_futures.append(submit_part(buffer_uploadThread, targets, partnumber, self.key, self.buf,
+                                             self.buf_len, self.md5list, not targets))
+        self.buf = None if last else buffer_pool.get(self.part_size)
+        self.buf_len = 0
+
+    # 提交最后一个分片并等待所有分片完成，分片是否成功由调用方检查
+    def close(self):
+        if self.buf_len or not self.md5list:
+            self.flush_part(last=True)
+        self.release()
+        futures.wait(self.part_futures)
+
+    # 出错时释放还没提交的缓冲区，等已提交的分片结束
+    def release(self):
+        if self.buf is not None:
+            buffer_pool.put(self.buf)
+            self.buf = None
+        futures.wait(self.part_futures)
+
+    def cal_etag(self):
+        return '"%s-%s"' % (hashlib.md5(b''.join(self.md5list)).hexdigest(), len(self.md5list))
+
+
+# 上传缓冲区里的一个分片到 targets 的每个目标(dryrun 则只算 MD5)，返回 {目标Bucket: complete_multipart_upload 需要的分片记录}
+def buffer_uploadThread(targets, partnumber, prefix_and_key, buf, size, md5list, dryrun):
+    part_start_time = time.time()
+    chunkdata = memoryview(buf)[:size]
+    try:
+        with metrics.stage('hash'):
+            chunkdata_md5 = hashlib.md5(chunkdata)
+            checksum = part_checksum(chunkdata) if JobType == 'LOCAL_TO_S3' else {}
+        md5list[partnumber-1] = chunkdata_md5.digest()
+        if dryrun:
+            return None
+        parts, retryTime = upload_part_targets(targets, partnumber, prefix_and_key, chunkdata, chunkdata_md5, checksum)
+        record_part_stats(prefix_and_key, size, time.time() - part_start_time, retryTime)
+    finally:
+        buffer_pool.put(buf)
+    return parts
+
+
+# 小文件打包模式(LOCAL_TO_S3, PackSmallFiles)：小文件按读取顺序写成 tar 格式的包，边打包边按 ChunkSize 分片上传，
+# 分片和其他文件共享全局分片线程池。包完成后写 <包名>.index.json 索引，记录每个文件在包中的 Offset/Size，
+# 可以用 get_object(Range=f'bytes={Offset}-{Offset+Size-1}') 取出单个文件。有索引的包才算完成，续传以包为单位
+def small_file_threads():
+    return MaxPackThread if JobType == 'LOCAL_TO_S3' and PackSmallFiles else MaxSmallFileThread
+
+
+def pack_dir():
+    return str(PurePosixPath(S3Prefix) / PackPrefix)
+
+
+def is_pack_key(prefix_and_key):
+    return prefix_and_key.startswith(pack_dir() + '/')
+
+
+packed_file_index = {}  # 已完成的包里的文件 {目标Key: {"Pack", "Offset", "Size", "MTime", "MD5"}}，PackSmallFiles 时在 main 中加载
+pack_sequence = itertools.count(1)
+pack_name_prefix = ''
+
+
+# 从目标列表里的包索引加载已打包的文件，包名带时间，同一个文件以最后打包的为准
+def load_pack_index(desFileIndex):
+    index_keys = sorted(k for k in desFileIndex if is_pack_key(k) and k.endswith('.index.json'))
+
+    def get_index(key):
+        try:
+            with metrics.stage('download'):
+                return json.loads(s3_dest_client.get_object(Bucket=DesBucket, Key=key)["Body"].read())
+        except Exception as err:
+            logger.warning(f'Can not read pack index, files in it will be packed again - {key} - {str(err)}')
+            return None
+
+    packed = {}
+    with futures.ThreadPoolExecutor(max_workers=MaxListThread) as index_pool:
+        for pack_index in index_pool.map(get_index, index_keys):
+            if pack_index is None:
+                continue
+            for member in pack_index["Members"]:
+                packed[member["Key"]] = dict(member, Pack=pack_index["Pack"])
+    logger.info(f'Loaded {len(index_keys)} pack indexes, {len(packed)} packed files')
+    return packed
+
+
+# 未完成的包不能续传(重启后列出的文件和打包顺序不同)，清理掉，其中的文件重新打包。分片模式下只清理本 shard 的包
+def abort_unfinished_packs(uploaded_list):
+    for u in uploaded_list:
+        if is_pack_key(u["Key"]) and (ShardCount <= 1 or f'-shard{ShardIndex}-' in u["Key"]):
+            logger.info(f'Abort unfinished pack: {u["Key"]}')
+            s3_dest_client.abort_multipart_upload(Bucket=DesBucket, Key=u["Key"], UploadId=u["UploadId"])
+
+
+class SmallFilePack(PartStream):
+    def __init__(self):
+        super().__init__(f'{pack_name_prefix}{next(pack_sequence):06d}.tar', max(ChunkSize, 5 * Megabytes))
+        if ChecksumAlgorithm:
+            self.create_args["ChecksumAlgorithm"] = ChecksumAlgorithm
+        self.members = []  # [(srcfile, 索引记录)]
+        self.upload = self.uploads[0]  # 打包模式只有 DesBucket 一个目标
+
+    # tar 成员：PAX 头(支持长文件名和 UTF-8)，数据，补齐到 512 字节
+    def add(self, srcfile, data):
+        info = tarfile.TarInfo(str(PurePosixPath(srcfile["Key"])))
+        info.size = len(data)
+        info.mtime = (srcfile.get("MTime") or time.time_ns()) / 1e9
+        info.mode = 0o644
+        self.write(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+        with metrics.stage('hash'):
+            md5 = hashlib.md5(data).hexdigest()
+        self.members.append((srcfile, {
+            "Key": str(PurePosixPath(S3Prefix) / srcfile["Key"]),
+            "Offset": self.size,
+            "Size": len(data),
+            "MTime": srcfile.get("MTime"),
+            "MD5": md5
+        }))
+        self.write(data)
+        self.write(tarfile.NUL * (-len(data) % tarfile.BLOCKSIZE))
+
+    # 写 tar 结束块，上传最后一个分片并合并，写索引；只有一个分片的小包直接 put_object
+    def finish(self):
+        self.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        try:
+            if self.upload["UploadId"] is None:
+                body = memoryview(self.buf)[:self.buf_len]
+                with metrics.stage('hash'):
+                    body_md5 = hashlib.md5(body)
+                    checksum = part_checksum(body)
+                with metrics.stage('put_object'):
+                    etag = s3_dest_client.put_object(
+                        Body=PartReader(body),
+                        Bucket=DesBucket,
+                        Key=self.key,
+                        StorageClass=StorageClass,
+                        ContentMD5=base64.b64encode(body_md5.digest()).decode('utf-8'),
+                        **checksum
+                    )["ETag"]
+                metrics.count('bytes', 'direction', 'upload', self.buf_len)
+                progress.add('TransferBytes', self.buf_len)
+                cal_etag = f'"{body_md5.hexdigest()}"'
+                self.release()
+            else:
+                self.close()
+                parts = [f.result()[DesBucket] for f in self.part_futures]  # 分片超过最大重试次数则抛出，整个包放弃
+                with metrics.stage('complete'):
+                    etag = s3_dest_client.complete_multipart_upload(
+                        Bucket=DesBucket,
+                        Key=self.key,
+                        UploadId=self.upload["UploadId"],
+                        MultipartUpload={"Parts": parts}
+                    )["ETag"]
+                cal_etag = self.cal_etag()
+                forget_upload(self.upload["Dest"], self.key, self.upload["UploadId"])
+            if ifVerifyMD5 and etag != cal_etag:
+                s3_dest_client.delete_object(Bucket=DesBucket, Key=self.key)
+                raise Exception(f'MD5 ETag NOT MATCHED ( Destination / Origin ): {etag} - {cal_etag}')
+            self.put_index(etag)
+        except BaseException as err:
+            self.abort(err)
+            return
+        for srcfile, member in self.members:
+            metrics.count('files', 'result', 'transferred')
+            progress.file_done(srcfile)
+            transfer_ledger.completed(DesBucket, member["Key"], member["Size"], None)
+            record_synced_file(self.upload["Dest"], srcfile, member["Key"], f'"{member["MD5"]}"')
+        logger.info(f'FINISH pack: {len(self.members)} files, {self.size} bytes TO {DesBucket}/{self.key}')
+
+    # 包里的文件都不算完成，结束校验会报告它们，下次运行重新打包
+    def abort(self, err):
+        reason = 'part upload quit for max retries' if isinstance(err, SystemExit) else str(err)
+        logger.error(f'Pack upload fail, {len(self.members)} files in it are not uploaded - {self.key} - {reason}')
+        self.release()
+        if self.upload["UploadId"] is not None:
+            try:
+                s3_dest_client.abort_multipart_upload(Bucket=DesBucket, Key=self.key, UploadId=self.upload["UploadId"])
+            except Exception as abort_err:
+                logger.warning(f'Abort pack upload fail - {self.key} - {str(abort_err)}')
+            forget_upload(self.upload["Dest"], self.key, self.upload["UploadId"])
+
+    def put_index(self, etag):
+        index_body = json.dumps({
+            "Pack": self.key,
+            "Size": self.size,
+            "ETag": etag,
+            "Members": [member for srcfile, member in self.members]
+        }).encode('utf-8')
+        retryTime = 0
+        while True:
+            try:
+                s3_dest_client.put_object(
+                    Body=index_body,
                     Bucket=DesBucket,
-                    Key=prefix_and_key,
-                    StorageClass=StorageClass
+                    Key=self.key + '.index.json',
+                    ContentMD5=base64.b64encode(hashlib.md5(index_body).digest()).decode('utf-8')
                 )
-                # logger.info("UploadId: "+response_new_upload["UploadId"])
-                reponse_uploadId = response_new_upload["UploadId"]
-                partnumberList = []
-            elif response_check_upload == 'NEXT':
+                return
+            except Exception as err:
+                retryTime += 1
+                if retryTime > MaxRetry or is_fatal_error(err):
+                    raise
+                time.sleep(retry_backoff(err, retryTime))
+
+
+# 打包线程：依次读取小文件写入当前的包，包满 PackSize 则完成这个包开始下一个
+def consume_pack_queue(file_queue):
+    pack = None
+    while True:
+        srcfile = file_queue.get()
+        if srcfile is None:
+            break
+        prefix_and_key = str(PurePosixPath(S3Prefix) / srcfile["Key"])
+        try:
+            packed = packed_file_index.get(prefix_and_key)
+            if packed is not None and (packed["Size"], packed["MTime"]) == (srcfile["Size"], srcfile.get("MTime")):
+                transfer_ledger.completed(DesBucket, prefix_and_key, srcfile["Size"], None)
+                response_check_upload = 'NEXT'  # 已在之前完成的包里，文件没有变化
+            else:
+                response_check_upload = check_file_exit(srcfile, destinations[0])
+            if response_check_upload == 'NEXT':
                 logger.info(f'Duplicated. {srcfile["Key"]} same size, goto next file.')
-                raise NextFile()
+                metrics.count('files', 'result', 'skipped')
+                progress.file_done(srcfile, skipped=True)
+                continue
+            if response_check_upload != 'UPLOAD':
+                s3_dest_client.abort_multipart_upload(Bucket=DesBucket, Key=prefix_and_key,
+                                                      UploadId=response_check_upload)
+                forget_upload(destinations[0], prefix_and_key, response_check_upload)
+            with metrics.stage('read'), open(os.path.join(SrcDir, srcfile["Key"]), 'rb') as data:
+                getBody = data.read()
+        except Exception as err:
+            logger.error(f'Pack file fail: {srcfile["Key"]} - {str(err)}')
+            continue
+        if pack is None:
+            pack = SmallFilePack()
+        try:
+            pack.add(srcfile, getBody)
+        except Exception as err:
+            pack.abort(err)  # 包的数据已不完整，放弃整个包
+            pack = None
+            continue
+        if pack.size >= PackSize:
+            pack.finish()
+            pack = None
+    if pack is not None:
+        pack.finish()
+
+
+def upload_file(srcfile):
+    logger.info(f'Start file: {srcfile["Key"]}')
+    metrics.file_start(srcfile["Key"], srcfile["Size"])
+    prefix_and_key = srcfile["Key"]
+    if JobType == 'LOCAL_TO_S3':
+        prefix_and_key = str(PurePosixPath(S3Prefix) / srcfile["Key"])
+    try:
+        # 检查文件在每个目标是否已存在，存在的目标不再上传；不存在且没UploadID要新建、不存在但有UploadID得到返回的UploadID
+        pending = [(dest, check_file_exit(srcfile, dest)) for dest in destinations]
+        pending = [(dest, response_check_upload) for dest, response_check_upload in pending
+                   if response_check_upload != 'NEXT']
+        if not pending:
+            logger.info(f'Duplicated. {srcfile["Key"]} same size, goto next file.')
+            raise NextFile()
+        compressed = compress_file(srcfile)
+        # 循环重试3次（如果MD5计算的ETag不一致）
+        for md5_retry in range(3):
+            uploads, chunkSize = prepare_uploads(srcfile, pending, compressed)
+
+            if compressed:
+                # 压缩后的大小事先不知道，边压缩边切分片
+                upload_etag_full, partCount = uploadCompressedPart(uploads, srcfile, chunkSize)
+            else:
+                # 获取索引列表
+                response_indexList = split(srcfile, chunkSize)
+
+                # 执行分片upload，每个分片读取或下载一次，上传到所有目标
+                upload_etag_full = uploadPart(uploads, response_indexList, srcfile, chunkSize)
+                partCount = len(response_indexList)
+
+            # 合并各目标上的文件，分别检查，ETag 不匹配的目标重传；一个目标失败不影响其他目标合并，最后再退出
+            pending = []
+            complete_err = None
+            for upload in uploads:
+                dest = upload["Dest"]
+                try:
+                    response_complete = completeUpload(dest, upload["UploadId"], srcfile["Key"], partCount)
+                except SystemExit as err:
+                    complete_err = err
+                    continue
+                if compressed:
+                    transfer_ledger.completed(dest.bucket, prefix_and_key, srcfile["Size"],
+                                              response_complete["ETag"])  # 记原文件大小
+                forget_upload(dest, prefix_and_key, upload["UploadId"])
+                logger.info(f'FINISH: {srcfile["Key"]} TO {response_complete["Location"]}')
+
+                # 检查文件MD5，服务端拷贝不经过本机，没有本地计算的MD5可比较
+                # 压缩续传依赖重新压缩的结果与上次相同，续传的压缩文件总是检查
+                if (ifVerifyMD5 or (compressed and upload["Parts"])) and not (JobType == 'S3_TO_S3' and ServerSideCopy):
+                    if response_complete["ETag"] != upload_etag_full:  # ETag 不匹配，删除S3的文件，重试
+                        logger.warning(f'MD5 ETag NOT MATCHED {dest.bucket}/{prefix_and_key}( Destination / Origin ): '
+                                       f'{response_complete["ETag"]} - {upload_etag_full}')
+                        dest.client.delete_object(
+                            Bucket=dest.bucket,
+                            Key=prefix_and_key
+                        )
+                        transfer_ledger.forget(dest.bucket, prefix_and_key, srcfile)
+                        pending.append((dest, 'UPLOAD'))
+                        logger.warning(f'Deleted and retry upload {dest.bucket}/{prefix_and_key}')
+                        continue
+                    logger.info(f'MD5 ETag Matched - {srcfile["Key"]} - {response_complete["ETag"]}')
+                record_synced_file(dest, srcfile, prefix_and_key, upload_etag_full)
+            if complete_err is not None:
+                raise complete_err
+            if not pending:
+                break
+            if md5_retry == 2:
+                logger.warning(f'MD5 ETag NOT MATCHED Exceed Max Retries - {srcfile["Key"]}')
+        metrics.count('files', 'result', 'transferred')
+        metrics.file_end(srcfile["Key"])  # 先结束活动文件再计入完成，进度不会重复计算这个文件
+        progress.file_done(srcfile)
+    except NextFile:
+        metrics.count('files', 'result', 'skipped')
+        progress.file_done(srcfile, skipped=True)
+    finally:
+        metrics.file_end(srcfile["Key"])
+    return
+
+
+# 准备这个文件在各目标的 Upload [{"Dest", "UploadId", "Parts": 已上传的分片, "JournalParts": 续传记录}]：
+# 有未完成的 Upload 先查已上传的分片续传，没有则新建。分片只读取或下载一次再上传到所有目标，各目标必须用同一个分片大小，
+# 以第一个有已上传分片的 Upload 为准，推断不出分片大小或与之不同的 Upload 放弃，从头开始
+def prepare_uploads(srcfile, pending, compressed):
+    prefix_and_key = srcfile["Key"]
+    if JobType == 'LOCAL_TO_S3':
+        prefix_and_key = str(PurePosixPath(S3Prefix) / srcfile["Key"])
+    chunkSize = None
+    uploads = []
+    for dest, response_check_upload in pending:
+        upload = {"Dest": dest, "UploadId": None, "Parts": set(), "JournalParts": {}}
+        uploads.append(upload)
+        if response_check_upload == 'UPLOAD':
+            continue
+        partnumberList = []
+        journalParts = {}
+        partSize = None
+        # 先查本地续传记录，记录里的分片一定已在S3上，不用再 list_parts
+        if resume_journal is not None:
+            journalParts = resume_journal.get_parts(dest.bucket, prefix_and_key, response_check_upload)
+        if journalParts:
+            partnumberList = sorted(journalParts)
+            partSize = uploaded_chunksize(srcfile, {n: p["Size"] for n, p in journalParts.items()}, compressed)
+            logger.info(f'Found {len(partnumberList)} uploaded parts in resume journal - '
+                        f'{dest.bucket}/{prefix_and_key}')
+        if partSize is None:
+            # 获取已上传partnumberList，以及从已上传分片推断出的这个Upload的分片大小
+            journalParts = {}
+            partnumberList, partSize = checkPartnumberList(srcfile, dest, response_check_upload, compressed)
+        if partnumberList and (partSize is None or partSize != (chunkSize or partSize)):
+            # 推断不出分片大小，或与其他目标续传的分片大小不同，就不能续传，放弃这个Upload从头开始
+            logger.warning(f'Can not resume unfinished upload with unknown or different part size, restart: '
+                           f'{dest.bucket}/{prefix_and_key}')
+            dest.client.abort_multipart_upload(
+                Bucket=dest.bucket,
+                Key=prefix_and_key,
+                UploadId=response_check_upload
+            )
+            forget_upload(dest, prefix_and_key, response_check_upload)
+            continue
+        upload.update({"UploadId": response_check_upload, "Parts": set(partnumberList), "JournalParts": journalParts})
+        for partnumber, part in journalParts.items():
+            part_ledger.add(dest.bucket, response_check_upload, partnumber, part)
+        if partnumberList:
+            chunkSize = partSize
+    if chunkSize is None:
+        chunkSize = choose_chunksize(srcfile)
+    extra_args = {}
+    if JobType == 'LOCAL_TO_S3' and ChecksumAlgorithm:
+        extra_args["ChecksumAlgorithm"] = ChecksumAlgorithm  # 分片带 flexible checksum 时 Upload 也要指定算法
+    if compressed:
+        extra_args.update(compress_args(srcfile))
+    for upload in uploads:
+        if upload["UploadId"] is None:
+            logger.info(f'New upload: {upload["Dest"].bucket}/{prefix_and_key}')
+            response_new_upload = upload["Dest"].client.create_multipart_upload(
+                Bucket=upload["Dest"].bucket,
+                Key=prefix_and_key,
+                StorageClass=upload["Dest"].storage_class,
+                **extra_args
+            )
+            upload["UploadId"] = response_new_upload["UploadId"]
+    return uploads, chunkSize
+
+
+def check_file_exit(srcfile, dest):
+    # 检查源文件是否在目标文件夹中
+    prefix_and_key = srcfile["Key"]
+    if JobType == 'LOCAL_TO_S3':
+        prefix_and_key = str(PurePosixPath(S3Prefix) / srcfile["Key"])
+    synced_stat = None
+    stat_changed = False
+    if sync_manifest is not None:
+        synced_stat = sync_manifest.get_stat(dest.bucket, prefix_and_key)
+        if synced_stat is not None:
+            stat_changed = synced_stat != (srcfile["Size"], srcfile.get("MTime"), srcfile.get("Inode"))
+            if not stat_changed and TrustSyncManifest:
+                transfer_ledger.completed(dest.bucket, prefix_and_key, srcfile["Size"], None)
+                return 'NEXT'  # 本地同步清单记录这个文件上次同步后没有变化
+    listed_upto = dest.listed_upto
+    des_file = dest.des_file_index.get(prefix_and_key)
+    if des_file is None and listed_upto is not None and prefix_and_key > listed_upto:
+        des_file = head_des_file(dest, prefix_and_key)  # 目标还没列到这个 Key
+    des_size = None if des_file is None else des_file["Size"]
+    if Compression and des_size is not None and des_size != srcfile["Size"] and not stat_changed:
+        des_size = uncompressed_size(dest, prefix_and_key, des_size)  # 压缩上传的对象比较原文件大小
+    if des_file is not None and srcfile["Size"] == des_size and not stat_changed:
+        if sync_manifest is not None and synced_stat is None:
+            record_synced_file(dest, srcfile, prefix_and_key, des_file["ETag"])  # 已在目标的文件也记入清单
+        transfer_ledger.completed(dest.bucket, prefix_and_key, des_size, des_file["ETag"])
+        return 'NEXT'  # 文件完全相同
+    # 找不到文件，或文件不一致，要重新传的
+    # 查Key是否有未完成的UploadID，索引中已是同一个Key时间最晚的Upload
+    UploadID_latest = dest.upload_id_index.get(prefix_and_key)
+    # 如果找不到上传过的Upload，则从头开始传
+    if UploadID_latest is None:
+        return 'UPLOAD'
+    return UploadID_latest["UploadId"]
+
+
+# 续传时列出已上传的分片，放入内存记录，合并时不用再列
+def checkPartnumberList(srcfile, dest, uploadId, compressed=False):
+    try:
+        prefix_and_key = srcfile["Key"]
+        if JobType == 'LOCAL_TO_S3':
+            prefix_and_key = str(PurePosixPath(S3Prefix) / srcfile["Key"])
+        # 按现在的分片大小预计分片数，决定同时列几页
+        pages = -(-srcfile["Size"] // choose_chunksize(srcfile) // 1000)
+        uploadedParts = list_uploaded_parts(dest, prefix_and_key, uploadId, pages)
+        for partnumber, part in uploadedParts.items():
+            part_ledger.add(dest.bucket, uploadId, partnumber, part)
+        partnumberList = sorted(uploadedParts)
+        if partnumberList:  # 如果为0则表示没有查到已上传的Part
+            logger.info("Found uploaded partnumber: "+json.dumps(partnumberList))
+    except Exception as checkPartnumberList_err:
+        logger.error("checkPartnumberList_err"+str(checkPartnumberList_err))
+        sys.exit(0)
+    return partnumberList, uploaded_chunksize(srcfile, {n: p["Size"] for n, p in uploadedParts.items()}, compressed)
+
+
+# 列出一个 Upload 已上传的分片 {PartNumber: {"ETag", "Size", 校验和}}，只在续传或内存记录不全时使用
+# 分片编号是整数，每页最多 1000 个：PartNumberMarker 为 0, 1000, 2000... 的页一定包含 (Marker, Marker+1000] 的全部分片，
+# 所以预计的 pages 页同时请求，不用等上一页的 NextPartNumberMarker；最后一页之后还有的再按顺序往后列
+def list_uploaded_parts(dest, prefix_and_key, uploadId, pages=1):
+    def list_page(PartNumberMarker):
+        with metrics.stage('list_parts'):
+            return dest.client.list_parts(
+                Bucket=dest.bucket,
+                Key=prefix_and_key,
+                UploadId=uploadId,
+                MaxParts=1000,
+                PartNumberMarker=PartNumberMarker
+            )
+    pages = max(1, min(pages, 10))  # 最多 10,000 个分片
+    if pages > 1:
+        with futures.ThreadPoolExecutor(max_workers=pages) as page_pool:
+            responses = list(page_pool.map(list_page, range(0, pages * 1000, 1000)))
+    else:
+        responses = [list_page(0)]
+    while responses[-1]['IsTruncated']:
+        responses.append(list_page(responses[-1]['NextPartNumberMarker']))
+    uploadedParts = {}
+    for response_uploadedList in responses:
+        for partObject in response_uploadedList.get("Parts", []):
+            part = {"ETag": partObject["ETag"], "Size": partObject["Size"]}
+            if ChecksumAlgorithm and f'Checksum{ChecksumAlgorithm}' in partObject:
+                part[f'Checksum{ChecksumAlgorithm}'] = partObject[f'Checksum{ChecksumAlgorithm}']
+            uploadedParts[partObject["PartNumber"]] = part
+    return uploadedParts
+
+
+# 从已上传分片的大小推断这个Upload当时用的分片大小，推断不出或与文件大小对不上则返回 None
+# Part 1 如果不是最后一个分片，它的大小就是分片大小；否则两个大小相同的分片中至少有一个不是最后一个
+# 压缩上传的总大小事先不知道：除编号最大的分片外都应等于分片大小，编号最大的可能是最后一个分片
+def uploaded_chunksize(srcfile, partSizeList, compressed=False):
+    if not partSizeList:
+        return None
+    if compressed:
+        last = max(partSizeList)
+        sizes = {size for partnumber, size in partSizeList.items() if partnumber != last}
+        # 只有编号最大的分片时，它不一定是整分片，和现在的分片大小相同才续传
+        chunkSize = sizes.pop() if sizes else choose_chunksize(srcfile)
+        if sizes or partSizeList[last] > chunkSize or (len(partSizeList) == 1 and partSizeList[last] != chunkSize):
+            return None
+        return chunkSize
+    if 1 in partSizeList:
+        chunkSize = partSizeList[1]
+    else:
+        sizes = list(partSizeList.values())
+        same_size = [size for size in sizes if sizes.count(size) > 1]
+        if not same_size:
+            return None
+        chunkSize = max(same_size)
+    total = max(-(-srcfile["Size"] // chunkSize), 1)
+    for partnumber, size in partSizeList.items():
+        if partnumber < total:
+            expected = chunkSize
+        elif partnumber == total:
+            expected = srcfile["Size"] - chunkSize * (total - 1)
+        else:
+            return None
+        if size != expected:
+            return None
+    return chunkSize
+
+
+# 单个文件的分片大小：基础值为 ChunkSize 或自适应调整的值，并保证分片数不超过 10,000
+def choose_chunksize(srcfile):
+    chunkSize = chunk_tuner.chunksize() if AdaptiveChunkSize else ChunkSize
+    min_chunksize = -(-srcfile["Size"] // 10000)
+    min_chunksize = -(-min_chunksize // Megabytes) * Megabytes  # 按 MB 向上取整
+    if min_chunksize > chunkSize:
+        logger.info(f'File {srcfile["Key"]} needs more than 10,000 parts of {chunkSize} bytes, '
+                    f'use part size {min_chunksize}')
+        chunkSize = min_chunksize
+    return chunkSize
+
+
+# 按实测的单分片吞吐量和重试情况调整新文件的分片大小
+# 目标是每个分片大约 TargetSeconds 秒传完：带宽大则分片大；重试多（丢包、不稳定）则分片减半，少重传数据
+class ChunkSizeTuner:
+    TargetSeconds = 10
+    MinSamples = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.speed = 0.0  # 单分片吞吐量 bytes/s，指数移动平均
+        self.retry_rate = 0.0  # 每个分片的平均重试次数，指数移动平均
+
+    def record_part(self, size, seconds, retries):
+        speed = size / max(seconds, 0.001)
+        with self.lock:
+            if self.samples == 0:
+                self.speed = speed
+                self.retry_rate = retries
+            else:
+                self.speed = 0.8 * self.speed + 0.2 * speed
+                self.retry_rate = 0.8 * self.retry_rate + 0.2 * retries
+            self.samples += 1
+
+    def chunksize(self):
+        with self.lock:
+            if self.samples < self.MinSamples:
+                return ChunkSize  # 样本不够，先用配置的 ChunkSize
+            size = self.speed * self.TargetSeconds
+            if self.retry_rate > 0.1:
+                size = size / 2
+        size = min(max(size, 5 * Megabytes), MaxChunkSize)
+        return int(size // Megabytes) * Megabytes
+
+
+chunk_tuner = ChunkSizeTuner()
+
+
+# 错误分类：限流的要退避更久并通知 concurrency_controller 减小并发；没有权限、不存在的重试也没用
+ThrottleErrorCodes = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests',
+                      'RequestThrottled', 'ServiceUnavailable'}
+FatalErrorCodes = {'AccessDenied', 'AllAccessDisabled', 'InvalidAccessKeyId', 'SignatureDoesNotMatch',
+                   'NoSuchBucket', 'NoSuchKey', 'NoSuchUpload', 'InvalidBucketName'}
+
+
+# 取出错误码和 http 状态码：botocore 的 ClientError 在 response 里，oss2 的异常是 code/status 属性
+def error_code_status(err):
+    response = getattr(err, 'response', None)
+    if isinstance(response, dict):
+        return (response.get('Error', {}).get('Code', ''),
+                response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0))
+    return getattr(err, 'code', '') or '', getattr(err, 'status', 0) or 0
+
+
+def is_throttle_error(err):
+    code, status = error_code_status(err)
+    return code in ThrottleErrorCodes or status in (429, 503)
+
+
+def is_fatal_error(err):
+    code, status = error_code_status(err)
+    return code in FatalErrorCodes or status in (403, 404)
+
+
+# 重试前等待的秒数：指数退避加全随机抖动，避免大量分片同时重试形成限流风暴
+# 限流的起始退避更长，并让 concurrency_controller 减小并发
+def retry_backoff(err, retryTime):
+    if is_throttle_error(err):
+        base = 2
+        metrics.count('retries', 'error', 'throttle')
+        if AdaptiveConcurrency:
+            concurrency_controller.throttled()
+    else:
+        base = 0.5
+        metrics.count('retries', 'error', 'other')
+    return random.uniform(0, min(60, base * 2 ** retryTime))
+
+
+# 自适应并发(AIMD)：每个分片先占一个名额，名额数 limit 每个统计窗口调整一次
+# 名额用满且吞吐量上升则增加：开始时翻倍(慢启动)，之后每次 +1；遇到限流减半，单位数据耗时比最低值高一倍(延迟突增)
+# 且吞吐量比上个窗口下降则减 1/4。链路跑满时并发翻倍，单个分片耗时也随之翻倍而吞吐量不变，这不算拥塞，只看耗时会来回震荡
+# 减小后一个窗口内不再减小，一次限流风暴只减半一次
+class ConcurrencyController:
+    Window = 3  # 统计窗口，秒
+    MinLimit = 2
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.limit = min(MaxParallelFile * MaxThread, MaxAdaptiveThread)
+        self.in_flight = 0
+        self.saturated = False  # 窗口内名额是否用满过
+        self.slow_start = True
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_seconds = 0.0  # 窗口内完成的分片耗时之和
+        self.last_throughput = 0.0
+        self.base_latency = None  # 最低的单位数据耗时，秒/byte
+        self.last_decrease = 0.0
+
+    def try_acquire(self):
+        with self.cond:
+            if self.in_flight >= self.limit:
+                self.saturated = True
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.saturated = True
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def record_part(self, size, seconds):
+        with self.cond:
+            self.window_bytes += size
+            self.window_seconds += seconds
+            now = time.time()
+            if now - self.window_start >= self.Window:
+                self.adjust(now)
+
+    def throttled(self):
+        with self.cond:
+            self.decrease(time.time(), 0.5, 'throttled')
+
+    def decrease(self, now, factor, reason):
+        if now - self.last_decrease < self.Window:
+            return
+        self.limit = max(self.MinLimit, int(self.limit * factor))
+        self.slow_start = False
+        self.last_decrease = now
+        logger.info(f'Concurrency {reason}, decrease to {self.limit} parts')
+
+    def adjust(self, now):
+        throughput = self.window_bytes / (now - self.window_start)
+        latency = self.window_seconds / max(self.window_bytes, 1)
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        if latency > 2 * self.base_latency and throughput < self.last_throughput * 0.9:
+            self.decrease(now, 0.75, 'latency spike')
+        elif self.saturated and throughput > self.last_throughput * 1.05:
+            self.limit = min(MaxAdaptiveThread, self.limit * 2 if self.slow_start else self.limit + 1)
+            self.cond.notify_all()
+            logger.info(f'Concurrency increase to {self.limit} parts, throughput {throughput / Megabytes:.1f} MB/s')
+        elif self.saturated:
+            self.slow_start = False  # 名额用满但吞吐量不再上升
+        self.last_throughput = throughput
+        self.saturated = self.in_flight >= self.limit
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_seconds = 0.0
+
+
+concurrency_controller = ConcurrencyController()
+
+
+# 分片完成后的统计：传输统计、自适应分片大小和自适应并发
+def record_part_stats(srcfileKey, size, seconds, retries):
+    metrics.observe('part', seconds)
+    metrics.count('bytes', 'direction', 'upload', size)
+    metrics.file_bytes(srcfileKey, size)
+    progress.part_done(size)
+    chunk_tuner.record_part(size, seconds, retries)
+    if AdaptiveConcurrency:
+        concurrency_controller.record_part(size, seconds)
+
+
+# 在分片线程里执行一个分片，AdaptiveConcurrency 时先占用 concurrency_controller 的名额
+def run_part(part_func, *args):
+    if AdaptiveConcurrency:
+        with concurrency_controller.slot():
+            return profiler.run(part_func, *args)
+    return profiler.run(part_func, *args)
+
+
+# 提交一个分片到 part_pool，asyncio 引擎的名额由 AsyncPartEngine 自己处理
+def submit_part(part_func, *args):
+    if Engine == 'thread':
+        return part_pool.submit(run_part, part_func, *args)
+    return part_pool.submit(part_func, *args)
+
+
+# 可复用的分片缓冲区池，同时是全局内存预算：使用中的缓冲区总大小不超过 MaxMemoryBuffer，
+# 超出则 get 阻塞，等其他分片上传完释放缓冲区(对下载形成背压)；空闲缓冲区在需要腾出预算时丢弃
+class BufferPool:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.free = collections.deque()
+        self.free_bytes = 0
+        self.in_use = 0
+
+    # block = False 时超出预算不等待，返回 None
+    def get(self, size, block=True):
+        with self.cond:
+            # 单个分片就超过预算的，等其他缓冲区都释放后也允许，避免死锁
+            while self.in_use > 0 and self.in_use + size > MaxMemoryBuffer:
+                if not block:
+                    return None
+                self.cond.wait()
+            self.in_use += size
+            for buf in self.free:
+                if len(buf) == size:
+                    self.free.remove(buf)
+                    self.free_bytes -= size
+                    return buf
+            self.trim()
+        return bytearray(size)
+
+    def put(self, buf):
+        with self.cond:
+            self.in_use -= len(buf)
+            self.free.append(buf)
+            self.free_bytes += len(buf)
+            self.trim()
+            self.cond.notify_all()
+
+    def trim(self):
+        while self.free and self.in_use + self.free_bytes > MaxMemoryBuffer:
+            self.free_bytes -= len(self.free.popleft())
+
+    @contextlib.contextmanager
+    def buffer(self, size):
+        buf = self.get(size)
+        try:
+            yield buf
+        finally:
+            self.put(buf)
+
+
+buffer_pool = BufferPool()
+
+
+# 只读的 memoryview 文件对象，作为 upload_part 的 Body。按 http 发送的块大小复制，不复制整个分片
+class PartReader(io.RawIOBase):
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(min(len(b), len(self.view) - self.pos), 0)
+        b[:n] = self.view[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.view) - self.pos
+        chunk = bytes(self.view[self.pos:self.pos+size])
+        self.pos += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = len(self.view) + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def __len__(self):
+        return len(self.view)
+
+
+# LOCAL_TO_S3 每个 upload_file 只打开一次本地文件：能 mmap 则每个分片直接取 memoryview 切片，不分配内存；
+# 不能 mmap 的（LocalMmapRead = False、空文件、不支持 mmap 的文件系统、32位系统的大文件）从缓冲池取 bytearray 读入
+# 读入也共用这一个文件句柄：有 os.preadv 的系统按偏移读，不移动文件位置，多个分片线程可同时读；
+# 没有的(Windows)用锁保护 seek + readinto
+class LocalFileReader:
+    def __init__(self, path, use_mmap=True):
+        self.path = path
+        self.mmap = None
+        self.lock = threading.Lock()
+        self.file = open(path, 'rb')
+        if LocalMmapRead and use_mmap:
+            try:
+                self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError, OverflowError) as err:
+                logger.debug(f'Can not mmap {path}, use buffer pool - {str(err)}')
+
+    # 从 offset 读满 view，返回读到的字节数，文件已到末尾则少于 len(view)
+    def readinto(self, view, offset):
+        n = 0
+        while n < len(view):
+            if hasattr(os, 'preadv'):
+                size = os.preadv(self.file.fileno(), [view[n:]], offset + n)
             else:
-                reponse_uploadId = response_check_upload
+                with self.lock:
+                    self.file.seek(offset + n)
+                    size = self.file.readinto(view[n:])
+            if not size:
+                break
+            n += size
+        return n
+
+    @contextlib.contextmanager
+    def part(self, partStartIndex, chunkSize):
+        if self.mmap is not None:
+            with memoryview(self.mmap) as whole, whole[partStartIndex:partStartIndex+chunkSize] as view:
+                yield view
+        else:
+            buf = buffer_pool.get(chunkSize)
+            try:
+                with metrics.stage('read'), memoryview(buf) as whole, whole[:chunkSize] as target:
+                    n = self.readinto(target, partStartIndex)
+                with memoryview(buf) as whole, whole[:n] as view:
+                    yield view
+            finally:
+                buffer_pool.put(buf)
 
-                # 获取已上传partnumberList
-                partnumberList = checkPartnumberList(srcfile, reponse_uploadId)
+    def close(self):
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass  # 还有 memoryview 没释放(如异常的 traceback 持有)，由垃圾回收关闭
+        self.file.close()
 
-            # 获取索引列表
-            response_indexList = split(srcfile)
 
-            # 执行分片upload
-            upload_etag_full = uploadPart(reponse_uploadId, response_indexList, partnumberList, srcfile)
+# LOCAL_TO_S3 分片流水线：读取 -> 哈希 -> 上传 三个阶段各自的线程数，阶段之间是有界队列
+# 同一个分片在一个线程里顺序 读、算 MD5、上传 时，磁盘、CPU、网络轮流闲着；流水线让三者同时忙
+# 读取阶段真正从磁盘读入缓冲池的 bytearray(不用 mmap，否则读盘会推迟到哈希阶段)，队列满或超出 MaxMemoryBuffer 则读取暂停
+# 分片耗时只累加三个阶段实际处理它的时间，不含在队列里等待的时间，和不用流水线时的分片耗时可比
+class PartPipeline:
+    def __init__(self):
+        self.read_queue = queue.Queue(maxsize=PipelineQueueSize)
+        self.hash_queue = queue.Queue(maxsize=PipelineQueueSize)
+        self.upload_queue = queue.Queue(maxsize=PipelineQueueSize)
+        upload_threads = MaxAdaptiveThread if AdaptiveConcurrency else MaxParallelFile * MaxThread
+        self.stages = []
+        for stage_queue, worker, n in ((self.read_queue, self.read_worker, MaxReadThread),
+                                       (self.hash_queue, self.hash_worker, MaxHashThread),
+                                       (self.upload_queue, self.upload_worker, upload_threads)):
+            threads = [threading.Thread(target=profiler.run, args=(self.stage_loop, stage_queue, worker), daemon=True)
+                       for i in range(n)]
+            for t in threads:
+                t.start()
+            self.stages.append((stage_queue, threads))
 
-            # 合并S3上的文件
-            response_complete = completeUpload(
-                reponse_uploadId, srcfile["Key"], len(response_indexList))
-            logger.info(f'FINISH: {srcfile["Key"]} TO {response_complete["Location"]}')
+    # 返回 concurrent.futures.Future，分片上传完成(dryrun 则算完 MD5)时完成
+    def submit(self, targets, partnumber, partStartIndex, chunkSize, srcfileKey, md5list, dryrun, local_reader):
+        part = {
+            "Targets": targets,
+            "PartNumber": partnumber,
+            "Start": partStartIndex,
+            "ChunkSize": chunkSize,
+            "Key": srcfileKey,
+            "MD5List": md5list,
+            "DryRun": dryrun,
+            "Reader": local_reader,
+            "Future": futures.Future(),
+            "Stack": contextlib.ExitStack(),
+            "Seconds": 0.0
+        }
+        self.read_queue.put(part)
+        return part["Future"]
 
-            # 检查文件MD5
-            if ifVerifyMD5:
-                if response_complete["ETag"] == upload_etag_full:
-                    logger.info(f'MD5 ETag Matched - {srcfile["Key"]} - {response_complete["ETag"]}')
-                    break
-                else:  # ETag 不匹配，删除S3的文件，重试
-                    logger.warning(f'MD5 ETag NOT MATCHED {srcfile["Key"]}( Destination / Origin ): '
-                                   f'{response_complete["ETag"]} - {upload_etag_full}')
-                    s3_dest_client.delete_object(
-                        Bucket=DesBucket,
-                        Key=prefix_and_key
-                    )
-                    UploadIdList = []
-                    logger.warning('Deleted and retry upload {srcfile["Key"]}')
-                if md5_retry == 2:
-                    logger.warning('MD5 ETag NOT MATCHED Exceed Max Retries - {srcfile["Key"]}')
-            else:
+    def stage_loop(self, stage_queue, worker):
+        while True:
+            part = stage_queue.get()
+            if part is None:
                 break
-    except NextFile:
-        pass
-    return
+            try:
+                worker(part)
+            except BaseException as err:  # 上传超过最大重试次数 sys.exit 也只结束这个分片
+                part["Stack"].close()
+                part["Future"].set_exception(err)
 
+    def read_worker(self, part):
+        start_time = time.time()
+        part["Data"] = part["Stack"].enter_context(part["Reader"].part(part["Start"], part["ChunkSize"]))
+        part["Seconds"] += time.time() - start_time
+        self.hash_queue.put(part)
 
-def check_file_exit(srcfile, desFilelist, UploadIdList):
-    # 检查源文件是否在目标文件夹中
-    prefix_and_key = srcfile["Key"]
-    if JobType == 'LOCAL_TO_S3':
-        prefix_and_key = str(PurePosixPath(S3Prefix) / srcfile["Key"])
-    for f in desFilelist:
-        if f["Key"] == prefix_and_key and \
-                (srcfile["Size"] == f["Size"]):
-            return 'NEXT'  # 文件完全相同
-    # 找不到文件，或文件不一致，要重新传的
-    # 查Key是否有未完成的UploadID
-    keyIDList = []
-    for u in UploadIdList:
-        if u["Key"] == prefix_and_key:
-            keyIDList.append(u)
-    # 如果找不到上传过的Upload，则从头开始传
-    if not keyIDList:
-        return 'UPLOAD'
-    # 对同一个Key（文件）的不同Upload找出时间最晚的值
-    UploadID_latest = keyIDList[0]
-    for u in keyIDList:
-        if u["Initiated"] > UploadID_latest["Initiated"]:
-            UploadID_latest = u
-    return UploadID_latest["UploadId"]
+    def hash_worker(self, part):
+        start_time = time.time()
+        with metrics.stage('hash'):
+            part["MD5"] = hashlib.md5(part["Data"])
+            part["Checksum"] = part_checksum(part["Data"])
+        part["Seconds"] += time.time() - start_time
+        part["MD5List"][part["PartNumber"]-1] = part["MD5"].digest()
+        if part["DryRun"]:
+            part["Stack"].close()
+            part["Future"].set_result(None)
+        else:
+            self.upload_queue.put(part)
 
+    def upload_worker(self, part):
+        prefix_and_key = str(PurePosixPath(S3Prefix) / part["Key"])
+        chunkdata, chunkdata_md5 = part["Data"], part["MD5"]
+        with concurrency_controller.slot() if AdaptiveConcurrency else contextlib.nullcontext():
+            start_time = time.time()
+            parts, retryTime = upload_part_targets(part["Targets"], part["PartNumber"], prefix_and_key, chunkdata,
+                                                   chunkdata_md5, part["Checksum"])
+            part["Seconds"] += time.time() - start_time
+        record_part_stats(part["Key"], len(chunkdata), part["Seconds"], retryTime)
+        part["Stack"].close()
+        part["Future"].set_result(None)
 
-def checkPartnumberList(srcfile, uploadId):
-    try:
-        prefix_and_key = srcfile["Key"]
-        if JobType == 'LOCAL_TO_S3':
-            prefix_and_key = str(PurePosixPath(S3Prefix) / srcfile["Key"])
-        partnumberList = []
-        PartNumberMarker = 0
-        IsTruncated = True
-        while IsTruncated:
-            response_uploadedList = s3_dest_client.list_parts(
-                Bucket=DesBucket,
-                Key=prefix_and_key,
-                UploadId=uploadId,
-                MaxParts=1000,
-                PartNumberMarker=PartNumberMarker
-            )
-            NextPartNumberMarker = response_uploadedList['NextPartNumberMarker']
-            IsTruncated = response_uploadedList['IsTruncated']
-            if NextPartNumberMarker > 0:
-                for partnumberObject in response_uploadedList["Parts"]:
-                    partnumberList.append(partnumberObject["PartNumber"])
-            PartNumberMarker = NextPartNumberMarker
-        if partnumberList:  # 如果为0则表示没有查到已上传的Part
-            logger.info("Found uploaded partnumber: "+json.dumps(partnumberList))
-    except Exception as checkPartnumberList_err:
-        logger.error("checkPartnumberList_err"+json.dumps(checkPartnumberList_err))
-        sys.exit(0)
-    return partnumberList
+    # 按阶段顺序结束：前一阶段的线程都退出后，后面的队列里不会再有新分片
+    def shutdown(self):
+        for stage_queue, threads in self.stages:
+            for t in threads:
+                stage_queue.put(None)
+            for t in threads:
+                t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        return False
+
+
+part_pipeline = None
+
+
+# 可选的 S3 flexible checksum，返回 upload_part/put_object 的附加参数
+def part_checksum(chunkdata):
+    if ChecksumAlgorithm == 'SHA256':
+        digest = hashlib.sha256(chunkdata).digest()
+    elif ChecksumAlgorithm == 'CRC32C':
+        digest = crc32c.crc32c(chunkdata).to_bytes(4, 'big')
+    else:
+        return {}
+    return {
+        "ChecksumAlgorithm": ChecksumAlgorithm,
+        f"Checksum{ChecksumAlgorithm}": base64.b64encode(digest).decode('utf-8')
+    }
 
 
 # split the file into a virtual part list of index, each index is the start point of the file
-def split(srcfile):
+def split(srcfile, chunkSize):
     partnumber = 1
     indexList = [0]
-    while ChunkSize * partnumber < srcfile["Size"]: # 如果刚好是"="，则无需再分下一part，所以这里不能用"<="
-        indexList.append(ChunkSize * partnumber)
+    while chunkSize * partnumber < srcfile["Size"]: # 如果刚好是"="，则无需再分下一part，所以这里不能用"<="
+        indexList.append(chunkSize * partnumber)
         partnumber += 1
-    if partnumber > 10000:
-        logger.error(f'PART NUMBER LIMIT 10,000. YOUR FILE HAS {partnumber}. ')
-        logger.error('PLEASE CHANGE THE chunksize IN CONFIG FILE AND TRY AGAIN')
-        sys.exit(0)
     return indexList
 
 
 # upload parts in the list
-def uploadPart(uploadId, indexList, partnumberList, srcfile):
+def uploadPart(uploads, indexList, srcfile, chunkSize):
     partnumber = 1  # 当前循环要上传的Partnumber
     total = len(indexList)
-    md5list = [hashlib.md5(b'')]*total
-    complete_list = []
-    # 线程池Start
-    with futures.ThreadPoolExecutor(max_workers=MaxThread) as pool:
-        for partStartIndex in indexList:
-            # start to upload part
-            if partnumber not in partnumberList:
-                dryrun = False
-            else:
-                dryrun = True
-            # upload 1 part/thread, or dryrun to only caculate md5
-            if JobType == 'LOCAL_TO_S3':
-                pool.submit(uploadThread, uploadId, partnumber,
-                            partStartIndex, srcfile["Key"], total, md5list, dryrun, complete_list)
-            elif JobType == 'S3_TO_S3':
-                pool.submit(download_uploadThread, uploadId, partnumber,
-                            partStartIndex, srcfile["Key"], total, md5list, dryrun, complete_list)
-            elif JobType == 'ALIOSS_TO_S3':
-                pool.submit(alioss_download_uploadThread, uploadId, partnumber,
-                            partStartIndex, srcfile["Key"], srcfile["Size"], total, md5list, dryrun, complete_list)
+    md5list = [hashlib.md5(b'').digest()]*total
+    part_futures = []
+    local_reader = None
+    if JobType == 'LOCAL_TO_S3':
+        local_reader = LocalFileReader(os.path.join(SrcDir, srcfile["Key"]), use_mmap=part_pipeline is None)
+    # 所有分片提交到全局分片线程池 part_pool，与其他文件共享并发，哪个文件还有分片就给哪个文件
+    # asyncio 引擎的 part_pool 是 AsyncPartEngine，分片是事件循环里的协程，返回的同样是 concurrent.futures.Future
+    for partStartIndex in indexList:
+        # start to upload part，分片上传到还没有这个分片的目标，所有目标都已有则 dryrun
+        targets = [(u["Dest"], u["UploadId"]) for u in uploads if partnumber not in u["Parts"]]
+        dryrun = not targets
+        # 续传记录里有这个分片的 MD5，不用再读取或下载来计算
+        journalMD5 = [u["JournalParts"][partnumber]["MD5"] for u in uploads
+                      if partnumber in u["JournalParts"] and u["JournalParts"][partnumber]["MD5"]]
+        if dryrun and journalMD5:
+            md5list[partnumber-1] = bytes.fromhex(journalMD5[0])
             partnumber += 1
-    # 线程池End
+            continue
+        # upload 1 part/thread, or dryrun to only caculate md5
+        if JobType == 'LOCAL_TO_S3' and part_pipeline is not None:
+            part_futures.append(part_pipeline.submit(targets, partnumber, partStartIndex, chunkSize, srcfile["Key"],
+                                                     md5list, dryrun, local_reader))
+        elif JobType == 'LOCAL_TO_S3':
+            part_futures.append(submit_part(
+                                async_uploadThread if Engine == 'asyncio' else uploadThread,
+                                targets, partnumber,
+                                partStartIndex, chunkSize, srcfile["Key"], md5list, dryrun,
+                                local_reader))
+        elif JobType == 'S3_TO_S3' and ServerSideCopy:
+            part_futures.append(submit_part(
+                                async_copy_uploadThread if Engine == 'asyncio' else copy_uploadThread,
+                                targets, partnumber,
+                                partStartIndex, chunkSize, srcfile["Key"], srcfile["Size"], md5list, dryrun))
+        elif JobType == 'S3_TO_S3':
+            part_futures.append(submit_part(
+                                async_download_uploadThread if Engine == 'asyncio' else download_uploadThread,
+                                targets, partnumber,
+                                partStartIndex, chunkSize, srcfile["Key"], srcfile["Size"], md5list, dryrun))
+        elif JobType == 'ALIOSS_TO_S3':
+            part_futures.append(submit_part(alioss_download_uploadThread, targets, partnumber,
+                                partStartIndex, chunkSize, srcfile["Key"], srcfile["Size"], md5list, dryrun))
+        partnumber += 1
+    # 等待本文件的所有分片完成
+    futures.wait(part_futures)
+    if local_reader is not None:
+        local_reader.close()
     logger.info(f'All parts uploaded - {srcfile["Key"]} - size: {srcfile["Size"]}')
 
     # 计算所有分片列表的总etag: cal_etag
-    digests = b"".join(m.digest() for m in md5list)
+    digests = b"".join(md5list)
     md5full = hashlib.md5(digests)
     cal_etag = '"%s-%s"' % (md5full.hexdigest(), len(md5list))
     return cal_etag
 
 
+# 上传一个分片到一个目标，返回 complete_multipart_upload 需要的分片记录和重试次数
+def upload_part_to(dest, uploadId, partnumber, prefix_and_key, chunkdata, chunkdata_md5, checksum):
+    retryTime = 0
+    while retryTime <= MaxRetry:
+        try:
+            with metrics.stage('upload_part'):
+                response_upload_part = dest.client.upload_part(
+                    Body=PartReader(chunkdata),
+                    Bucket=dest.bucket,
+                    Key=prefix_and_key,
+                    PartNumber=partnumber,
+                    UploadId=uploadId,
+                    ContentMD5=base64.b64encode(chunkdata_md5.digest()).decode('utf-8'),
+                    **checksum
+                )
+            # 这里对单个part上传加了 MD5 校验，后面多part合并的时候会再做一次整个文件的
+            record_uploaded_part(dest, prefix_and_key, uploadId, partnumber, chunkdata_md5.hexdigest(),
+                                 response_upload_part["ETag"], len(chunkdata),
+                                 response_upload_part.get(f'Checksum{ChecksumAlgorithm}'))
+            break
+        except Exception as err:
+            retryTime += 1
+            logger.info(f'Upload Fail - {dest.bucket}/{prefix_and_key} - Retry part - {partnumber} - '
+                        f'Attempt - {retryTime} - {str(err)}')
+            if retryTime > MaxRetry or is_fatal_error(err):
+                logger.error(f'Quit for Max retries: {retryTime}')
+                sys.exit(0)
+            time.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
+    part = {"ETag": response_upload_part["ETag"], "PartNumber": partnumber}
+    if ChecksumAlgorithm and f'Checksum{ChecksumAlgorithm}' in response_upload_part:
+        part[f'Checksum{ChecksumAlgorithm}'] = response_upload_part[f'Checksum{ChecksumAlgorithm}']
+    return part, retryTime
+
+
+# 分片读取或下载一次，上传到 targets [(目标, UploadId)] 的每个目标：第一个在本线程，其他的同时在 fanout_pool 上传，
+# 各目标分别重试。返回 {目标Bucket: 分片记录} 和最多的重试次数，所有目标都结束后才返回，调用方才能释放分片的缓冲区
+def upload_part_targets(targets, partnumber, prefix_and_key, chunkdata, chunkdata_md5, checksum):
+    args = (partnumber, prefix_and_key, chunkdata, chunkdata_md5, checksum)
+    fanout = [fanout_pool.submit(profiler.run, upload_part_to, dest, uploadId, *args) for dest, uploadId in targets[1:]]
+    try:
+        results = [upload_part_to(targets[0][0], targets[0][1], *args)]
+    finally:
+        futures.wait(fanout)
+    results += [f.result() for f in fanout]
+    if fanout:
+        metrics.count('bytes', 'direction', 'upload', len(chunkdata) * len(fanout))
+    return ({dest.bucket: part for (dest, uploadId), (part, retries) in zip(targets, results)},
+            max(retries for part, retries in results))
+
+
+# asyncio 引擎上传一个分片到一个目标，超过最大重试次数抛出异常
+async def async_upload_part_to(dest, uploadId, partnumber, prefix_and_key, chunkdata, chunkdata_md5, checksum):
+    retryTime = 0
+    while retryTime <= MaxRetry:
+        try:
+            with metrics.stage('upload_part'):
+                response_upload_part = await part_pool.dest_clients[dest.bucket].upload_part(
+                    Body=PartReader(chunkdata),
+                    Bucket=dest.bucket,
+                    Key=prefix_and_key,
+                    PartNumber=partnumber,
+                    UploadId=uploadId,
+                    ContentMD5=base64.b64encode(chunkdata_md5.digest()).decode('utf-8'),
+                    **checksum
+                )
+            record_uploaded_part(dest, prefix_and_key, uploadId, partnumber, chunkdata_md5.hexdigest(),
+                                 response_upload_part["ETag"], len(chunkdata),
+                                 response_upload_part.get(f'Checksum{ChecksumAlgorithm}'))
+            return retryTime
+        except Exception as err:
+            retryTime += 1
+            logger.info(f'Upload Fail - {dest.bucket}/{prefix_and_key} - Retry part - {partnumber} - '
+                        f'Attempt - {retryTime} - {str(err)}')
+            if retryTime > MaxRetry or is_fatal_error(err):
+                logger.error(f'Quit for Max retries: {retryTime}')
+                raise
+            await asyncio.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
+
+
+# asyncio 引擎把一个分片同时上传到 targets 的每个目标，所有目标都结束后才返回最多的重试次数，有失败的则抛出
+async def async_upload_part_targets(targets, partnumber, prefix_and_key, chunkdata, chunkdata_md5, checksum):
+    results = await asyncio.gather(*(async_upload_part_to(dest, uploadId, partnumber, prefix_and_key, chunkdata,
+                                                          chunkdata_md5, checksum)
+                                     for dest, uploadId in targets), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    if len(targets) > 1:
+        metrics.count('bytes', 'direction', 'upload', len(chunkdata) * (len(targets) - 1))
+    return max(results)
+
+
 # Single Thread Upload one part, from local to s3
-def uploadThread(uploadId, partnumber, partStartIndex, srcfileKey, total, md5list, dryrun, complete_list):
+def uploadThread(targets, partnumber, partStartIndex, chunkSize, srcfileKey, md5list, dryrun, local_reader):
     prefix_and_key = str(PurePosixPath(S3Prefix) / srcfileKey)
-    if not dryrun:
-        print(f'\033[0;32;1m--->Uploading\033[0m {srcfileKey} - {partnumber}/{total}')
-    with open(os.path.join(SrcDir, srcfileKey), 'rb') as data:
-        retryTime = 0
-        while retryTime <= MaxRetry:
-            try:
-                data.seek(partStartIndex)
-                chunkdata = data.read(ChunkSize)
-                chunkdata_md5 = hashlib.md5(chunkdata)
-                md5list[partnumber-1] = chunkdata_md5
+    part_start_time = time.time()
+    retryTime = 0
+    while retryTime <= MaxRetry:
+        try:
+            # chunkdata 是 mmap 或缓冲区的 memoryview，MD5 和 upload_part 都直接读它，不复制整个分片
+            with local_reader.part(partStartIndex, chunkSize) as chunkdata:
+                chunkdata_len = len(chunkdata)
+                with metrics.stage('hash'):  # mmap 的页在计算 MD5 时才从磁盘读入
+                    chunkdata_md5 = hashlib.md5(chunkdata)
+                    checksum = part_checksum(chunkdata)
+                md5list[partnumber-1] = chunkdata_md5.digest()
                 if not dryrun:
-                    s3_dest_client.upload_part(
-                        Body=chunkdata,
-                        Bucket=DesBucket,
-                        Key=prefix_and_key,
-                        PartNumber=partnumber,
-                        UploadId=uploadId,
-                        ContentMD5=base64.b64encode(chunkdata_md5.digest()).decode('utf-8')
-                    )
-                    # 这里对单个part上传加了 MD5 校验，后面多part合并的时候会再做一次整个文件的
-                break
-            except Exception as err:
-                retryTime += 1
-                logger.info(f'UploadThreadFunc log: {srcfileKey} - {str(err)}')
-                logger.info(f'Upload Fail - {srcfileKey} - Retry part - {partnumber} - Attempt - {retryTime}')
-                if retryTime > MaxRetry:
-                    logger.error(f'Quit for Max retries: {retryTime}')
-                    sys.exit(0)
-                time.sleep(5*retryTime)  # 递增延迟重试
-    complete_list.append(partnumber)
+                    parts, upload_retries = upload_part_targets(targets, partnumber, prefix_and_key, chunkdata,
+                                                                chunkdata_md5, checksum)
+                    retryTime += upload_retries
+            break
+        except Exception as err:
+            retryTime += 1
+            logger.info(f'UploadThreadFunc log: {srcfileKey} - {str(err)}')
+            logger.info(f'Read Fail - {srcfileKey} - Retry part - {partnumber} - Attempt - {retryTime}')
+            if retryTime > MaxRetry or is_fatal_error(err):
+                logger.error(f'Quit for Max retries: {retryTime}')
+                sys.exit(0)
+            time.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
     if not dryrun:
-        print(f'\033[0;34;1m    --->Complete\033[0m {srcfileKey} '
-              f'- {partnumber}/{total} \033[0;34;1m{len(complete_list)/total:.2%}\033[0m')
+        record_part_stats(srcfileKey, chunkdata_len, time.time() - part_start_time, retryTime)
     return
 
 
 # download part from src. s3 and upload to dest. s3
-def download_uploadThread(uploadId, partnumber, partStartIndex, srcfileKey, total, md5list, dryrun, complete_list):
+def download_uploadThread(targets, partnumber, partStartIndex, chunkSize, srcfileKey, srcfileSize, md5list, dryrun):
+    part_start_time = time.time()
+    part_retries = 0
     if ifVerifyMD5 or not dryrun:
-        # 下载文件
-        if not dryrun:
-            print(f"\033[0;33;1m--->Downloading\033[0m {srcfileKey} - {partnumber}/{total}")
-        else:
-            print(f"\033[0;33;40m--->Downloading for verify MD5\033[0m {srcfileKey} - {partnumber}/{total}")
-        retryTime = 0
-        while retryTime <= MaxRetry:
-            try:
-                response_get_object = s3_src_client.get_object(
-                    Bucket=SrcBucket,
-                    Key=srcfileKey,
-                    Range="bytes="+str(partStartIndex)+"-"+str(partStartIndex+ChunkSize-1)
-                    )
-                getBody = response_get_object["Body"].read()
-                chunkdata_md5 = hashlib.md5(getBody)
-                md5list[partnumber-1] = chunkdata_md5
-                break
-            except Exception as err:
-                retryTime += 1
-                logger.warning(f"DownloadThreadFunc - {srcfileKey} - Exception log: {str(err)}")
-                logger.warning(f"Download part fail, retry part: {partnumber} Attempts: {retryTime}")
-                if retryTime > MaxRetry:
-                    logger.error(f"Quit for Max Download retries: {retryTime}")
-                    sys.exit(0)
-                time.sleep(5*retryTime)  # 递增延迟重试
-    if not dryrun:
-        # 上传文件
-        print(f'\033[0;32;1m    --->Uploading\033[0m {srcfileKey} - {partnumber}/{total}')
-        retryTime = 0
-        while retryTime <= MaxRetry:
-            try:
-                s3_dest_client.upload_part(
-                    Body=getBody,
-                    Bucket=DesBucket,
-                    Key=srcfileKey,
-                    PartNumber=partnumber,
-                    UploadId=uploadId,
-                    ContentMD5=base64.b64encode(chunkdata_md5.digest()).decode('utf-8')
-                )
-                break
-            except Exception as err:
-                retryTime += 1
-                logger.warning(f"UploadThreadFunc - {srcfileKey} - Exception log: {str(err)}")
-                logger.warning(f"Upload part fail, retry part: {partnumber} Attempts: {retryTime}")
-                if retryTime > MaxRetry:
-                    logger.error(f"Quit for Max Download retries: {retryTime}")
-                    sys.exit(0)
-                time.sleep(5*retryTime)  # 递增延迟重试
-    complete_list.append(partnumber)
+        partSize = min(chunkSize, srcfileSize - partStartIndex)
+        # 分片下载到缓冲池的 bytearray 里，缓冲区总大小受 MaxMemoryBuffer 限制，超出则等待
+        with buffer_pool.buffer(chunkSize) as buf:
+            # 下载文件
+            retryTime = 0
+            while retryTime <= MaxRetry:
+                try:
+                    with metrics.stage('download'):
+                        response_get_object = s3_src_client.get_object(
+                            Bucket=SrcBucket,
+                            Key=srcfileKey,
+                            Range="bytes="+str(partStartIndex)+"-"+str(partStartIndex+chunkSize-1)
+                            )
+                        getBody, chunkdata_md5 = read_part_body(
+                            response_get_object["Body"].iter_chunks(chunk_size=Megabytes), buf, partSize)
+                    metrics.count('bytes', 'direction', 'download', len(getBody))
+                    md5list[partnumber-1] = chunkdata_md5.digest()
+                    break
+                except Exception as err:
+                    retryTime += 1
+                    logger.warning(f"DownloadThreadFunc - {srcfileKey} - Exception log: {str(err)}")
+                    logger.warning(f"Download part fail, retry part: {partnumber} Attempts: {retryTime}")
+                    if retryTime > MaxRetry or is_fatal_error(err):
+                        logger.error(f"Quit for Max Download retries: {retryTime}")
+                        sys.exit(0)
+                    time.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
+            part_retries += retryTime
+            if not dryrun:
+                # 上传文件，下载一次上传到所有目标
+                parts, retryTime = upload_part_targets(targets, partnumber, srcfileKey, getBody, chunkdata_md5, {})
+                part_retries += retryTime
+                record_part_stats(srcfileKey, len(getBody), time.time() - part_start_time, part_retries)
+    return
+
+
+# 把下载流逐块写入预分配的缓冲区，边收边算 MD5，返回已写入部分的 memoryview 和 MD5
+def read_part_body(stream, buf, partSize):
+    chunkdata_md5 = hashlib.md5()
+    view = memoryview(buf)
+    n = 0
+    for chunk in stream:
+        if n + len(chunk) > partSize:
+            raise Exception(f'Part body larger than expected size {partSize}')
+        view[n:n+len(chunk)] = chunk
+        chunkdata_md5.update(chunk)
+        n += len(chunk)
+    if n != partSize:
+        raise Exception(f'Part body size {n} not match expected size {partSize}')
+    return view[:n], chunkdata_md5
+
+
+# server-side copy part from src. s3 to dest. s3 by upload_part_copy, data does not pass through this host
+def copy_uploadThread(targets, partnumber, partStartIndex, chunkSize, srcfileKey, srcfileSize, md5list, dryrun):
     if not dryrun:
-        print(f'\033[0;34;1m        --->Complete\033[0m {srcfileKey} '
-              f'- {partnumber}/{total} \033[0;34;1m{len(complete_list)/total:.2%}\033[0m')
+        part_start_time = time.time()
+        # CopySourceRange 不能超出源文件范围，最后一个Part的结尾要改为FileSize-1
+        partEndIndex = min(partStartIndex+chunkSize, srcfileSize) - 1
+        part_retries = 0
+        # 每个目标分别从源 Bucket 服务端拷贝
+        for dest, uploadId in targets:
+            retryTime = 0
+            while retryTime <= MaxRetry:
+                try:
+                    with metrics.stage('copy_part'):
+                        response_copy_part = dest.client.upload_part_copy(
+                            Bucket=dest.bucket,
+                            Key=srcfileKey,
+                            PartNumber=partnumber,
+                            UploadId=uploadId,
+                            CopySource={"Bucket": SrcBucket, "Key": srcfileKey},
+                            CopySourceRange="bytes="+str(partStartIndex)+"-"+str(partEndIndex)
+                        )
+                    logger.debug(f'Copied part {srcfileKey} - {partnumber} - {response_copy_part["CopyPartResult"]["ETag"]}')
+                    # 服务端拷贝没有本地计算的 MD5
+                    record_uploaded_part(dest, srcfileKey, uploadId, partnumber, None,
+                                         response_copy_part["CopyPartResult"]["ETag"],
+                                         partEndIndex - partStartIndex + 1)
+                    break
+                except Exception as err:
+                    retryTime += 1
+                    logger.warning(f"CopyThreadFunc - {srcfileKey} - Exception log: {str(err)}")
+                    logger.warning(f"Copy part fail, retry part: {partnumber} Attempts: {retryTime}")
+                    if retryTime > MaxRetry or is_fatal_error(err):
+                        logger.error(f"Quit for Max Copy retries: {retryTime}")
+                        sys.exit(0)
+                    time.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
+            part_retries += retryTime
+        record_part_stats(srcfileKey, partEndIndex - partStartIndex + 1, time.time() - part_start_time, part_retries)
     return
 
 
 # download part from src. ali_oss and upload to dest. s3
-def alioss_download_uploadThread(uploadId, partnumber, partStartIndex, srcfileKey, srcfileSize, total, md5list, dryrun, complete_list):
+def alioss_download_uploadThread(targets, partnumber, partStartIndex, chunkSize, srcfileKey, srcfileSize, md5list, dryrun):
+    part_start_time = time.time()
+    part_retries = 0
     if ifVerifyMD5 or not dryrun:
-        # 下载文件
-        if not dryrun:
-            print(f"\033[0;33;1m--->Downloading\033[0m {srcfileKey} - {partnumber}/{total}")
-        else:
-            print(f"\033[0;33;40m--->Downloading for verify MD5\033[0m {srcfileKey} - {partnumber}/{total}")
-        retryTime = 0
-        while retryTime <= MaxRetry:
+        partSize = min(chunkSize, srcfileSize - partStartIndex)
+        # 分片下载到缓冲池的 bytearray 里，缓冲区总大小受 MaxMemoryBuffer 限制，超出则等待
+        with buffer_pool.buffer(chunkSize) as buf:
+            # 下载文件
+            retryTime = 0
+            while retryTime <= MaxRetry:
+                try:
+                    partEndIndex = partStartIndex+partSize-1
+                    # Ali OSS 如果range结尾超出范围会变成从头开始下载全部(什么脑子？)，所以必须人工修改为FileSize-1
+                    # 而S3或本地硬盘超出范围只会把结尾指针改为最后一个字节
+                    with metrics.stage('download'):
+                        response_get_object = ali_bucket.get_object(
+                            key=srcfileKey,
+                            byte_range=(partStartIndex, partEndIndex)
+                            )
+                        getBody, chunkdata_md5 = read_part_body(response_get_object, buf, partSize)
+                    metrics.count('bytes', 'direction', 'download', len(getBody))
+                    md5list[partnumber-1] = chunkdata_md5.digest()
+                    break
+                except Exception as err:
+                    retryTime += 1
+                    logger.warning(f"DownloadThreadFunc - {srcfileKey} - Exception log: {str(err)}")
+                    logger.warning(f"Download part fail, retry part: {partnumber} Attempts: {retryTime}")
+                    if retryTime > MaxRetry or is_fatal_error(err):
+                        logger.error(f"Quit for Max Download retries: {retryTime}")
+                        sys.exit(0)
+                    time.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
+            part_retries += retryTime
+            if not dryrun:
+                # 上传文件，下载一次上传到所有目标
+                parts, retryTime = upload_part_targets(targets, partnumber, srcfileKey, getBody, chunkdata_md5, {})
+                part_retries += retryTime
+                record_part_stats(srcfileKey, len(getBody), time.time() - part_start_time, part_retries)
+    return
+
+
+# 没有安装 aiobotocore 时，asyncio 引擎用线程池执行同步 boto3 client 的请求，接口与 aiobotocore 的 client 相同
+class ExecutorS3Client:
+    def __init__(self, client, executor):
+        self.client = client
+        self.executor = executor
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        async def call(**kwargs):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(method, **kwargs))
+        return call
+
+
+# asyncio 分片引擎：事件循环在单独的线程里运行，接口与 ThreadPoolExecutor 相同，作为 part_pool 使用
+# upload_file 仍是每个文件一个线程，但分片不占线程，是事件循环里的协程，同时在途的分片数由 MaxAsyncPart 控制
+# S3 请求用 aiobotocore 的异步 client；MD5、读本地文件等阻塞操作放到默认线程池执行
+class AsyncPartEngine:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=profiler.run, args=(self.loop.run_forever,), daemon=True)
+        self.thread.start()
+        # 同步的分片函数(ALIOSS_TO_S3)和没有 aiobotocore 时的 S3 请求在这个线程池执行
+        self.sync_executor = futures.ThreadPoolExecutor(max_workers=MaxParallelFile * MaxThread)
+        self.native = AioSession is not None
+        self.exit_stack = None
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    async def start(self):
+        self.semaphore = asyncio.Semaphore(MaxAsyncPart)
+        self.exit_stack = contextlib.AsyncExitStack()
+        self.dest_clients = {}  # {目标Bucket: client}
+        self.src_client = None
+        if not self.native:
+            logger.warning(f'aiobotocore is not installed, asyncio engine sends S3 requests '
+                           f'with {MaxParallelFile * MaxThread} threads')
+            for dest in destinations:
+                self.dest_clients[dest.bucket] = ExecutorS3Client(dest.client, self.sync_executor)
+            if JobType == 'S3_TO_S3':
+                self.src_client = ExecutorS3Client(s3_src_client, self.sync_executor)
+            return
+        aio_config = AioConfig(max_pool_connections=MaxAsyncPart)
+        for dest in destinations:
+            self.dest_clients[dest.bucket] = await self.exit_stack.enter_async_context(
+                AioSession(profile=dest.profile).create_client('s3', config=aio_config))
+        if JobType == 'S3_TO_S3':
+            self.src_client = await self.exit_stack.enter_async_context(
+                AioSession(profile=SrcProfileName).create_client('s3', config=aio_config))
+        logger.info(f'Asyncio engine started, max {MaxAsyncPart} parts in flight')
+
+    def submit(self, part_func, *args):
+        return asyncio.run_coroutine_threadsafe(self.run_part(part_func, *args), self.loop)
+
+    async def run_part(self, part_func, *args):
+        async with self.semaphore:
+            # AdaptiveConcurrency 时还要占用 concurrency_controller 的名额，不能阻塞事件循环，轮询等待
+            while AdaptiveConcurrency and not concurrency_controller.try_acquire():
+                await asyncio.sleep(0.05)
             try:
-                partEndIndex = partStartIndex+ChunkSize-1
-                if partEndIndex > srcfileSize:
-                    partEndIndex = srcfileSize-1
-                # Ali OSS 如果range结尾超出范围会变成从头开始下载全部(什么脑子？)，所以必须人工修改为FileSize-1
-                # 而S3或本地硬盘超出范围只会把结尾指针改为最后一个字节
-                response_get_object = ali_bucket.get_object(
-                    key=srcfileKey,
-                    byte_range=(partStartIndex, partEndIndex)
-                    )
-                getBody = b''
-                for chunk in response_get_object:
-                    getBody += chunk
-                chunkdata_md5 = hashlib.md5(getBody)
-                md5list[partnumber-1] = chunkdata_md5
-                break
-            except Exception as err:
-                retryTime += 1
-                logger.warning(f"DownloadThreadFunc - {srcfileKey} - Exception log: {str(err)}")
-                logger.warning(f"Download part fail, retry part: {partnumber} Attempts: {retryTime}")
-                if retryTime > MaxRetry:
-                    logger.error(f"Quit for Max Download retries: {retryTime}")
-                    sys.exit(0)
-                time.sleep(5*retryTime)  # 递增延迟重试
-    if not dryrun:
-        # 上传文件
-        print(f'\033[0;32;1m    --->Uploading\033[0m {srcfileKey} - {partnumber}/{total}')
+                if asyncio.iscoroutinefunction(part_func):
+                    return await part_func(*args)
+                return await self.loop.run_in_executor(self.sync_executor, part_func, *args)
+            except SystemExit:
+                # 同步的分片函数重试用尽会 sys.exit，SystemExit 传到事件循环会结束循环，其他分片永远等不到结果
+                raise Exception('part upload quit for max retries')
+            finally:
+                if AdaptiveConcurrency:
+                    concurrency_controller.release()
+
+    # 把 get_object 的 Body 读入缓冲区并计算 MD5，同 read_part_body
+    async def read_body(self, body, buf, partSize):
+        if not self.native:
+            return await self.loop.run_in_executor(
+                self.sync_executor, read_part_body, body.iter_chunks(chunk_size=Megabytes), buf, partSize)
+        view = memoryview(buf)
+        n = 0
+        async with body as stream:
+            async for chunk in stream.iter_chunks(Megabytes):
+                if n + len(chunk) > partSize:
+                    raise Exception(f'Part body larger than expected size {partSize}')
+                view[n:n+len(chunk)] = chunk
+                n += len(chunk)
+        if n != partSize:
+            raise Exception(f'Part body size {n} not match expected size {partSize}')
+        return view[:n], await self.loop.run_in_executor(None, hashlib.md5, view[:n])
+
+    async def close(self):
+        await self.exit_stack.aclose()
+
+    def shutdown(self, wait=True):
+        asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+        self.sync_executor.shutdown(wait=wait)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
+
+
+# 在线程池里从本地文件取一个分片并计算 MD5，分片的 memoryview 由 stack 负责在上传完后释放
+def read_local_part(stack, local_reader, partStartIndex, chunkSize):
+    chunkdata = stack.enter_context(local_reader.part(partStartIndex, chunkSize))
+    with metrics.stage('hash'):
+        return chunkdata, hashlib.md5(chunkdata), part_checksum(chunkdata)
+
+
+# asyncio 引擎不能阻塞事件循环等待内存预算，轮询直到 buffer_pool 有预算
+async def async_buffer_get(size):
+    while True:
+        buf = buffer_pool.get(size, block=False)
+        if buf is not None:
+            return buf
+        await asyncio.sleep(0.05)
+
+
+# asyncio 引擎 Upload one part, from local to s3。超过最大重试次数抛出异常，由 completeUpload 检查分片数不符退出
+async def async_uploadThread(targets, partnumber, partStartIndex, chunkSize, srcfileKey, md5list, dryrun, local_reader):
+    prefix_and_key = str(PurePosixPath(S3Prefix) / srcfileKey)
+    part_start_time = time.time()
+    with contextlib.ExitStack() as stack:
         retryTime = 0
         while retryTime <= MaxRetry:
             try:
-                s3_dest_client.upload_part(
-                    Body=getBody,
-                    Bucket=DesBucket,
-                    Key=srcfileKey,
-                    PartNumber=partnumber,
-                    UploadId=uploadId,
-                    ContentMD5=base64.b64encode(chunkdata_md5.digest()).decode('utf-8')
-                )
+                chunkdata, chunkdata_md5, checksum = await part_pool.loop.run_in_executor(
+                    None, read_local_part, stack, local_reader, partStartIndex, chunkSize)
                 break
             except Exception as err:
                 retryTime += 1
-                logger.warning(f"UploadThreadFunc - {srcfileKey} - Exception log: {str(err)}")
-                logger.warning(f"Upload part fail, retry part: {partnumber} Attempts: {retryTime}")
-                if retryTime > MaxRetry:
-                    logger.error(f"Quit for Max Download retries: {retryTime}")
-                    sys.exit(0)
-                time.sleep(5*retryTime)  # 递增延迟重试
-    complete_list.append(partnumber)
+                logger.info(f'UploadThreadFunc log: {srcfileKey} - {str(err)}')
+                logger.info(f'Read Fail - {srcfileKey} - Retry part - {partnumber} - Attempt - {retryTime}')
+                if retryTime > MaxRetry or is_fatal_error(err):
+                    logger.error(f'Quit for Max retries: {retryTime}')
+                    raise
+                await asyncio.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
+        chunkdata_len = len(chunkdata)
+        md5list[partnumber-1] = chunkdata_md5.digest()
+        if not dryrun:
+            # 上传的重试在 async_upload_part_targets 里按目标分别进行
+            retryTime += await async_upload_part_targets(targets, partnumber, prefix_and_key, chunkdata,
+                                                         chunkdata_md5, checksum)
+    if not dryrun:
+        record_part_stats(srcfileKey, chunkdata_len, time.time() - part_start_time, retryTime)
+    return
+
+
+# asyncio 引擎 download part from src. s3 and upload to dest. s3
+async def async_download_uploadThread(targets, partnumber, partStartIndex, chunkSize, srcfileKey, srcfileSize,
+                                      md5list, dryrun):
+    part_start_time = time.time()
+    part_retries = 0
+    if ifVerifyMD5 or not dryrun:
+        partSize = min(chunkSize, srcfileSize - partStartIndex)
+        buf = await async_buffer_get(chunkSize)
+        try:
+            # 下载文件
+            retryTime = 0
+            while retryTime <= MaxRetry:
+                try:
+                    with metrics.stage('download'):
+                        response_get_object = await part_pool.src_client.get_object(
+                            Bucket=SrcBucket,
+                            Key=srcfileKey,
+                            Range="bytes="+str(partStartIndex)+"-"+str(partStartIndex+chunkSize-1)
+                            )
+                        getBody, chunkdata_md5 = await part_pool.read_body(response_get_object["Body"], buf, partSize)
+                    metrics.count('bytes', 'direction', 'download', len(getBody))
+                    md5list[partnumber-1] = chunkdata_md5.digest()
+                    break
+                except Exception as err:
+                    retryTime += 1
+                    logger.warning(f"DownloadThreadFunc - {srcfileKey} - Exception log: {str(err)}")
+                    logger.warning(f"Download part fail, retry part: {partnumber} Attempts: {retryTime}")
+                    if retryTime > MaxRetry or is_fatal_error(err):
+                        logger.error(f"Quit for Max Download retries: {retryTime}")
+                        raise
+                    await asyncio.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
+            part_retries += retryTime
+            if not dryrun:
+                # 上传文件，下载一次同时上传到所有目标
+                part_retries += await async_upload_part_targets(targets, partnumber, srcfileKey, getBody,
+                                                                chunkdata_md5, {})
+                record_part_stats(srcfileKey, len(getBody), time.time() - part_start_time, part_retries)
+        finally:
+            buffer_pool.put(buf)
+    return
+
+
+# asyncio 引擎 server-side copy part from src. s3 to dest. s3 by upload_part_copy
+async def async_copy_uploadThread(targets, partnumber, partStartIndex, chunkSize, srcfileKey, srcfileSize,
+                                  md5list, dryrun):
     if not dryrun:
-        print(f'\033[0;34;1m        --->Complete\033[0m {srcfileKey} '
-              f'- {partnumber}/{total} \033[0;34;1m{len(complete_list)/total:.2%}\033[0m')
+        part_start_time = time.time()
+        # CopySourceRange 不能超出源文件范围，最后一个Part的结尾要改为FileSize-1
+        partEndIndex = min(partStartIndex+chunkSize, srcfileSize) - 1
+        part_retries = 0
+        # 每个目标分别从源 Bucket 服务端拷贝
+        for dest, uploadId in targets:
+            retryTime = 0
+            while retryTime <= MaxRetry:
+                try:
+                    with metrics.stage('copy_part'):
+                        response_copy_part = await part_pool.dest_clients[dest.bucket].upload_part_copy(
+                            Bucket=dest.bucket,
+                            Key=srcfileKey,
+                            PartNumber=partnumber,
+                            UploadId=uploadId,
+                            CopySource={"Bucket": SrcBucket, "Key": srcfileKey},
+                            CopySourceRange="bytes="+str(partStartIndex)+"-"+str(partEndIndex)
+                        )
+                    # 服务端拷贝没有本地计算的 MD5
+                    record_uploaded_part(dest, srcfileKey, uploadId, partnumber, None,
+                                         response_copy_part["CopyPartResult"]["ETag"],
+                                         partEndIndex - partStartIndex + 1)
+                    break
+                except Exception as err:
+                    retryTime += 1
+                    logger.warning(f"CopyThreadFunc - {srcfileKey} - Exception log: {str(err)}")
+                    logger.warning(f"Copy part fail, retry part: {partnumber} Attempts: {retryTime}")
+                    if retryTime > MaxRetry or is_fatal_error(err):
+                        logger.error(f"Quit for Max Copy retries: {retryTime}")
+                        raise
+                    await asyncio.sleep(retry_backoff(err, retryTime))  # 指数退避加随机抖动
+            part_retries += retryTime
+        record_part_stats(srcfileKey, partEndIndex - partStartIndex + 1, time.time() - part_start_time, part_retries)
     return
 
 
 # Complete multipart upload
 # 通过查询回来的所有Part列表uploadedListParts来构建completeStructJSON
-def completeUpload(reponse_uploadId, srcfileKey, len_indexList):
-    # 查询S3的所有Part列表uploadedListParts构建completeStructJSON
+def completeUpload(dest, reponse_uploadId, srcfileKey, len_indexList):
+    # 用内存里的分片记录构建completeStructJSON，记录不全(如续传记录没有校验和)才查询S3的所有Part列表
     prefix_and_key = srcfileKey
     if JobType == 'LOCAL_TO_S3':
         prefix_and_key = str(PurePosixPath(S3Prefix) / srcfileKey)
-    uploadedListPartsClean = []
-    PartNumberMarker = 0
-    IsTruncated = True
-    while IsTruncated:
-        response_uploadedList = s3_dest_client.list_parts(
-            Bucket=DesBucket,
-            Key=prefix_and_key,
-            UploadId=reponse_uploadId,
-            MaxParts=1000,
-            PartNumberMarker=PartNumberMarker
-        )
-        NextPartNumberMarker = response_uploadedList['NextPartNumberMarker']
-        IsTruncated = response_uploadedList['IsTruncated']
-        if NextPartNumberMarker > 0:
-            for partObject in response_uploadedList["Parts"]:
-                ETag = partObject["ETag"]
-                PartNumber = partObject["PartNumber"]
-                addup = {
-                    "ETag": ETag,
-                    "PartNumber": PartNumber
-                }
-                uploadedListPartsClean.append(addup)
-        PartNumberMarker = NextPartNumberMarker
-    if len(uploadedListPartsClean) != len_indexList:
+    partNumbers = range(1, len_indexList + 1)
+    checksumKey = f'Checksum{ChecksumAlgorithm}' if JobType == 'LOCAL_TO_S3' and ChecksumAlgorithm else None
+    uploadedParts = part_ledger.parts(dest.bucket, reponse_uploadId)
+    if any(n not in uploadedParts or (checksumKey and checksumKey not in uploadedParts[n]) for n in partNumbers):
+        logger.info(f'Part records incomplete, list parts - {dest.bucket}/{prefix_and_key}')
+        uploadedParts = list_uploaded_parts(dest, prefix_and_key, reponse_uploadId, -(-len_indexList // 1000))
+    if any(n not in uploadedParts for n in partNumbers):
         logger.warning(f'Uploaded parts size not match - {srcfileKey}')
         sys.exit(0)
+    uploadedListPartsClean = []
+    uploadedSize = 0
+    for PartNumber in partNumbers:
+        partObject = uploadedParts[PartNumber]
+        uploadedSize += partObject["Size"]
+        addup = {
+            "ETag": partObject["ETag"],
+            "PartNumber": PartNumber
+        }
+        if checksumKey and checksumKey in partObject:
+            addup[checksumKey] = partObject[checksumKey]
+        uploadedListPartsClean.append(addup)
     completeStructJSON = {"Parts": uploadedListPartsClean}
 
     # S3合并multipart upload任务
-    response_complete = s3_dest_client.complete_multipart_upload(
-        Bucket=DesBucket,
-        Key=prefix_and_key,
-        UploadId=reponse_uploadId,
-        MultipartUpload=completeStructJSON
-    )
+    with metrics.stage('complete'):
+        response_complete = dest.client.complete_multipart_upload(
+            Bucket=dest.bucket,
+            Key=prefix_and_key,
+            UploadId=reponse_uploadId,
+            MultipartUpload=completeStructJSON
+        )
+    transfer_ledger.completed(dest.bucket, prefix_and_key, uploadedSize, response_complete["ETag"])
     logger.info(f'Complete merge file {srcfileKey}')
     return response_complete
 
 
-def compare_local_to_s3():
-    logger.info('Comparing destination and source ...')
-    fileList = get_local_file_list()
-    desFilelist = get_s3_file_list(s3_dest_client, DesBucket)
-    deltaList = []
-    for source_file in fileList:
-        match = False
-        for destination_file in desFilelist:
-            if (str((PurePosixPath(S3Prefix) / source_file["Key"])) == destination_file["Key"]) and \
-                    (source_file["Size"] == destination_file["Size"]):
-                match = True  # source 在 destination找到，并且Size一致
-                break
-        if not match:
-            deltaList.append(source_file)
+# 输出比较结果
+def report_delta(deltaList):
     if not deltaList:
         logger.warning('All source files are in destination Bucket/Prefix. Job well done.')
     else:
         logger.warning(f'There are {len(deltaList)} files not in destination or not the same size. List:')
         for delta_file in deltaList:
-            logger.warning(str(delta_file))
-    return
+            logger.warning(json.dumps(delta_file, default=str))
+
+
+# 不一致的文件加入比较结果，多个目标时标出是哪个目标
+def delta_entry(dest, srcfile):
+    if len(destinations) > 1:
+        return {**srcfile, "DesBucket": dest.bucket}
+    return srcfile
+
+
+# 比较源和目标，返回不一致的文件列表和比较的源文件数，分片模式下只比较本 shard 的文件
+def compare_local_to_s3():
+    logger.info('Comparing destination and source ...')
+    fileList = [f for f in get_local_file_list() if src_in_shard(f)]
+    deltaList = []
+    for dest in destinations:
+        desFileIndex = build_des_file_index(get_s3_file_list(dest.client, dest.bucket))
+        if PackSmallFiles:
+            desFileIndex = {**load_pack_index(desFileIndex), **desFileIndex}  # 打包的文件按包索引比较
+        for source_file in fileList:
+            prefix_and_key = str(PurePosixPath(S3Prefix) / source_file["Key"])
+            destination_file = desFileIndex.get(prefix_and_key)
+            if destination_file is not None and Compression and source_file["Size"] != destination_file["Size"]:
+                destination_file = {"Size": uncompressed_size(dest, prefix_and_key, destination_file["Size"])}
+            if destination_file is None or source_file["Size"] != destination_file["Size"]:
+                deltaList.append(delta_entry(dest, source_file))  # source 在 destination找不到，或Size不一致
+    report_delta(deltaList)
+    return deltaList, len(fileList)
 
 
 def compare_buckets():
@@ -629,117 +3124,501 @@ def compare_buckets():
             fileList = get_ali_oss_file_list(ali_bucket)
         else:
             fileList = head_oss_single_file(ali_bucket)
-    desFilelist = get_s3_file_list(s3_dest_client, DesBucket)
+    fileList = [f for f in fileList if src_in_shard(f)]
     deltaList = []
-    for source_file in fileList:
-        match = False
-        for destination_file in desFilelist:
-            if source_file == destination_file:
-                match = True  # source 在 destination找到，并且Size一致
-                break
-        if not match:
-            deltaList.append(source_file)
-    if not deltaList:
-        logger.warning('All source files are in destination Bucket/Prefix. Job well done.')
-    else:
-        logger.warning(f'There are {len(deltaList)} files not in destination or not the same size. List:')
-        for delta_file in deltaList:
-            logger.warning(json.dumps(delta_file))
-    return
+    for dest in destinations:
+        desFileIndex = build_des_file_index(get_s3_file_list(dest.client, dest.bucket))
+        for source_file in fileList:
+            destination_file = desFileIndex.get(source_file["Key"])
+            if destination_file is not None and Compression and source_file["Size"] != destination_file["Size"]:
+                destination_file = {"Size": uncompressed_size(dest, source_file["Key"], destination_file["Size"])}
+            if destination_file is None or source_file["Size"] != destination_file["Size"]:
+                deltaList.append(delta_entry(dest, source_file))  # source 在 destination找不到，或Size不一致
+    report_delta(deltaList)
+    return deltaList, len(fileList)
+
+
+# 默认的结束校验：源列表里每个文件在本次运行中都有完成或跳过记录且大小一致的即通过，
+# 只有失败、没有记录、大小不符的文件 head 目标确认，不再重新列出源和目标。多个目标时每个目标分别校验
+def verify_from_ledger():
+    logger.info('Verifying destination from transfer ledger ...')
+    if not transfer_ledger.listing_complete:
+        logger.error('Source file list did not finish, can not verify from transfer ledger')
+        raise TransferError('Source file list not complete')
+    deltaList = []
+    for dest in destinations:
+        unconfirmed = transfer_ledger.unconfirmed(dest.bucket)
+        for prefix_and_key, srcfile in unconfirmed:
+            try:
+                with metrics.stage('head'):
+                    response_head = dest.client.head_object(Bucket=dest.bucket, Key=prefix_and_key)
+                des_size = int(response_head.get("Metadata", {}).get(CompressSizeMeta, response_head["ContentLength"]))
+            except Exception as err:
+                logger.info(f'Head destination fail - {dest.bucket}/{prefix_and_key} - {str(err)}')
+                des_size = None
+            if des_size != srcfile["Size"]:
+                deltaList.append(delta_entry(dest, srcfile))  # source 在 destination找不到，或Size不一致
+        logger.info(f'{dest.bucket}: {transfer_ledger.listed_count - len(unconfirmed)} files confirmed by ledger, '
+                    f'{len(unconfirmed)} checked by head_object')
+    report_delta(deltaList)
+    return deltaList, transfer_ledger.listed_count
+
+
+# 各 shard 的结果写在目标 Bucket 里，多主机之间除了目标 Bucket 不需要共享任何东西
+def shard_result_key(shard_index):
+    return str(PurePosixPath(S3Prefix) / 's3_upload_shards' / f'shard-{shard_index}-of-{ShardCount}.json')
+
+
+def save_shard_result(deltaList, source_count, spent_time):
+    s3_dest_client.put_object(
+        Bucket=DesBucket,
+        Key=shard_result_key(ShardIndex),
+        Body=json.dumps({
+            "ShardIndex": ShardIndex,
+            "ShardCount": ShardCount,
+            "SourceFiles": source_count,
+            "SpentTime": spent_time,
+            "Delta": deltaList
+        }, default=str)
+    )
+    logger.info(f'Shard {ShardIndex}/{ShardCount} result saved to {DesBucket}/{shard_result_key(ShardIndex)}')
+
+
+def load_shard_result(shard_index):
+    try:
+        response_get_object = s3_dest_client.get_object(Bucket=DesBucket, Key=shard_result_key(shard_index))
+    except Exception as err:
+        logger.debug(f'Shard {shard_index} result not found - {str(err)}')
+        return None
+    return json.loads(response_get_object["Body"].read())
+
+
+# 分片模式的协调进程：在本机为每个 shard 启动一个进程，各自有自己的 GIL；命令行加 --merge 则不启动进程，
+# 等待其他主机上的 shard 完成，最多等 ShardMergeTimeout 秒。合并各 shard 的结果输出一份比较报告，合并后删除结果文件，
+# 下次运行从头开始。有 shard 没有结果(失败、崩溃或超时仍未完成)则报告缺少哪些 shard，抛出 TransferError
+def run_shard_coordinator():
+    start_time = time.time()
+    deadline = start_time + ShardMergeTimeout if ShardMergeTimeout > 0 else None
+    if '--merge' not in sys.argv:
+        for shard_index in range(ShardCount):
+            s3_dest_client.delete_object(Bucket=DesBucket, Key=shard_result_key(shard_index))
+        logger.info(f'Start {ShardCount} shard processes')
+        shard_processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--shard', str(shard_index)],
+                                            stdin=subprocess.DEVNULL)
+                           for shard_index in range(ShardCount)]
+        for p in shard_processes:
+            p.wait()
+    shard_results = {}
+    while True:
+        for shard_index in range(ShardCount):
+            if shard_index not in shard_results:
+                result = load_shard_result(shard_index)
+                if result is not None:
+                    shard_results[shard_index] = result
+        missing = [i for i in range(ShardCount) if i not in shard_results]
+        if not missing or '--merge' not in sys.argv:
+            break
+        if deadline is not None and time.time() >= deadline:
+            logger.error(f'Waited {ShardMergeTimeout}s for shard results, stop waiting')
+            break
+        logger.info(f'Waiting for shards: {missing}')
+        time.sleep(30 if deadline is None else max(0, min(30, deadline - time.time())))
+    deltaList = []
+    source_count = 0
+    for shard_index in sorted(shard_results):
+        deltaList.extend(shard_results[shard_index]["Delta"])
+        source_count += shard_results[shard_index]["SourceFiles"]
+    spent_time = int(time.time() - start_time)
+    logger.warning(f'Merged {len(shard_results)}/{ShardCount} shards, {source_count} source files, '
+                   f'time: {spent_time}s')
+    if missing:
+        logger.error(f'Shards without result (failed or still running): {missing}')
+        if deltaList:
+            report_delta(deltaList)
+        raise TransferError(f'Shards without result: {missing}')
+    for shard_index in range(ShardCount):
+        s3_dest_client.delete_object(Bucket=DesBucket, Key=shard_result_key(shard_index))
+    report_delta(deltaList)
 
 
 # Main
-if __name__ == '__main__':
+class TransferError(Exception):
+    pass
+
+
+# 一次传输任务的配置。配置文件 s3_upload_config 的全部配置项是默认值，
+# config 是 dict 或有同名属性的对象(如另一个配置模块)，关键字参数再覆盖，如 TransferJob(JobType='S3_TO_S3', S3Prefix='logs')
+class TransferJob:
+    def __init__(self, config=None, **overrides):
+        self.config = dict(DefaultConfig)
+        if isinstance(config, dict):
+            overrides = {**config, **overrides}
+        elif config is not None:
+            self.config.update({k: getattr(config, k) for k in DefaultConfig if hasattr(config, k)})
+        unknown = [k for k in overrides if k not in DefaultConfig]
+        if unknown:
+            raise ValueError(f'Unknown config: {", ".join(unknown)}')
+        self.config.update(overrides)
+
+
+# 每个任务开始时按任务的配置重建统计、进度、完成记录、自适应状态；buffer_pool 保留，缓冲区跨任务复用
+def reset_job_state():
+    global metrics, profiler, progress, transfer_ledger, chunk_tuner, concurrency_controller, \
+        resume_journal, sync_manifest, part_pipeline, packed_file_index, pack_sequence, fanout_pool, part_ledger, \
+        list_error
+    metrics = TransferMetrics()
+    profiler = Profiler()
+    progress = ProgressReporter()
+    transfer_ledger = TransferLedger()
+    part_ledger = PartLedger()
+    chunk_tuner = ChunkSizeTuner()
+    concurrency_controller = ConcurrencyController()
+    resume_journal = None
+    sync_manifest = None
+    part_pipeline = None
+    list_error = None
+    fanout_pool = None
+    packed_file_index = {}
+    pack_sequence = itertools.count(1)
+
+
+# S3 client 连接池大小：同时可能发请求的线程数 = 分片线程 + 小文件线程 + 文件线程(create/list_parts/complete) + 列表线程
+def s3_pool_connections():
+    part_threads = MaxAdaptiveThread if AdaptiveConcurrency else MaxParallelFile * MaxThread
+    return part_threads + MaxSmallFileThread + MaxParallelFile + MaxListThread
+
+
+# 可嵌入的传输入口：长期运行的服务用同一个 Transferer 依次运行多个 TransferJob，复用 boto3 Session(凭证解析)、
+# S3 client 的连接池(TLS 连接)和线程池，并发配置变了才按新的大小重建
+# 模块状态是全局变量，同一时间只运行一个任务：所有 Transferer 的 run 共用模块级的 transfer_lock，并发调用会排队
+transfer_lock = threading.Lock()
+
+
+class Transferer:
+    def __init__(self, log_to_file=False, console=False):
+        self.log_to_file = log_to_file  # True 则每个任务写 log 目录下的日志文件
+        self.console = console  # True 则日志、进度状态行和结果输出到屏幕，命令行入口使用；False 时不向 stdout 输出，也不交互询问
+        self.log_file_name = None  # 上一次 run 写入的日志文件
+        self.sessions = {}  # {profile_name: Session}
+        self.clients = {}  # {profile_name: (max_pool_connections, client)}
+        self.ali_buckets = {}  # {(endpoint, bucket, key_id): (pool_size, Bucket)}
+        self.executors = {}  # {name: (max_workers, ThreadPoolExecutor)}
+
+    def s3_client(self, profile_name):
+        pool_size = s3_pool_connections()
+        cached = self.clients.get(profile_name)
+        if cached is None or cached[0] != pool_size:
+            if profile_name not in self.sessions:
+                self.sessions[profile_name] = Session(profile_name=profile_name)
+            client = self.sessions[profile_name].client('s3', config=Config(max_pool_connections=pool_size))
+            self.clients[profile_name] = cached = (pool_size, client)
+        return cached[1]
+
+    def oss_bucket(self):
+        pool_size = s3_pool_connections()
+        key = (ali_endpoint, ali_SrcBucket, ali_access_key_id)
+        cached = self.ali_buckets.get(key)
+        if cached is None or cached[0] != pool_size:
+            oss2.defaults.connection_pool_size = pool_size
+            bucket = oss2.Bucket(oss2.Auth(ali_access_key_id, ali_access_key_secret), ali_endpoint, ali_SrcBucket,
+                                 session=oss2.Session())
+            self.ali_buckets[key] = cached = (pool_size, bucket)
+        return cached[1]
+
+    def executor(self, name, max_workers):
+        cached = self.executors.get(name)
+        if cached is None or cached[0] != max_workers:
+            if cached is not None:
+                cached[1].shutdown(wait=True)
+            self.executors[name] = cached = (max_workers, futures.ThreadPoolExecutor(max_workers=max_workers))
+        return cached[1]
+
+    # 返回 {"Delta": 缺失或大小不一致的文件, "SourceFiles": 源文件数, "SpentTime": 秒}，任务中止则抛出 TransferError
+    # coordinator = True 时分片模式(ShardCount > 1, ShardIndex < 0)用命令行和配置文件启动各 shard 进程，只用于命令行入口
+    def run(self, job, coordinator=False):
+        with transfer_lock:
+            globals().update(job.config)
+            load_optional_modules()
+            setup_logging(self.log_to_file, self.console)
+            try:
+                if ShardCount > 1 and ShardIndex < 0 and not coordinator:
+                    logger.warning('ERR ShardIndex, each job runs one shard')
+                    raise TransferError('ERR ShardIndex, each job runs one shard')
+                reset_job_state()
+                return run_transfer(self)
+            except SystemExit as e:
+                raise TransferError(f'Transfer job quit: {e}')
+            finally:
+                self.log_file_name = log_file_name
+                close_logging()
+
+    def close(self):
+        for max_workers, executor in self.executors.values():
+            executor.shutdown(wait=True)
+        self.executors = {}
+        self.clients = {}
+        self.ali_buckets = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def run_transfer(transferer):
+    global s3_dest_client, s3_src_client, ali_bucket, destinations
     start_time = time.time()
     # 校验输入
     if JobType not in ['LOCAL_TO_S3', 'S3_TO_S3', 'ALIOSS_TO_S3']:
         logger.warning('ERR JobType, check config file')
-        sys.exit(0)
+        raise TransferError('ERR JobType')
+    if Engine not in ['thread', 'asyncio']:
+        logger.warning('ERR Engine, check config file')
+        raise TransferError('ERR Engine')
+    if ShardCount > 1 and ShardIndex >= ShardCount:
+        logger.warning('ERR ShardIndex, check config file')
+        raise TransferError('ERR ShardIndex')
+    if ChecksumAlgorithm not in ['', 'SHA256', 'CRC32C']:
+        logger.warning('ERR ChecksumAlgorithm, check config file')
+        raise TransferError('ERR ChecksumAlgorithm')
+    if ChecksumAlgorithm == 'CRC32C' and crc32c is None:
+        logger.warning('ChecksumAlgorithm CRC32C needs the crc32c package: pip install crc32c')
+        raise TransferError('ChecksumAlgorithm CRC32C needs the crc32c package')
+    if Compression and Compression not in CompressionCodecs:
+        logger.warning('ERR Compression, check config file')
+        raise TransferError('ERR Compression')
+    des_buckets = [DesBucket] + [d.get("DesBucket") for d in ExtraDestinations]
+    if None in des_buckets or len(set(des_buckets)) != len(des_buckets):
+        logger.warning('ERR ExtraDestinations, each needs a different DesBucket, check config file')
+        raise TransferError('ERR ExtraDestinations')
+    if ExtraDestinations and PackSmallFiles:
+        logger.warning('ERR ExtraDestinations, not supported with PackSmallFiles')
+        raise TransferError('ERR ExtraDestinations with PackSmallFiles')
 
-    # 定义 s3 client
-    s3_config = Config(max_pool_connections=25)
-    s3_dest_client = Session(profile_name=DesProfileName).client('s3', config=s3_config)
+    # 定义 s3 client，连接池大小按并发配置，Transferer 跨任务复用；每个目标用自己 profile 的 client
+    destinations = [Destination(DesBucket, DesProfileName, StorageClass)] + [
+        Destination(d["DesBucket"], d.get("DesProfileName", DesProfileName), d.get("StorageClass", StorageClass))
+        for d in ExtraDestinations]
+    for dest in destinations:
+        dest.client = transferer.s3_client(dest.profile)
+    s3_dest_client = destinations[0].client
     if JobType == 'S3_TO_S3':
-        s3_src_client = Session(profile_name=SrcProfileName).client('s3', config=s3_config)
+        s3_src_client = transferer.s3_client(SrcProfileName)
     elif JobType == 'ALIOSS_TO_S3':
-        ali_bucket = oss2.Bucket(oss2.Auth(ali_access_key_id, ali_access_key_secret), ali_endpoint, ali_SrcBucket)
+        ali_bucket = transferer.oss_bucket()
 
-    # 检查目标S3能否写入
+    # 分片模式的协调进程只启动 shard 进程和合并结果
+    if ShardCount > 1 and ShardIndex < 0:
+        run_shard_coordinator()
+        return None
+
+    # 传输统计输出和性能剖析，任务中止也要停止输出、关闭本地记录
+    metrics.start_export()
+    profiler.start()
+    if transferer.console:
+        progress.start()
     try:
-        logger.info('Checking write permission for dest. S3 bucket')
-        s3_dest_client.put_object(
-            Bucket=DesBucket,
-            Key=str(PurePosixPath(S3Prefix) / 'access_test'),
-            Body='access_test_content'
-        )
-    except Exception as e:
-        logger.error('Can not write to dest. bucket/prefix. ERR: '+str(e))
-        sys.exit(0)
+        return transfer_files(transferer, start_time)
+    finally:
+        progress.stop()
+        if resume_journal is not None:
+            resume_journal.close()
+        if sync_manifest is not None:
+            sync_manifest.close()
+        metrics.stop_export()
+        profiler.dump(os.path.splitext(log_file_name)[0] if log_file_name else this_file_name+'-'+job_time())
+
 
-    # 获取源文件列表
+def transfer_files(transferer, start_time):
+    global SrcDir, sync_manifest, resume_journal, part_pool, part_pipeline, packed_file_index, pack_name_prefix, \
+        fanout_pool
+    # 检查目标S3能否写入
+    for dest in destinations:
+        try:
+            logger.info(f'Checking write permission for dest. S3 bucket - {dest.bucket}')
+            dest.client.put_object(
+                Bucket=dest.bucket,
+                Key=str(PurePosixPath(S3Prefix) / 'access_test'),
+                Body='access_test_content'
+            )
+        except Exception as e:
+            logger.error(f'Can not write to dest. bucket/prefix - {dest.bucket}. ERR: '+str(e))
+            raise TransferError('Can not write to dest. bucket/prefix')
+
+    # 获取源文件列表：生成器边列边放入有界队列，与目标列表查询和文件上传同时进行
     logger.info('Get source file list')
-    src_file_list = []
     if JobType == "LOCAL_TO_S3":
         if SrcDir[-1] == '/':
             SrcDir = SrcDir[:len(SrcDir) - 1]
-        src_file_list = get_local_file_list()
+        src_file_iter = iter_local_file_list()
     elif JobType == "S3_TO_S3":
         if SrcFileIndex == "*":
-            src_file_list = get_s3_file_list(s3_src_client, SrcBucket)
+            src_file_iter = iter_s3_file_list(s3_src_client, SrcBucket)
         else:
-            src_file_list = head_s3_single_file(s3_src_client, SrcBucket)
+            src_file_iter = head_s3_single_file(s3_src_client, SrcBucket)
     elif JobType == 'ALIOSS_TO_S3':
         if SrcFileIndex == "*":
-            src_file_list = get_ali_oss_file_list(ali_bucket)
+            src_file_iter = iter_ali_oss_file_list(ali_bucket)
         else:
-            src_file_list = head_oss_single_file(ali_bucket)
+            src_file_iter = head_oss_single_file(ali_bucket)
+    src_file_queue = queue.Queue(maxsize=MaxListQueue)
+    small_file_queue = queue.Queue(maxsize=MaxListQueue)
+    metrics.gauge('file_queue_depth', src_file_queue.qsize)
+    metrics.gauge('small_file_queue_depth', small_file_queue.qsize)
+    metrics.gauge('buffer_in_use_bytes', lambda: buffer_pool.in_use)
+    if AdaptiveConcurrency:
+        metrics.gauge('concurrency_limit', lambda: concurrency_controller.limit)
+        metrics.gauge('parts_in_flight', lambda: concurrency_controller.in_flight)
+    stop_listing = threading.Event()
+    list_thread = threading.Thread(target=profiler.run,
+                                   args=(produce_file_queue, src_file_iter, src_file_queue, small_file_queue,
+                                         stop_listing),
+                                   daemon=True)
+    list_thread.start()
 
-    # 获取目标s3现存文件列表
-    des_file_list = get_s3_file_list(s3_dest_client, DesBucket)
+    # 打开本地同步清单
+    if JobType == 'LOCAL_TO_S3' and SyncManifestFile:
+        sync_manifest = SyncManifest(SyncManifestFile)
 
-    # 获取Bucket中所有未完成的Multipart Upload
-    multipart_uploaded_list = get_uploaded_list(s3_dest_client)
+    # 打开本地续传记录
+    if ResumeJournalFile:
+        resume_journal = ResumeJournal(ResumeJournalFile)
 
-    # 是否清理所有未完成的Multipart Upload, 用于强制重传
-    if multipart_uploaded_list:
-        logger.warning(f'{len(multipart_uploaded_list)} Unfinished upload, clean them and restart?')
-        logger.warning('NOTICE: IF CLEAN, YOU CANNOT RESUME ANY UNFINISHED UPLOAD')
-        if not DontAskMeToClean:
-            keyboard_input = input("CLEAN unfinished upload and restart(input CLEAN) or resume loading(press enter)? Please confirm: (n/CLEAN)")
-        else:
-            keyboard_input = 'no'
-        if keyboard_input == 'CLEAN':
-            # 清理所有未完成的Upload
-            for clean_i in multipart_uploaded_list:
-                s3_dest_client.abort_multipart_upload(
-                    Bucket=DesBucket,
-                    Key=clean_i["Key"],
-                    UploadId=clean_i["UploadId"]
-                )
-            multipart_uploaded_list = []
-            logger.info('CLEAN FINISHED')
+    stop_index = threading.Event()
+    index_threads = []
+    for dest in destinations:
+        # 获取目标s3现存文件列表，信任本地同步清单时不列出目标
+        # 打包模式要从中找出全部包索引，先列完；其他在后台列出，文件线程同时开始
+        if sync_manifest is not None and TrustSyncManifest:
+            logger.info(f'Trust sync manifest, skip listing destination bucket - {dest.bucket}')
+        elif JobType == 'LOCAL_TO_S3' and PackSmallFiles:
+            dest.des_file_index = build_des_file_index(get_s3_file_list(dest.client, dest.bucket))
         else:
-            logger.info('You choose not to clean, now try to resume unfinished upload')
+            dest.listed_upto = ''
+            index_thread = threading.Thread(target=profiler.run, args=(load_des_file_index, dest, stop_index),
+                                            daemon=True)
+            index_thread.start()
+            index_threads.append(index_thread)
+
+        # 获取Bucket中所有未完成的Multipart Upload，分片模式下只处理本 shard 的，未完成的包单独处理
+        uploaded_list = get_uploaded_list(dest)
+        multipart_uploaded_list = [u for u in uploaded_list if in_shard(u["Key"]) and not is_pack_key(u["Key"])]
+        if JobType == 'LOCAL_TO_S3' and PackSmallFiles:
+            abort_unfinished_packs(uploaded_list)
+
+        # 是否清理所有未完成的Multipart Upload, 用于强制重传
+        if multipart_uploaded_list:
+            logger.warning(f'{len(multipart_uploaded_list)} Unfinished upload in {dest.bucket}, clean them and restart?')
+            logger.warning('NOTICE: IF CLEAN, YOU CANNOT RESUME ANY UNFINISHED UPLOAD')
+            # 分片模式下多个进程不能同时询问，嵌入调用时没有终端可问，都默认续传
+            if not DontAskMeToClean and ShardCount <= 1 and transferer.console:
+                keyboard_input = input("CLEAN unfinished upload and restart(input CLEAN) or resume loading(press enter)? Please confirm: (n/CLEAN)")
+            else:
+                keyboard_input = 'no'
+            if keyboard_input == 'CLEAN':
+                # 清理所有未完成的Upload
+                for clean_i in multipart_uploaded_list:
+                    dest.client.abort_multipart_upload(
+                        Bucket=dest.bucket,
+                        Key=clean_i["Key"],
+                        UploadId=clean_i["UploadId"]
+                    )
+                    forget_upload(dest, clean_i["Key"], clean_i["UploadId"])
+                multipart_uploaded_list = []
+                logger.info('CLEAN FINISHED')
+            else:
+                logger.info('You choose not to clean, now try to resume unfinished upload')
+
+        # 目标文件列表和未完成的Upload只建一次索引，每个文件的检查都是 O(1) 查找
+        dest.upload_id_index = build_upload_id_index(multipart_uploaded_list)
+    if JobType == 'LOCAL_TO_S3' and PackSmallFiles:
+        packed_file_index = load_pack_index(destinations[0].des_file_index)
+        pack_name_prefix = f'{pack_dir()}/pack-{time.strftime("%Y%m%d%H%M%S", time.gmtime())}-'
+        if ShardCount > 1:
+            pack_name_prefix += f'shard{ShardIndex}-'
 
     # 对文件列表中的逐个文件进行上传操作
-    with futures.ThreadPoolExecutor(max_workers=MaxParallelFile) as file_pool:
-        for src_file in src_file_list:
-            file_pool.submit(upload_file, src_file, des_file_list, multipart_uploaded_list)
+    # 大文件走 Multipart，小文件由单独的高并发线程池单请求上传
+    # MaxParallelFile 个文件线程即同时打开的 Multipart Upload 上限，它们的分片共享一个全局分片线程池
+    # Engine = 'asyncio' 则分片共享一个事件循环，在途分片数由 MaxAsyncPart 控制
+    # 线程池由 Transferer 保留给后续任务复用，这里只等待本次任务提交的文件都处理完
+    if Engine == 'asyncio':
+        part_pool = AsyncPartEngine()
+    else:
+        part_pool = transferer.executor(
+            'part', MaxAdaptiveThread if AdaptiveConcurrency else MaxParallelFile * MaxThread)
+    # LOCAL_TO_S3 的 thread 引擎可选 读取 -> 哈希 -> 上传 分片流水线，上传阶段代替全局分片线程池
+    if JobType == 'LOCAL_TO_S3' and Engine == 'thread' and LocalPipeline:
+        part_pipeline = PartPipeline()
+        metrics.gauge('pipeline_hash_queue_depth', part_pipeline.hash_queue.qsize)
+        metrics.gauge('pipeline_upload_queue_depth', part_pipeline.upload_queue.qsize)
+    # 多个目标时，分片在读取或下载它的线程上传到第一个目标，同时在 fanout_pool 上传到其他目标
+    if len(destinations) > 1:
+        fanout_pool = transferer.executor(
+            'fanout', (MaxAdaptiveThread if AdaptiveConcurrency else MaxParallelFile * MaxThread) * (len(destinations) - 1))
+    file_pool = transferer.executor('file', MaxParallelFile)
+    if JobType == 'LOCAL_TO_S3' and PackSmallFiles:
+        small_file_pool = transferer.executor('pack', MaxPackThread)
+    else:
+        small_file_pool = transferer.executor('small_file', MaxSmallFileThread)
+    with part_pool if Engine == 'asyncio' else contextlib.nullcontext(), \
+            part_pipeline or contextlib.nullcontext():
+        file_jobs = [file_pool.submit(profiler.run, consume_file_queue, src_file_queue, upload_file)
+                     for i in range(MaxParallelFile)]
+        if JobType == 'LOCAL_TO_S3' and PackSmallFiles:
+            file_jobs += [small_file_pool.submit(profiler.run, consume_pack_queue, small_file_queue)
+                          for i in range(MaxPackThread)]
+        else:
+            file_jobs += [small_file_pool.submit(profiler.run, consume_file_queue, small_file_queue, upload_small_file)
+                          for i in range(MaxSmallFileThread)]
+        futures.wait(file_jobs)
+    # 消费者都已结束，万一有异常退出的，停止列出并清空队列，列表线程不会永远阻塞在满的队列上
+    stop_listing.set()
+    while list_thread.is_alive():
+        for q in (src_file_queue, small_file_queue):
+            with contextlib.suppress(queue.Empty):
+                while True:
+                    q.get_nowait()
+        list_thread.join(0.1)
+    stop_index.set()
+    for index_thread in index_threads:
+        index_thread.join()
+    if list_error is not None:
+        logger.error('Source file list did not finish, job aborted')
+        raise TransferError('Source file list fail')
+    progress.stop()
 
-    # 再次获取源文件列表和目标文件夹现存文件列表进行比较，每个文件大小一致，输出比较结果
+    # 按本次运行的完成记录校验，DeepVerify 则再次获取源文件列表和目标文件夹现存文件列表进行比较，输出比较结果
     spent_time = int(time.time() - start_time)
     time_m, time_s = divmod(spent_time, 60)
     time_h, time_m = divmod(time_m, 60)
-    if JobType == 'S3_TO_S3':
+    DesBuckets = ', '.join(f'{dest.bucket}/{S3Prefix}' for dest in destinations)
+    source = {'S3_TO_S3': f'{SrcBucket}/{S3Prefix}', 'ALIOSS_TO_S3': f'{ali_SrcBucket}/{S3Prefix}', 'LOCAL_TO_S3': SrcDir}[JobType]
+    logger.info(f'MISSION ACCOMPLISHED - Time: {time_h}H:{time_m}M:{time_s}S - FROM: {source} TO {DesBuckets}')
+    if transferer.console:
         print(
-            f'\033[0;34;1mMISSION ACCOMPLISHED - Time: {time_h}H:{time_m}M:{time_s}S \033[0m- FROM: {SrcBucket}/{S3Prefix} TO {DesBucket}/{S3Prefix}')
-        compare_buckets()
-    elif JobType == 'ALIOSS_TO_S3':
-        print(
-            f'\033[0;34;1mMISSION ACCOMPLISHED - Time: {time_h}H:{time_m}M:{time_s}S \033[0m- FROM: {ali_SrcBucket}/{S3Prefix} TO {DesBucket}/{S3Prefix}')
-        compare_buckets()
-    elif JobType == 'LOCAL_TO_S3':
-        print(
-            f'\033[0;34;1mMISSION ACCOMPLISHED - Time: {time_h}H:{time_m}M:{time_s}S \033[0m- FROM: {SrcDir} TO {DesBucket}/{S3Prefix}')
-        compare_local_to_s3()
-    print('Logged to file:', os.path.abspath(log_file_name))
+            f'\033[0;34;1mMISSION ACCOMPLISHED - Time: {time_h}H:{time_m}M:{time_s}S \033[0m- FROM: {source} TO {DesBuckets}')
+    if JobType == 'LOCAL_TO_S3':
+        deltaList, source_count = compare_local_to_s3() if DeepVerify else verify_from_ledger()
+    else:
+        deltaList, source_count = compare_buckets() if DeepVerify else verify_from_ledger()
+    if ShardCount > 1:
+        save_shard_result(deltaList, source_count, spent_time)
+    return {"Delta": deltaList, "SourceFiles": source_count, "SpentTime": spent_time}
+
+
+if __name__ == '__main__':
+    overrides = {}
+    # 命令行参数 --shard i 覆盖配置的 ShardIndex，多主机分片传输时各主机用同一个配置文件
+    if '--shard' in sys.argv:
+        overrides["ShardIndex"] = int(sys.argv[sys.argv.index('--shard') + 1])
+    with Transferer(log_to_file=True, console=True) as transferer:
+        try:
+            transferer.run(TransferJob(**overrides), coordinator=True)
+        except TransferError:
+            sys.exit(0)
+        finally:
+            if transferer.log_file_name is not None:
+                print('Logged to file:', os.path.abspath(transferer.log_file_name))
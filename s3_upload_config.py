@@ -7,15 +7,31 @@ SrcFileIndex = "*"  # 指定要上传的文件的文件名, type = str，Upload
 S3Prefix = "multipart"
 DesProfileName = "cn"  # 在~/.aws 中配置的能访问目标S3的 profile name
 DesBucket = "my-cn-bucket"  # 目标文件bucket, type = str
+# 同时传输到的其他目标，源文件只读取或下载一次，每个分片同时上传到所有目标，各目标分别续传和校验
+# 如 [{"DesBucket": "my-backup-bucket", "DesProfileName": "backup", "StorageClass": "STANDARD_IA"}]，
+# 不写 DesProfileName/StorageClass 则同上面的设置；不支持 PackSmallFiles, type = list
+ExtraDestinations = []
 
 """Configure for LOCAL_TO_S3"""
 SrcDir = r"/Users/huangzb/Downloads"  # 或Windows系统是 SrcDir = r"C:\Downloads"
 # 原文件本地存放目录，目录最后一个字符不要加斜杠, 字符串前面的 "r" 不要去掉
 # S3_TO_S3则该字段无效 type = str
+MaxWalkThread = 1  # 遍历本地目录的线程数，1 则在列表线程里顺序遍历(本地盘最快)；NFS/EFS 等每次 stat 是网络往返的文件系统可以加大, type = int
+LocalMmapRead = True  # True 则用 mmap 读取本地文件分片，不为每个分片分配内存；False 或不能 mmap 时用可复用的缓冲池, type = bool
+LocalPipeline = False  # True 则本地文件分片分成 读取 -> 哈希 -> 上传 三个阶段，各自线程数，阶段间是有界队列，适合慢速磁盘或 CPU 少的机器(thread 引擎), type = bool
+MaxReadThread = 4  # 流水线读取阶段的线程数，机械盘顺序读取宜少，SSD/网络文件系统可加大, type = int
+MaxHashThread = 4  # 流水线哈希阶段的线程数，hashlib 计算时释放 GIL，一般不超过 CPU 核数, type = int
+PipelineQueueSize = 8  # 流水线阶段之间最多排队的分片数，每个排队的分片占一个 ChunkSize 的缓冲区, type = int
+ChecksumAlgorithm = ""  # '' | 'SHA256' | 'CRC32C'，LOCAL_TO_S3 时每个分片额外带 S3 flexible checksum，CRC32C 需要 pip install crc32c, type = str
+SyncManifestFile = ""  # 本地同步清单文件(SQLite)，如 "s3_upload_manifest.db"，记录已同步文件的 Size/MTime/Inode/ETag
+# 再次运行时 stat 变化的文件即使大小相同也重新上传。空字符串(默认)则不启用, type = str
+TrustSyncManifest = False  # True 则信任本地同步清单，stat 没变的文件直接跳过，不再列出目标 Bucket，适合只有本工具写入目标的定期同步, type = bool
 
 """Configure for S3_TO_S3"""
 SrcBucket = "my-us-bucket"  # 源Bucket，LOCAL_TO_S3则本字段无效
 SrcProfileName = "us"  # 在~/.aws 中配置的能访问源S3的 profile name，LOCAL_TO_S3则本字段无效
+ServerSideCopy = False  # True 则用 upload_part_copy/copy_object 在S3服务端拷贝，数据不经过本机
+# 要求目标 profile 有源 Bucket 的读权限且在同一个分区(Global 与中国区之间不能用), type = bool
 
 """Configure for ALIOSS_TO_S3"""
 ali_SrcBucket = "img-process"  # 阿里云OSS 源Bucket，LOCAL_TO_S3/S3_TO_S3则本字段无效
@@ -25,17 +41,51 @@ ali_endpoint = "oss-cn-beijing.aliyuncs.com"  # OSS endpoint，在OSS控制台
 
 """Advanced Configure"""
 Megabytes = 1024*1024
-ChunkSize = 10 * Megabytes  # 文件分片大小，不小于5M，单文件分片总数不能超过10000, type = int
+ChunkSize = 10 * Megabytes  # 文件分片大小，不小于5M。单文件分片总数超过10000的会自动加大该文件的分片, type = int
+AdaptiveChunkSize = False  # True 则按实测的分片吞吐量和重试次数自动调整新文件的分片大小，ChunkSize 作为初始值, type = bool
+MaxChunkSize = 1024 * Megabytes  # 自适应分片大小的上限，S3_TO_S3/ALIOSS_TO_S3 每个线程要在内存中放一个分片, type = int
+MaxMemoryBuffer = 2048 * Megabytes  # 所有分片和小文件缓冲区的内存总量上限，超出则暂停读取或下载新分片/小文件，等待已有的上传完成, type = int
 MaxRetry = 20  # 单个Part上传失败后，最大重试次数, type = int
-MaxThread = 5  # 单文件同时上传的进程数量, type = int
-MaxParallelFile = 5  # 并行操作文件数量，即同时并发的进程数 = MaxParallelFile * MaxThread, type = int
+# 限流(SlowDown/503)和其他错误按各自的指数退避加随机抖动重试，没有权限、Bucket/Upload 不存在等错误不重试
+MaxThread = 5  # 全局分片线程池大小 = MaxParallelFile * MaxThread，所有文件的分片共享，空闲线程给还有分片的文件, type = int
+MaxParallelFile = 5  # 并行操作文件数量，即同时打开的 Multipart Upload 上限, type = int
+Engine = "thread"  # 分片并发引擎 'thread' | 'asyncio'。asyncio 则分片是事件循环里的协程，不占线程，在途分片数由 MaxAsyncPart 控制
+# asyncio 引擎需要安装 aiobotocore，没有安装则 S3 请求仍在 MaxParallelFile * MaxThread 个线程里执行, type = str
+MaxAsyncPart = 1000  # asyncio 引擎同时在途的分片数上限，S3_TO_S3/ALIOSS_TO_S3 还受 MaxMemoryBuffer 限制, type = int
+AdaptiveConcurrency = False  # True 则按实测吞吐量、限流和延迟自动增减同时传输的分片数(AIMD)，MaxParallelFile * MaxThread 作为初始值, type = bool
+MaxAdaptiveThread = 200  # 自适应并发的分片数上限，thread 引擎的分片线程池按这个大小创建, type = int
 IgnoreSmallFile = False  # 是否跳过小于chunksize的小文件, type = bool
 StorageClass = "STANDARD"
 # 'STANDARD'|'REDUCED_REDUNDANCY'|'STANDARD_IA'|'ONEZONE_IA'|'INTELLIGENT_TIERING'|'GLACIER'|'DEEP_ARCHIVE'
+Compression = ""  # '' | 'gzip' | 'deflate'，上传时流式压缩，目标对象设置 Content-Encoding，原文件大小记在元数据 uncompressed-size；服务端拷贝不压缩, type = str
+CompressLevel = 6  # 压缩级别 1-9，越大越慢压缩率越高, type = int
+CompressSampleSize = 1 * Megabytes  # 先压缩文件开头这么多字节试探压缩率, type = int
+CompressSkipRatio = 0.9  # 试探压缩后大于原大小的这个比例(已压缩的图片、视频、压缩包等)则不压缩，原样上传, type = float
 ifVerifyMD5 = False  # 是否做两次的MD5校验
 # 为True则一个文件完成上传合并分片之后再次进行整个文件的ETag校验MD5。
 # 对于S3_TO_S3，该开关True会在断点续传的时候重新下载所有已传过的分片来计算MD5。
 # 该开关不影响每个分片上传时候的校验，即使为False也会校验每个分片MD5。
+DeepVerify = False  # True 则传输结束后重新列出源和目标的全部文件逐个比较大小；False 则按本次运行的完成记录校验，只对未完成的文件 head 目标, type = bool
 
 DontAskMeToClean = False  # False 遇到存在现有的未完成upload时，不再询问是否Clean，默认不Clean，自动续传
+ResumeJournalFile = ""  # 本地续传记录文件(SQLite)，如 "s3_upload_resume.db"，记录每个已上传分片的 MD5/ETag
+# 续传时直接读取本地记录，不再 list_parts，ifVerifyMD5 也不用重新下载已传分片。空字符串(默认)则不启用, type = str
 LoggingLevel = "INFO"  # 日志输出级别 'WARNING' | 'INFO' | 'DEBUG'
+MaxListQueue = 1000  # 源文件列表边列边传的队列长度，列表快于上传时最多缓存这么多文件，type = int
+MaxListThread = 5  # 列出源/目标 Bucket 的并发线程数，>1 则按子目录分区并发列出，1 则单线程顺序列出, type = int
+SmallFileThreshold = ChunkSize  # 小于该大小的文件用单个 put_object 上传，不走 Multipart，设为 0 则全部走 Multipart, type = int
+MaxSmallFileThread = 50  # 小文件单请求上传的并发线程数, type = int
+PackSmallFiles = False  # True 则 LOCAL_TO_S3 的小文件不再逐个上传，按读取顺序打包成 tar 格式的大对象，每个包带一个 JSON 索引(各文件的 Offset/Size)，可以 Range GET 取出单个文件；续传以包为单位, type = bool
+PackSize = 256 * Megabytes  # 每个包的目标大小，包按 ChunkSize 分片边打包边上传, type = int
+MaxPackThread = 4  # 同时打包上传的包数，即读取小文件的线程数, type = int
+PackPrefix = "s3_upload_packs"  # 包和索引存放在目标 S3Prefix 下的这个子目录, type = str
+ShardCount = 1  # >1 则按目标 Key 的哈希把源文件分成 ShardCount 份，由多个进程(可以在多台主机)分别传输，type = int
+ShardIndex = -1  # 本进程传输的 shard 序号 0 ~ ShardCount-1，也可用命令行参数 --shard i 指定
+# -1 则在本机启动 ShardCount 个进程并合并结果；命令行加 --merge 则不启动进程，只等待并合并各主机的结果, type = int
+ShardMergeTimeout = 86400  # --merge 等待各主机 shard 结果的最长秒数，超时则报告缺少哪些 shard 并结束，0 则一直等待, type = int
+MetricsFile = ""  # 每 MetricsInterval 秒把传输统计(各阶段耗时直方图、吞吐量、重试、队列深度)写到这个 JSON 文件，空字符串则不写, type = str
+MetricsInterval = 10  # 传输统计 JSON 文件的写出间隔，秒, type = int
+MetricsPort = 0  # >0 则在 127.0.0.1 的这个端口提供 Prometheus 格式的 /metrics，0 则不启用, type = int
+ProfileMode = ""  # '' | 'cprofile' | 'tracemalloc'，结束时把 CPU 热点或内存分配热点写到 log 目录, type = str
+ProgressInterval = 1  # 终端上刷新进度状态行(总进度、吞吐量、ETA、正在传输的文件)的间隔，秒，0 则不输出, type = int
+ProgressLogInterval = 60  # stdout 不是终端(重定向到文件或日志采集)时每隔多少秒输出一行进度，0 则不输出, type = int